@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Import-time budget check for the headless entry points and the web app.
+
+Runs `python -X importtime -c "import <module>"` in a fresh interpreter,
+takes the best of several runs and fails (exit code 1) if a module exceeds
+its budget or pulls in a heavy dependency that should load lazily.
+
+Usage:
+    python check_import_time.py            # check default budgets
+    python check_import_time.py --runs 5 --scale 1.5
+"""
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+
+# module -> (budget in ms, modules that must NOT be imported at startup)
+BUDGETS = {
+    "src.services.scheduler": (600, ["streamlit", "plotly", "pandas", "yfinance"]),
+    "src.services.cron_update": (600, ["streamlit", "plotly", "pandas", "yfinance"]),
+    "src.services.market_data": (150, ["streamlit", "pandas", "yfinance"]),
+    "src.data.auth_manager": (500, ["streamlit", "pandas"]),
+    # Streamlit itself is most of this; pandas loads with the first dashboard render
+    "src.ui.app": (1500, ["pandas", "yfinance"]),
+}
+
+
+def measure(module):
+    """Returns (cumulative import time in ms, set of imported top-level packages)."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr.strip()[-2000:]}")
+
+    total_us = None
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        parts = [p.strip() for p in line[len("import time:"):].split("|")]
+        if len(parts) != 3 or not parts[1].isdigit():
+            continue
+        name = parts[2].strip()
+        imported.add(name.split(".")[0])
+        if name == module:
+            total_us = int(parts[1])
+    if total_us is None:
+        raise RuntimeError(f"No import time reported for {module}")
+    return total_us / 1000.0, imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3, help="runs per module (best is kept)")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply all budgets (slow machines)")
+    args = parser.parse_args()
+
+    failures = []
+    for module, (budget_ms, forbidden) in BUDGETS.items():
+        best_ms, imported = None, set()
+        for _ in range(max(1, args.runs)):
+            ms, imported = measure(module)
+            best_ms = ms if best_ms is None else min(best_ms, ms)
+        limit = budget_ms * args.scale
+        leaked = sorted(set(forbidden) & imported)
+        status = "OK"
+        if best_ms > limit:
+            status = "SLOW"
+            failures.append(f"{module}: {best_ms:.0f} ms > budget {limit:.0f} ms")
+        if leaked:
+            status = "HEAVY"
+            failures.append(f"{module}: imports {', '.join(leaked)} at startup")
+        print(f"{status:5} {module:32} {best_ms:8.1f} ms (budget {limit:.0f} ms)")
+
+    if failures:
+        print("\nImport budget exceeded:")
+        for failure in failures:
+            print(f"- {failure}")
+        sys.exit(1)
+    print("\nAll modules within import budget.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,49 @@
 import sqlite3
-import os
+import copy
+import time
 import secrets
-import pandas as pd
-import streamlit_authenticator as stauth
-from cryptography.fernet import Fernet
+import threading
+from cryptography.fernet import Fernet, MultiFernet
 from ..settings import get_settings
+from .db import resolve_db_path, ensure_db_dir
+
+# users columns holding Fernet tokens (re-encrypted by src.services.key_rotation,
+# which also re-encrypts ai_batches.api_key_enc)
+ENCRYPTED_COLUMNS = ("gemini_key_enc", "iol_user_enc", "iol_pass_enc")
+
+def parse_keys(value):
+    """Comma-separated ENCRYPTION_KEY -> list of keys (first is the primary)."""
+    return [key.strip() for key in value.split(",") if key.strip()]
+
+def hash_password(password):
+    """Bcrypt hash through streamlit-authenticator (current API, then legacy)."""
+    # Imported lazily: streamlit_authenticator pulls in Streamlit
+    import streamlit_authenticator as stauth
+
+    try:
+        # New API for streamlit-authenticator > 0.3.0
+        return stauth.Hasher.hash(password)
+    except Exception as e:
+        print(f"Primary hashing method failed: {e}. Trying legacy method...")
+        return stauth.Hasher([password]).generate()[0]
 
 class AuthManager:
+    # Credential map per database, shared by every session of the process:
+    # {db_path: (version, credentials)}
+    _credentials_cache = {}
+    _cache_lock = threading.Lock()
+
     def __init__(self, db_path="data/inver.db"):
-        self.db_path = self._resolve_db_path(db_path)
-        self._ensure_db_dir()
+        self.db_path = resolve_db_path(db_path)
+        ensure_db_dir(self.db_path)
         self.settings = get_settings()
-        self._key = self.settings.ENCRYPTION_KEY
-        self.cipher = Fernet(self._key)
+        # ENCRYPTION_KEY may list several keys: the first encrypts, any of them decrypts
+        self.keys = parse_keys(self.settings.ENCRYPTION_KEY)
+        self.primary = Fernet(self.keys[0])
+        self.cipher = MultiFernet([Fernet(key) for key in self.keys])
         self.cookie_key = self.settings.COOKIE_KEY
         self._init_users_table()
 
-    def _resolve_db_path(self, db_path):
-        if os.path.isabs(db_path):
-            return db_path
-        project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
-        return os.path.join(project_root, db_path)
-
-    def _ensure_db_dir(self):
-        dirname = os.path.dirname(self.db_path)
-        if dirname and not os.path.exists(dirname):
-            os.makedirs(dirname)
-        
     def _init_users_table(self):
         conn = sqlite3.connect(self.db_path)
         c = conn.cursor()
@@ -41,6 +58,34 @@ class AuthManager:
                 iol_pass_enc TEXT
             )
         ''')
+        # Migration: nightly batch analysis opt-in
+        c.execute("PRAGMA table_info(users)")
+        if "batch_opt_in" not in [row[1] for row in c.fetchall()]:
+            c.execute("ALTER TABLE users ADD COLUMN batch_opt_in INTEGER DEFAULT 0")
+
+        # Credentials version, bumped by every write that changes users' credentials
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS auth_meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER
+            )
+        ''')
+        c.execute("INSERT OR IGNORE INTO auth_meta (key, value) VALUES ('credentials_version', 0)")
+
+        # Progress of the online key rotation, one row per primary key
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS key_rotation (
+                key_id TEXT PRIMARY KEY,
+                last_rowid INTEGER DEFAULT 0,
+                rotated INTEGER DEFAULT 0,
+                skipped INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                started_at REAL,
+                updated_at REAL,
+                finished_at REAL
+            )
+        ''')
+
         # Check if we need to create default admin
         c.execute("SELECT count(*) FROM users")
         if c.fetchone()[0] == 0:
@@ -58,17 +103,10 @@ class AuthManager:
             print(f"WARNING: ADMIN_PASSWORD not set. Generated temporary admin password: {admin_password}")
 
         try:
-            # New API for streamlit-authenticator > 0.3.0
-            hashed_pw = stauth.Hasher.hash(admin_password)
+            hashed_pw = hash_password(admin_password)
         except Exception as e:
-            print(f"Primary hashing method failed: {e}. Trying legacy method...")
-            try:
-                # Legacy API check
-                hasher = stauth.Hasher([admin_password])
-                hashed_pw = hasher.generate()[0]
-            except Exception as e2:
-                print(f"Error hashing password: {e2}")
-                hashed_pw = "$2b$12$DEFAULT_HASH_IF_FAILED_TO_GEN" # Fallback, should not happen
+            print(f"Error hashing password: {e}")
+            hashed_pw = "$2b$12$DEFAULT_HASH_IF_FAILED_TO_GEN" # Fallback, should not happen
 
         # Get env vars to migrate
         gemini = self.settings.GEMINI_API_KEY or ""
@@ -84,6 +122,17 @@ class AuthManager:
             INSERT INTO users (username, name, email, password_hash, gemini_key_enc, iol_user_enc, iol_pass_enc)
             VALUES (?, ?, ?, ?, ?, ?, ?)
         ''', ("admin", "Administrator", "admin@inver.app", hashed_pw, gemini_enc, iol_u_enc, iol_p_enc))
+        self._bump_version(cursor)
+
+    def _bump_version(self, cursor):
+        """Invalidates cached credentials in every process (call inside the write transaction)."""
+        cursor.execute("UPDATE auth_meta SET value = value + 1 WHERE key = 'credentials_version'")
+
+    def get_credentials_version(self):
+        conn = sqlite3.connect(self.db_path)
+        row = conn.execute("SELECT value FROM auth_meta WHERE key = 'credentials_version'").fetchone()
+        conn.close()
+        return row[0] if row else 0
 
     def encrypt(self, text):
         if not text:
@@ -98,22 +147,40 @@ class AuthManager:
         except:
             return None
 
-    def get_authenticator(self):
-        """Returns the Authenticator object populated with DB users."""
+    def get_credentials(self):
+        """
+        Authenticator credentials ({"usernames": {...}}), cached in-process and
+        reloaded only when the credentials version changes. Do not mutate.
+        """
+        version = self.get_credentials_version()
+        cached = self._credentials_cache.get(self.db_path)
+        if cached and cached[0] == version:
+            return cached[1]
+
         conn = sqlite3.connect(self.db_path)
-        df = pd.read_sql("SELECT * FROM users", conn)
+        c = conn.cursor()
+        c.execute("SELECT username, name, email, password_hash FROM users")
+        rows = c.fetchall()
         conn.close()
         
         credentials = {"usernames": {}}
-        for _, row in df.iterrows():
-            credentials["usernames"][row['username']] = {
-                "name": row['name'],
-                "email": row['email'],
-                "password": row['password_hash']
+        for username, name, email, password_hash in rows:
+            credentials["usernames"][username] = {
+                "name": name,
+                "email": email,
+                "password": password_hash
             }
-            
+        with self._cache_lock:
+            self._credentials_cache[self.db_path] = (version, credentials)
+        return credentials
+
+    def get_authenticator(self):
+        """Returns the Authenticator object populated with DB users."""
+        import streamlit_authenticator as stauth
+
+        # The authenticator writes into its credentials; keep the cached map clean
         return stauth.Authenticate(
-            credentials,
+            copy.deepcopy(self.get_credentials()),
             "inver_cookie",
             self.cookie_key,
             cookie_expiry_days=30
@@ -134,6 +201,21 @@ class AuthManager:
             }
         return {}
 
+    def get_user_keys_cached(self, username, cache, ttl=300):
+        """
+        get_user_keys memoized in a caller-owned dict (e.g. st.session_state),
+        so a session doesn't decrypt on every rerun. Entries expire after
+        `ttl` seconds or when the credentials version changes.
+        """
+        key = f"user_keys:{username.lower()}"
+        version = self.get_credentials_version()
+        entry = cache.get(key)
+        if entry and entry["version"] == version and entry["expires_at"] > time.time():
+            return entry["keys"]
+        keys = self.get_user_keys(username)
+        cache[key] = {"version": version, "expires_at": time.time() + ttl, "keys": keys}
+        return keys
+
     def update_user_keys(self, username, gemini=None, iol_user=None, iol_pass=None):
         conn = sqlite3.connect(self.db_path)
         c = conn.cursor()
@@ -149,10 +231,114 @@ class AuthManager:
         if iol_pass is not None:
             enc = self.encrypt(iol_pass)
             c.execute("UPDATE users SET iol_pass_enc=? WHERE username=? COLLATE NOCASE", (enc, username))
-            
+
+        self._bump_version(c)
         conn.commit()
         conn.close()
 
+    def get_batch_opt_in(self, username):
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+        c.execute("SELECT batch_opt_in FROM users WHERE username=? COLLATE NOCASE", (username,))
+        row = c.fetchone()
+        conn.close()
+        return bool(row and row[0])
+
+    def set_batch_opt_in(self, username, enabled):
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+        c.execute("UPDATE users SET batch_opt_in=? WHERE username=? COLLATE NOCASE", (1 if enabled else 0, username))
+        conn.commit()
+        conn.close()
+
+    def get_batch_users(self):
+        """Usernames that opted in to the nightly batch analysis."""
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+        c.execute("SELECT username FROM users WHERE batch_opt_in = 1 ORDER BY username")
+        users = [row[0] for row in c.fetchall()]
+        conn.close()
+        return users
+
+    def get_iol_accounts(self):
+        """
+        [(username, iol_user, iol_pass)] for every user with stored IOL
+        credentials. Rows that fail to decrypt are skipped.
+        """
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+        c.execute('''
+            SELECT username, iol_user_enc, iol_pass_enc FROM users
+            WHERE iol_user_enc IS NOT NULL AND iol_pass_enc IS NOT NULL
+            ORDER BY username
+        ''')
+        rows = c.fetchall()
+        conn.close()
+
+        accounts = []
+        for username, user_enc, pass_enc in rows:
+            iol_user, iol_pass = self.decrypt(user_enc), self.decrypt(pass_enc)
+            if iol_user and iol_pass:
+                accounts.append((username, iol_user, iol_pass))
+        return accounts
+
+    def get_encrypted_batch(self, after_rowid, limit):
+        """[(rowid, username, {column: token})] of the next `limit` users after `after_rowid`."""
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+        c.execute(f'''
+            SELECT rowid, username, {", ".join(ENCRYPTED_COLUMNS)} FROM users
+            WHERE rowid > ? ORDER BY rowid LIMIT ?
+        ''', (after_rowid, limit))
+        rows = c.fetchall()
+        conn.close()
+        return [(row[0], row[1], dict(zip(ENCRYPTED_COLUMNS, row[2:]))) for row in rows]
+
+    def get_rotation_progress(self, key_id):
+        """Stored progress of the rotation to `key_id` (None if it never started)."""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        row = conn.execute("SELECT * FROM key_rotation WHERE key_id = ?", (key_id,)).fetchone()
+        conn.close()
+        return dict(row) if row else None
+
+    def save_rotated_batch(self, key_id, last_rowid, updates, skipped=0, failed=0, finished=False):
+        """
+        Writes re-encrypted tokens and the rotation progress in one short
+        transaction. `updates` are (column, new_token, rowid, old_token); a
+        token changed since it was read (e.g. the user saved new keys) is
+        left alone. Returns the number of tokens replaced.
+        """
+        now = time.time()
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            before = conn.total_changes
+            for column in ENCRYPTED_COLUMNS:
+                conn.executemany(
+                    f"UPDATE users SET {column} = ? WHERE rowid = ? AND {column} = ?",
+                    [(new, rowid, old) for col, new, rowid, old in updates if col == column]
+                )
+            rotated = conn.total_changes - before
+            conn.execute('''
+                INSERT INTO key_rotation (key_id, last_rowid, rotated, skipped, failed, started_at, updated_at, finished_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(key_id) DO UPDATE SET
+                    last_rowid = excluded.last_rowid,
+                    rotated = rotated + excluded.rotated,
+                    skipped = skipped + excluded.skipped,
+                    failed = failed + excluded.failed,
+                    updated_at = excluded.updated_at,
+                    finished_at = excluded.finished_at
+            ''', (key_id, last_rowid, rotated, skipped + len(updates) - rotated, failed, now, now, now if finished else None))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return rotated
+
     def user_exists(self, username):
         conn = sqlite3.connect(self.db_path)
         c = conn.cursor()
@@ -166,15 +352,10 @@ class AuthManager:
             return False, "Username already exists"
 
         try:
-            # Hash password (using the fixed API)
-            hashed_pw = stauth.Hasher.hash(password)
+            # bcrypt releases the GIL, so other sessions keep running meanwhile
+            hashed_pw = hash_password(password)
         except Exception as e:
-            # Fallback for safety, though unlikely now
-            try:
-                hasher = stauth.Hasher([password])
-                hashed_pw = hasher.generate()[0]
-            except:
-                return False, f"Error hashing password: {e}"
+            return False, f"Error hashing password: {e}"
 
         try:
             conn = sqlite3.connect(self.db_path)
@@ -183,6 +364,7 @@ class AuthManager:
                 INSERT INTO users (username, name, email, password_hash)
                 VALUES (?, ?, ?, ?)
             ''', (username, name, email, hashed_pw))
+            self._bump_version(c)
             conn.commit()
             conn.close()
             return True, "User created successfully"
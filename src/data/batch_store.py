@@ -0,0 +1,125 @@
+import sqlite3
+import json
+import time
+from .db import resolve_db_path, ensure_db_dir
+
+# Gemini batch states after which a batch is no longer polled
+TERMINAL_STATES = ("BATCH_STATE_SUCCEEDED", "BATCH_STATE_FAILED",
+                   "BATCH_STATE_CANCELLED", "BATCH_STATE_EXPIRED")
+
+class BatchStore:
+    """
+    Tracks Gemini batch jobs submitted for the nightly analyses, so the
+    scheduler can poll and import them across restarts. API keys are stored
+    encrypted (the caller passes the ciphertext).
+    """
+
+    def __init__(self, db_path="data/inver.db"):
+        self.db_path = resolve_db_path(db_path)
+        ensure_db_dir(self.db_path)
+        self.init_db()
+
+    def init_db(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS ai_batches (
+                name TEXT PRIMARY KEY,
+                key_hash TEXT,
+                api_key_enc TEXT,
+                model TEXT,
+                state TEXT,
+                requests TEXT,
+                request_count INTEGER,
+                result_count INTEGER,
+                error TEXT,
+                created_at REAL,
+                updated_at REAL,
+                imported_at REAL
+            )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_batches_state ON ai_batches (imported_at, state)")
+        conn.commit()
+        conn.close()
+
+    def add(self, name, key_hash, api_key_enc, model, requests):
+        """Records a submitted batch. requests maps request key -> metadata (user, amounts)."""
+        now = time.time()
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('''
+            INSERT INTO ai_batches (name, key_hash, api_key_enc, model, state, requests,
+                                    request_count, created_at, updated_at)
+            VALUES (?, ?, ?, ?, 'BATCH_STATE_PENDING', ?, ?, ?, ?)
+        ''', (name, key_hash, api_key_enc, model, json.dumps(requests), len(requests), now, now))
+        conn.commit()
+        conn.close()
+
+    def submitted_since(self, key_hash, since):
+        """True if a batch for this key was submitted after the `since` timestamp."""
+        conn = sqlite3.connect(self.db_path)
+        row = conn.execute(
+            "SELECT 1 FROM ai_batches WHERE key_hash = ? AND created_at >= ? LIMIT 1",
+            (key_hash, since)
+        ).fetchone()
+        conn.close()
+        return row is not None
+
+    def get_pending(self):
+        """Batches that still need polling or importing."""
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute('''
+            SELECT name, api_key_enc, model, state, requests FROM ai_batches
+            WHERE imported_at IS NULL
+            ORDER BY created_at ASC
+        ''').fetchall()
+        conn.close()
+        return [
+            {"name": name, "api_key_enc": key_enc, "model": model, "state": state,
+             "requests": json.loads(requests or "{}")}
+            for name, key_enc, model, state, requests in rows
+        ]
+
+    def get_api_keys(self):
+        """[(name, api_key_enc)] of every batch with a stored key (re-encrypted on key rotation)."""
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute(
+            "SELECT name, api_key_enc FROM ai_batches WHERE api_key_enc IS NOT NULL ORDER BY created_at"
+        ).fetchall()
+        conn.close()
+        return rows
+
+    def replace_api_keys(self, updates):
+        """
+        Writes re-encrypted keys ((name, new_enc, old_enc)) in one transaction;
+        a key changed since it was read is left alone. Returns rows replaced.
+        """
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        before = conn.total_changes
+        conn.executemany(
+            "UPDATE ai_batches SET api_key_enc = ? WHERE name = ? AND api_key_enc = ?",
+            [(new, name, old) for name, new, old in updates]
+        )
+        replaced = conn.total_changes - before
+        conn.commit()
+        conn.close()
+        return replaced
+
+    def update_state(self, name, state, error=None):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(
+            "UPDATE ai_batches SET state = ?, error = ?, updated_at = ? WHERE name = ?",
+            (state, error, time.time(), name)
+        )
+        conn.commit()
+        conn.close()
+
+    def mark_imported(self, name, result_count, error=None):
+        """Closes a batch: nothing left to poll or import."""
+        now = time.time()
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('''
+            UPDATE ai_batches SET result_count = ?, error = COALESCE(?, error),
+                                  updated_at = ?, imported_at = ?
+            WHERE name = ?
+        ''', (result_count, error, now, now, name))
+        conn.commit()
+        conn.close()
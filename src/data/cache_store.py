@@ -0,0 +1,193 @@
+import sqlite3
+import time
+import pickle
+import hashlib
+import functools
+from functools import lru_cache
+from .db import resolve_db_path, ensure_db_dir
+
+class CacheStore:
+    """
+    Small SQLite-backed key/value cache with TTL and size-bounded (LRU) eviction.
+    Lives in the shared data/ volume so the web app and the scheduler warm
+    the same entries.
+    """
+
+    def __init__(self, db_path="data/cache.db", max_entries=2000, max_bytes=64 * 1024 * 1024):
+        self.db_path = resolve_db_path(db_path)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        ensure_db_dir(self.db_path)
+        self.init_db()
+
+    def _connect(self):
+        # Short busy timeout: a cache should never block a render for long
+        conn = sqlite3.connect(self.db_path, timeout=5)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def init_db(self):
+        conn = self._connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                key TEXT PRIMARY KEY,
+                value BLOB,
+                size INTEGER,
+                expires_at REAL,
+                last_access REAL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS cache_stats (
+                namespace TEXT PRIMARY KEY,
+                hits INTEGER DEFAULT 0,
+                misses INTEGER DEFAULT 0
+            )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_expires ON cache_entries (expires_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_access ON cache_entries (last_access)")
+        conn.commit()
+        conn.close()
+
+    def get(self, key, default=None):
+        """Returns the cached value for key, or default if missing/expired."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT value, expires_at FROM cache_entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or row[1] < now:
+                return default
+            conn.execute("UPDATE cache_entries SET last_access = ? WHERE key = ?", (now, key))
+            conn.commit()
+        finally:
+            conn.close()
+        try:
+            return pickle.loads(row[0])
+        except Exception:
+            return default
+
+    def set(self, key, value, ttl):
+        """Stores value under key for ttl seconds, evicting if over budget."""
+        now = time.time()
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        conn = self._connect()
+        try:
+            conn.execute('''
+                INSERT INTO cache_entries (key, value, size, expires_at, last_access)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    value = excluded.value,
+                    size = excluded.size,
+                    expires_at = excluded.expires_at,
+                    last_access = excluded.last_access
+            ''', (key, sqlite3.Binary(blob), len(blob), now + ttl, now))
+            self._evict(conn, now)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def delete(self, key):
+        conn = self._connect()
+        conn.execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+        conn.commit()
+        conn.close()
+
+    def record(self, namespace, hit):
+        """Counts a hit or miss for namespace (shared across processes)."""
+        column = "hits" if hit else "misses"
+        conn = self._connect()
+        try:
+            conn.execute(f'''
+                INSERT INTO cache_stats (namespace, {column}) VALUES (?, 1)
+                ON CONFLICT(namespace) DO UPDATE SET {column} = {column} + 1
+            ''', (namespace,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def get_stats(self, namespace):
+        """Returns {"hits", "misses", "hit_rate"} for namespace."""
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT hits, misses FROM cache_stats WHERE namespace = ?", (namespace,)
+        ).fetchone()
+        conn.close()
+        hits, misses = row if row else (0, 0)
+        total = hits + misses
+        return {"hits": hits, "misses": misses, "hit_rate": hits / total if total else 0.0}
+
+    def _evict(self, conn, now):
+        """Drops expired entries, then least recently used ones until within bounds."""
+        conn.execute("DELETE FROM cache_entries WHERE expires_at < ?", (now,))
+        count, total = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries"
+        ).fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        rows = conn.execute(
+            "SELECT key, size FROM cache_entries ORDER BY last_access ASC"
+        ).fetchall()
+        victims = []
+        for key, size in rows:
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            victims.append((key,))
+            count -= 1
+            total -= size or 0
+        conn.executemany("DELETE FROM cache_entries WHERE key = ?", victims)
+
+    def get_or_set(self, key, ttl, loader):
+        """Returns the cached value, calling loader() and caching it on a miss."""
+        missing = object()
+        try:
+            value = self.get(key, missing)
+        except sqlite3.Error as e:
+            print(f"Cache read failed for {key}: {e}")
+            value = missing
+        if value is not missing:
+            return value
+        value = loader()
+        if value is not None:
+            try:
+                self.set(key, value, ttl)
+            except sqlite3.Error as e:
+                print(f"Cache write failed for {key}: {e}")
+        return value
+
+
+@lru_cache
+def get_cache_store():
+    """Process-wide CacheStore backed by data/cache.db."""
+    return CacheStore()
+
+
+def _make_key(prefix, args, kwargs):
+    raw = repr((args, sorted(kwargs.items())))
+    return f"{prefix}:{hashlib.sha256(raw.encode()).hexdigest()}"
+
+
+def disk_cache(ttl, namespace=None):
+    """
+    Decorator caching a function's result in the shared disk cache, keyed by
+    its arguments (drop-in for st.cache_data outside Streamlit). None results
+    are not cached so transient failures are retried.
+    Use `func.prime(value, *args)` to store a value computed elsewhere
+    (e.g. by a warm-up job) under the key of those arguments.
+    """
+    def decorator(func):
+        prefix = namespace or f"{func.__module__}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = _make_key(prefix, args, kwargs)
+            return get_cache_store().get_or_set(key, ttl, lambda: func(*args, **kwargs))
+
+        def prime(value, *args, **kwargs):
+            get_cache_store().set(_make_key(prefix, args, kwargs), value, ttl)
+
+        wrapper.prime = prime
+        return wrapper
+    return decorator
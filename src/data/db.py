@@ -0,0 +1,15 @@
+import os
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+def resolve_db_path(db_path):
+    """Relative database paths are taken from the project root."""
+    if os.path.isabs(db_path):
+        return db_path
+    return os.path.join(PROJECT_ROOT, db_path)
+
+def ensure_db_dir(db_path):
+    """Creates the directory of a database file if it is missing."""
+    dirname = os.path.dirname(db_path)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname, exist_ok=True)
@@ -0,0 +1,116 @@
+import sqlite3
+import time
+from .db import resolve_db_path, ensure_db_dir
+
+# Rate kinds as named by the argentinadatos.com API
+FX_OFFICIAL = "oficial"
+FX_MEP = "bolsa"
+FX_CCL = "contadoconliqui"
+
+class FXStore:
+    """
+    Daily FX rate series (official, MEP, CCL) stored in SQLite.
+    Series are loaded once per process and reused until the table changes
+    or max_age expires, so conversions never hit the DB row by row.
+    """
+
+    # Shared across instances: {(db_path, kind): (loaded_at, version, series)}
+    _series_cache = {}
+
+    def __init__(self, db_path="data/inver.db", max_age=3600):
+        self.db_path = resolve_db_path(db_path)
+        self.max_age = max_age
+        ensure_db_dir(self.db_path)
+        self.init_db()
+
+    def init_db(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS fx_rates (
+                date TEXT,
+                kind TEXT,
+                rate REAL,
+                PRIMARY KEY (kind, date)
+            )
+        ''')
+        conn.commit()
+        conn.close()
+
+    def save_rates(self, kind, rates):
+        """Upserts (date, rate) pairs for a rate kind. Returns rows written."""
+        rows = [(date, kind, float(rate)) for date, rate in rates if rate]
+        if not rows:
+            return 0
+        conn = sqlite3.connect(self.db_path)
+        conn.executemany('''
+            INSERT INTO fx_rates (date, kind, rate) VALUES (?, ?, ?)
+            ON CONFLICT(kind, date) DO UPDATE SET rate = excluded.rate
+        ''', rows)
+        conn.commit()
+        conn.close()
+        self._series_cache.pop((self.db_path, kind), None)
+        return len(rows)
+
+    def _version(self, conn, kind):
+        return conn.execute(
+            "SELECT COUNT(*), MAX(date) FROM fx_rates WHERE kind = ?", (kind,)
+        ).fetchone()
+
+    def get_series(self, kind):
+        """Returns the rate series for kind as a float Series indexed by Timestamp."""
+        key = (self.db_path, kind)
+        cached = self._series_cache.get(key)
+        if cached and time.time() - cached[0] < self.max_age:
+            return cached[2]
+
+        import pandas as pd
+
+        conn = sqlite3.connect(self.db_path)
+        version = self._version(conn, kind)
+        if cached and cached[1] == version:
+            conn.close()
+            self._series_cache[key] = (time.time(), version, cached[2])
+            return cached[2]
+        df = pd.read_sql_query(
+            "SELECT date, rate FROM fx_rates WHERE kind = ? ORDER BY date ASC", conn, params=(kind,)
+        )
+        conn.close()
+        series = pd.Series(df['rate'].values, index=pd.to_datetime(df['date']), name=kind, dtype=float)
+        self._series_cache[key] = (time.time(), version, series)
+        return series
+
+    def latest_rate(self, kind):
+        series = self.get_series(kind)
+        return float(series.iloc[-1]) if not series.empty else None
+
+    def latest_date(self, kind):
+        series = self.get_series(kind)
+        return series.index[-1].strftime("%Y-%m-%d") if not series.empty else None
+
+    def convert(self, df, kind, value_cols, date_col='date', suffix='_usd'):
+        """
+        Divides value_cols by the rate in effect on each row's date (last known
+        rate on or before it) in one vectorized merge. Adds `<col><suffix>` columns.
+        """
+        import pandas as pd
+
+        result = df.copy()
+        series = self.get_series(kind)
+        if result.empty or series.empty:
+            for col in value_cols:
+                result[f"{col}{suffix}"] = float('nan')
+            return result
+        rates = series.rename('fx_rate').rename_axis('_fx_date').reset_index()
+        result['_fx_date'] = pd.to_datetime(result[date_col])
+        order = result['_fx_date'].argsort(kind='stable')
+        merged = pd.merge_asof(
+            result.iloc[order], rates, on='_fx_date', direction='backward'
+        )
+        # Dates before the first stored rate use the earliest rate available
+        merged['fx_rate'] = merged['fx_rate'].fillna(rates['fx_rate'].iloc[0])
+        merged.index = result.index[order]
+        merged = merged.loc[result.index]
+        for col in value_cols:
+            result[f"{col}{suffix}"] = merged[col] / merged['fx_rate']
+        result['fx_rate'] = merged['fx_rate']
+        return result.drop(columns=['_fx_date'])
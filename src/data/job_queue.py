@@ -0,0 +1,203 @@
+import sqlite3
+import json
+import time
+from .db import resolve_db_path, ensure_db_dir
+
+class JobQueue:
+    """
+    Persistent queue of AI analysis requests stored in SQLite.
+    The UI enqueues jobs and polls their status; worker processes claim
+    them atomically, honouring a per-user concurrency limit.
+    """
+
+    def __init__(self, db_path="data/inver.db"):
+        self.db_path = resolve_db_path(db_path)
+        ensure_db_dir(self.db_path)
+        self.init_db()
+
+    def _connect(self):
+        # isolation_level=None: transactions are managed explicitly (BEGIN IMMEDIATE)
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def init_db(self):
+        conn = self._connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS analysis_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT,
+                status TEXT,
+                payload TEXT,
+                created_at REAL,
+                started_at REAL,
+                finished_at REAL,
+                worker TEXT,
+                analysis_id INTEGER,
+                error TEXT
+            )
+        ''')
+        # Migration: retry accounting and worker liveness
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(analysis_jobs)")]
+        if "attempts" not in columns:
+            conn.execute("ALTER TABLE analysis_jobs ADD COLUMN attempts INTEGER DEFAULT 0")
+        if "heartbeat_at" not in columns:
+            conn.execute("ALTER TABLE analysis_jobs ADD COLUMN heartbeat_at REAL")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON analysis_jobs (status, created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_user ON analysis_jobs (user_id, status)")
+        conn.close()
+
+    def _row_to_job(self, row):
+        if row is None:
+            return None
+        keys = ["id", "user_id", "status", "payload", "created_at", "started_at",
+                "finished_at", "worker", "analysis_id", "error"]
+        job = dict(zip(keys, row))
+        job["payload"] = json.loads(job["payload"] or "{}")
+        return job
+
+    def enqueue(self, user_id, payload):
+        """Adds a queued job and returns its id."""
+        conn = self._connect()
+        cursor = conn.execute('''
+            INSERT INTO analysis_jobs (user_id, status, payload, created_at)
+            VALUES (?, 'queued', ?, ?)
+        ''', (user_id, json.dumps(payload), time.time()))
+        job_id = cursor.lastrowid
+        conn.close()
+        return job_id
+
+    def claim(self, worker_id, per_user_limit=1):
+        """
+        Atomically marks the oldest runnable job as running and returns it
+        (None if nothing can run). Users already at per_user_limit running
+        jobs are skipped so one user cannot occupy every worker.
+        """
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute('''
+                SELECT id, user_id, status, payload, created_at, started_at,
+                       finished_at, worker, analysis_id, error
+                FROM analysis_jobs
+                WHERE status = 'queued'
+                  AND user_id NOT IN (
+                      SELECT user_id FROM analysis_jobs
+                      WHERE status = 'running'
+                      GROUP BY user_id HAVING COUNT(*) >= ?
+                  )
+                ORDER BY created_at ASC
+                LIMIT 1
+            ''', (per_user_limit,)).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            now = time.time()
+            conn.execute('''
+                UPDATE analysis_jobs SET status = 'running', started_at = ?, worker = ?,
+                                         heartbeat_at = ?, attempts = COALESCE(attempts, 0) + 1
+                WHERE id = ?
+            ''', (now, worker_id, now, row[0]))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        job = self._row_to_job(row)
+        job.update(status="running", started_at=now, worker=worker_id)
+        return job
+
+    def heartbeat(self, job_id, worker_id):
+        """Records that `worker_id` is still running the job."""
+        conn = self._connect()
+        conn.execute('''
+            UPDATE analysis_jobs SET heartbeat_at = ?
+            WHERE id = ? AND worker = ? AND status = 'running'
+        ''', (time.time(), job_id, worker_id))
+        conn.close()
+
+    def complete(self, job_id, analysis_id):
+        conn = self._connect()
+        conn.execute('''
+            UPDATE analysis_jobs SET status = 'done', finished_at = ?, analysis_id = ?
+            WHERE id = ?
+        ''', (time.time(), analysis_id, job_id))
+        conn.close()
+
+    def fail(self, job_id, error):
+        conn = self._connect()
+        conn.execute('''
+            UPDATE analysis_jobs SET status = 'failed', finished_at = ?, error = ?
+            WHERE id = ?
+        ''', (time.time(), str(error)[:2000], job_id))
+        conn.close()
+
+    def retry(self, job_id, error, max_attempts):
+        """
+        Sends a failed job back to the queue unless it already used
+        max_attempts runs, in which case it is marked failed. Returns True
+        if it was re-queued.
+        """
+        conn = self._connect()
+        cursor = conn.execute('''
+            UPDATE analysis_jobs SET status = 'queued', started_at = NULL, worker = NULL,
+                                     heartbeat_at = NULL, error = ?
+            WHERE id = ? AND status = 'running' AND attempts < ?
+        ''', (str(error)[:2000], job_id, max_attempts))
+        requeued = cursor.rowcount > 0
+        conn.close()
+        if not requeued:
+            self.fail(job_id, error)
+        return requeued
+
+    def get(self, job_id):
+        conn = self._connect()
+        row = conn.execute('''
+            SELECT id, user_id, status, payload, created_at, started_at,
+                   finished_at, worker, analysis_id, error
+            FROM analysis_jobs WHERE id = ?
+        ''', (job_id,)).fetchone()
+        conn.close()
+        return self._row_to_job(row)
+
+    def get_active_jobs(self, user_id):
+        """Queued or running jobs for a user, oldest first."""
+        conn = self._connect()
+        rows = conn.execute('''
+            SELECT id, user_id, status, payload, created_at, started_at,
+                   finished_at, worker, analysis_id, error
+            FROM analysis_jobs
+            WHERE user_id = ? AND status IN ('queued', 'running')
+            ORDER BY created_at ASC
+        ''', (user_id,)).fetchall()
+        conn.close()
+        return [self._row_to_job(row) for row in rows]
+
+    def requeue_stale(self, heartbeat_timeout, max_attempts):
+        """
+        Recovers running jobs whose worker sent no heartbeat for
+        heartbeat_timeout seconds (dead worker): they go back to the queue,
+        or are marked failed once they used max_attempts runs. Long jobs
+        with a live worker are left alone. Returns the number re-queued.
+        """
+        now = time.time()
+        stale = now - heartbeat_timeout
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute('''
+                UPDATE analysis_jobs SET status = 'failed', finished_at = ?,
+                                         error = 'Worker stopped responding (' || attempts || ' attempts)'
+                WHERE status = 'running' AND COALESCE(heartbeat_at, started_at) < ? AND attempts >= ?
+            ''', (now, stale, max_attempts))
+            cursor = conn.execute('''
+                UPDATE analysis_jobs SET status = 'queued', started_at = NULL, worker = NULL, heartbeat_at = NULL
+                WHERE status = 'running' AND COALESCE(heartbeat_at, started_at) < ?
+            ''', (stale,))
+            count = cursor.rowcount
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return count
@@ -0,0 +1,148 @@
+import sqlite3
+import time
+from .db import resolve_db_path, ensure_db_dir
+
+# Lease held by the scheduler replica that runs the singleton jobs
+LEADER_LEASE = "scheduler-leader"
+
+class LeaseStore:
+    """
+    Coordination between scheduler replicas sharing the database: named
+    leases (one holder at a time, e.g. the leader) and per-user refresh
+    claims so replicas split the portfolio refresh between them. Leases and
+    claims expire, so work held by a dead replica is picked up by the others.
+    """
+
+    def __init__(self, db_path="data/inver.db"):
+        self.db_path = resolve_db_path(db_path)
+        ensure_db_dir(self.db_path)
+        self.init_db()
+
+    def _connect(self):
+        # isolation_level=None: transactions are managed explicitly (BEGIN IMMEDIATE)
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def init_db(self):
+        conn = self._connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS scheduler_leases (
+                name TEXT PRIMARY KEY,
+                holder TEXT,
+                expires_at REAL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS refresh_claims (
+                user_id TEXT PRIMARY KEY,
+                holder TEXT,
+                expires_at REAL,
+                refreshed_at REAL
+            )
+        ''')
+        conn.close()
+
+    def try_acquire(self, name, holder, ttl):
+        """
+        Takes or renews the lease `name` for `ttl` seconds. Returns True if
+        `holder` owns it afterwards (free, expired or already held by it).
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT holder, expires_at FROM scheduler_leases WHERE name = ?", (name,)
+            ).fetchone()
+            acquired = row is None or row[0] == holder or row[1] < now
+            if acquired:
+                conn.execute('''
+                    INSERT INTO scheduler_leases (name, holder, expires_at) VALUES (?, ?, ?)
+                    ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+                ''', (name, holder, now + ttl))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return acquired
+
+    def release(self, name, holder):
+        """Gives up a lease early (no-op if `holder` does not own it)."""
+        conn = self._connect()
+        conn.execute(
+            "UPDATE scheduler_leases SET expires_at = 0 WHERE name = ? AND holder = ?", (name, holder)
+        )
+        conn.close()
+
+    def claim_users(self, user_ids, holder, limit, ttl, fresh_for):
+        """
+        Claims up to `limit` of `user_ids` for `ttl` seconds. A user is
+        claimable when no live claim exists and it was not refreshed in the
+        last `fresh_for` seconds. Returns the claimed user ids.
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute("SELECT user_id, expires_at, refreshed_at FROM refresh_claims").fetchall()
+            busy = {
+                user_id for user_id, expires_at, refreshed_at in rows
+                if (expires_at or 0) >= now or (refreshed_at or 0) >= now - fresh_for
+            }
+            claimed = [user_id for user_id in user_ids if user_id not in busy][:limit]
+            conn.executemany('''
+                INSERT INTO refresh_claims (user_id, holder, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+            ''', [(user_id, holder, now + ttl) for user_id in claimed])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return claimed
+
+    def complete_users(self, user_ids, holder):
+        """Marks claimed users as refreshed (attempted) and releases their claims."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany('''
+                UPDATE refresh_claims SET expires_at = 0, refreshed_at = ?
+                WHERE user_id = ? AND holder = ?
+            ''', [(now, user_id, holder) for user_id in user_ids])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def release_users(self, user_ids, holder):
+        """Drops claims without marking the users refreshed, so any replica can retry them."""
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "UPDATE refresh_claims SET expires_at = 0 WHERE user_id = ? AND holder = ?",
+                [(user_id, holder) for user_id in user_ids]
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def claimed_elsewhere(self, user_ids, holder):
+        """How many of `user_ids` are currently claimed by other holders."""
+        wanted = set(user_ids)
+        conn = self._connect()
+        rows = conn.execute(
+            "SELECT user_id FROM refresh_claims WHERE expires_at >= ? AND holder != ?",
+            (time.time(), holder)
+        ).fetchall()
+        conn.close()
+        return sum(1 for (user_id,) in rows if user_id in wanted)
@@ -0,0 +1,110 @@
+import sqlite3
+import math
+import time
+from functools import lru_cache
+from .db import resolve_db_path, ensure_db_dir
+
+def _percentile(values, pct):
+    """Nearest-rank percentile of a sorted list (None if empty)."""
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, math.ceil(pct / 100 * len(values)) - 1))
+    return values[index]
+
+class ModelStats:
+    """
+    Per-model call log (latency, outcome, output tokens) used to route
+    requests to fast, healthy Gemini models. Aggregates are computed over a
+    recent window and memoized briefly per process.
+    """
+
+    # Shared across instances: {(db_path, window): (loaded_at, stats)}
+    _stats_cache = {}
+
+    def __init__(self, db_path="data/inver.db", retention_days=7, cache_ttl=30):
+        self.db_path = resolve_db_path(db_path)
+        self.retention_days = retention_days
+        self.cache_ttl = cache_ttl
+        ensure_db_dir(self.db_path)
+        self.init_db()
+
+    def init_db(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS model_calls (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                model TEXT,
+                ts REAL,
+                latency REAL,
+                status TEXT,
+                output_tokens INTEGER
+            )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_model_calls_ts ON model_calls (ts)")
+        conn.commit()
+        conn.close()
+
+    def record(self, model, latency, status, output_tokens=0):
+        """
+        Logs one call. status is 'ok', 'timeout', 'server_error' (5xx, 429,
+        connection) or 'error' (request-side problems, not held against the model).
+        """
+        now = time.time()
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('''
+            INSERT INTO model_calls (model, ts, latency, status, output_tokens)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (model, now, float(latency), status, int(output_tokens or 0)))
+        conn.execute("DELETE FROM model_calls WHERE ts < ?", (now - self.retention_days * 86400,))
+        conn.commit()
+        conn.close()
+        for key in [k for k in self._stats_cache if k[0] == self.db_path]:
+            self._stats_cache.pop(key, None)
+
+    def get_stats(self, window=86400):
+        """
+        {model: {calls, p50, p90, p95, timeout_p95, timeout_rate, error_rate,
+        tokens_per_s}} over the last `window` seconds. Latency percentiles use
+        successful calls; timeout_p95 also counts timed-out calls at the
+        timeout they hit, so it grows while a model keeps timing out.
+        """
+        key = (self.db_path, window)
+        cached = self._stats_cache.get(key)
+        if cached and time.time() - cached[0] < self.cache_ttl:
+            return cached[1]
+
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute(
+            "SELECT model, latency, status, output_tokens FROM model_calls WHERE ts >= ?",
+            (time.time() - window,)
+        ).fetchall()
+        conn.close()
+
+        calls = {}
+        for model, latency, status, tokens in rows:
+            calls.setdefault(model, []).append((latency, status, tokens or 0))
+
+        stats = {}
+        for model, entries in calls.items():
+            ok = sorted(latency for latency, status, _ in entries if status == "ok")
+            censored = sorted(latency for latency, status, _ in entries if status in ("ok", "timeout"))
+            ok_time = sum(latency for latency, status, _ in entries if status == "ok")
+            ok_tokens = sum(tokens for _, status, tokens in entries if status == "ok")
+            total = len(entries)
+            stats[model] = {
+                "calls": total,
+                "p50": _percentile(ok, 50),
+                "p90": _percentile(ok, 90),
+                "p95": _percentile(ok, 95),
+                "timeout_p95": _percentile(censored, 95),
+                "timeout_rate": sum(1 for _, s, _ in entries if s == "timeout") / total,
+                "error_rate": sum(1 for _, s, _ in entries if s == "server_error") / total,
+                "tokens_per_s": (ok_tokens / ok_time) if ok_time > 0 else None,
+            }
+        self._stats_cache[key] = (time.time(), stats)
+        return stats
+
+@lru_cache
+def get_model_stats():
+    """Process-wide ModelStats on data/inver.db."""
+    return ModelStats()
@@ -0,0 +1,169 @@
+import sqlite3
+import re
+import time
+import hashlib
+from .db import resolve_db_path, ensure_db_dir
+
+def normalize_title(title):
+    """Lowercases a headline and strips punctuation/extra spaces for comparison."""
+    title = re.sub(r'[^\w\s]', ' ', (title or '').lower())
+    return re.sub(r'\s+', ' ', title).strip()
+
+def content_hash(item):
+    """Stable id for a story: the normalized headline, falling back to the URL."""
+    basis = normalize_title(item.get('title')) or item.get('link') or ''
+    return hashlib.sha1(basis.encode()).hexdigest()
+
+class NewsStore:
+    """
+    Persistent news table keyed by content hash, with a symbol/time index.
+    Filled incrementally per symbol and pruned by a retention window.
+    """
+
+    def __init__(self, db_path="data/inver.db", retention_days=14):
+        self.db_path = resolve_db_path(db_path)
+        self.retention_days = retention_days
+        ensure_db_dir(self.db_path)
+        self.init_db()
+
+    def init_db(self):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS news_items (
+                content_hash TEXT PRIMARY KEY,
+                title TEXT,
+                link TEXT,
+                publisher TEXT,
+                published_at REAL,
+                fetched_at REAL
+            )
+        ''')
+        # One row per (story, symbol); published_at is denormalized for the index
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS news_symbols (
+                content_hash TEXT,
+                symbol TEXT,
+                published_at REAL,
+                PRIMARY KEY (content_hash, symbol)
+            )
+        ''')
+        # Incremental fetch cursor: newest story seen in each symbol's own feed
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS news_fetch_state (
+                symbol TEXT PRIMARY KEY,
+                last_published REAL,
+                fetched_at REAL
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_news_symbol_time ON news_symbols (symbol, published_at)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_news_published ON news_items (published_at)")
+        conn.commit()
+        conn.close()
+
+    def last_seen(self, symbol):
+        """Publication time (epoch seconds) of the newest story stored from symbol's feed."""
+        conn = sqlite3.connect(self.db_path)
+        row = conn.execute(
+            "SELECT last_published FROM news_fetch_state WHERE symbol = ?", (symbol,)
+        ).fetchone()
+        conn.close()
+        return row[0] if row and row[0] else 0.0
+
+    def get_fetch_times(self, symbols):
+        """Returns {symbol: fetched_at} for symbols whose feed was stored before."""
+        symbols = list(symbols)
+        if not symbols:
+            return {}
+        placeholders = ",".join("?" for _ in symbols)
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute(
+            f"SELECT symbol, fetched_at FROM news_fetch_state WHERE symbol IN ({placeholders})",
+            symbols
+        ).fetchall()
+        conn.close()
+        return dict(rows)
+
+    def add_items(self, symbol, items):
+        """
+        Stores stories fetched for symbol that are newer than the last one seen.
+        Related tickers are indexed too. Returns the number of new stories.
+        """
+        now = time.time()
+        since = self.last_seen(symbol)
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        added = 0
+        newest = since
+        for item in items:
+            published = item.get('published')
+            if published:
+                if published <= since:
+                    continue
+                newest = max(newest, published)
+            else:
+                # Undated: stored as of now (dedup by content hash) but the
+                # cursor is not moved, or older dated stories would be skipped
+                published = now
+            digest = content_hash(item)
+            cursor.execute('''
+                INSERT OR IGNORE INTO news_items (content_hash, title, link, publisher, published_at, fetched_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (digest, item.get('title'), item.get('link'), item.get('publisher'), published, now))
+            added += cursor.rowcount
+            symbols = [symbol] + [s for s in item.get('related', []) if s and s != symbol]
+            cursor.executemany('''
+                INSERT OR IGNORE INTO news_symbols (content_hash, symbol, published_at)
+                VALUES (?, ?, ?)
+            ''', [(digest, s, published) for s in symbols])
+        cursor.execute('''
+            INSERT INTO news_fetch_state (symbol, last_published, fetched_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT(symbol) DO UPDATE SET
+                last_published = excluded.last_published,
+                fetched_at = excluded.fetched_at
+        ''', (symbol, newest, now))
+        conn.commit()
+        conn.close()
+        return added
+
+    def get_news_by_symbol(self, symbols, hours=24):
+        """Returns {symbol: [story, ...]} for stories published in the last `hours`."""
+        symbols = list(symbols)
+        if not symbols:
+            return {}
+        since = time.time() - hours * 3600
+        placeholders = ",".join("?" for _ in symbols)
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute(f'''
+            SELECT s.symbol, n.title, n.link, n.publisher, n.published_at
+            FROM news_symbols s
+            JOIN news_items n ON n.content_hash = s.content_hash
+            WHERE s.symbol IN ({placeholders}) AND s.published_at >= ?
+            ORDER BY s.published_at DESC
+        ''', (*symbols, since)).fetchall()
+        conn.close()
+
+        result = {symbol: [] for symbol in symbols}
+        for symbol, title, link, publisher, published in rows:
+            result[symbol].append({
+                "title": title,
+                "link": link,
+                "publisher": publisher,
+                "published": published,
+                "related": [],
+            })
+        return result
+
+    def prune(self, retention_days=None):
+        """Deletes stories older than the retention window. Returns rows removed."""
+        days = retention_days if retention_days is not None else self.retention_days
+        cutoff = time.time() - days * 86400
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM news_symbols WHERE published_at < ?", (cutoff,))
+        cursor.execute("DELETE FROM news_items WHERE published_at < ?", (cutoff,))
+        removed = cursor.rowcount
+        conn.commit()
+        conn.close()
+        return removed
@@ -1,26 +1,14 @@
 import sqlite3
-import pandas as pd
 from datetime import datetime, timedelta
-import os
+from .fx_store import FXStore, FX_CCL
+from .db import resolve_db_path, ensure_db_dir
 
 class PortfolioManager:
     def __init__(self, db_path="data/inver.db"):
-        self.db_path = self._resolve_db_path(db_path)
-        self._ensure_db_dir()
+        self.db_path = resolve_db_path(db_path)
+        ensure_db_dir(self.db_path)
         self.init_db()
 
-    def _resolve_db_path(self, db_path):
-        if os.path.isabs(db_path):
-            return db_path
-        project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
-        return os.path.join(project_root, db_path)
-
-    def _ensure_db_dir(self):
-        """Ensures the data directory exists."""
-        dirname = os.path.dirname(self.db_path)
-        if dirname and not os.path.exists(dirname):
-            os.makedirs(dirname)
-
     def init_db(self):
         """Creates the necessary tables if they don't exist and migrates schema."""
         conn = sqlite3.connect(self.db_path)
@@ -75,6 +63,32 @@ class PortfolioManager:
                 response TEXT
             )
         ''')
+
+        # Structured trade recommendations (one row per trade of an analysis)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ai_recommendations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                analysis_id INTEGER,
+                user_id TEXT,
+                created_at TEXT,
+                ticker TEXT,
+                side TEXT,
+                quantity REAL,
+                limit_price REAL,
+                amount REAL,
+                rationale TEXT
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_recs_user ON ai_recommendations (user_id, created_at)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_recs_ticker ON ai_recommendations (ticker, created_at)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_recs_analysis ON ai_recommendations (analysis_id)")
+
+        # Snapshots rebuilt by the gap backfill are flagged (V3)
+        for table in ("portfolio_snapshots", "asset_snapshots"):
+            try:
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN reconstructed INTEGER DEFAULT 0")
+            except sqlite3.OperationalError:
+                pass
         
         conn.commit()
         conn.close()
@@ -135,7 +149,8 @@ class PortfolioManager:
             VALUES (?, ?, ?, ?)
             ON CONFLICT(date, user_id) DO UPDATE SET
                 total_value = excluded.total_value,
-                invested_amount = excluded.invested_amount
+                invested_amount = excluded.invested_amount,
+                reconstructed = 0
         ''', (date_str, user_id, total_value, invested_amount))
         
         # 2. Save Assets
@@ -146,7 +161,8 @@ class PortfolioManager:
                 ON CONFLICT(date, symbol, user_id) DO UPDATE SET
                     quantity = excluded.quantity,
                     price = excluded.price,
-                    total_value = excluded.total_value
+                    total_value = excluded.total_value,
+                    reconstructed = 0
             ''', (
                 date_str, 
                 user_id,
@@ -159,19 +175,149 @@ class PortfolioManager:
         conn.commit()
         conn.close()
 
-    def get_history(self, days=30, user_id='admin'):
-        """Returns history for a specific user."""
+    def save_daily_snapshots(self, snapshots):
+        """
+        Bulk version of save_daily_snapshot for the scheduler: `snapshots` is a
+        list of dicts with user_id, total_value, assets and optional
+        invested_amount. Everything is written in a single transaction.
+        Returns the number of portfolios saved.
+        """
+        if not snapshots:
+            return 0
+        date_str = datetime.now().strftime("%Y-%m-%d")
+        totals, assets = [], []
+        for snap in snapshots:
+            totals.append((date_str, snap["user_id"], snap["total_value"], snap.get("invested_amount", 0.0)))
+            assets.extend(
+                (date_str, snap["user_id"], asset.get("Symbol"), asset.get("Quantity", 0),
+                 asset.get("Last Price", 0), asset.get("Total Value", 0))
+                for asset in snap.get("assets") or []
+            )
+
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT INTO portfolio_snapshots (date, user_id, total_value, invested_amount)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(date, user_id) DO UPDATE SET
+                total_value = excluded.total_value,
+                invested_amount = excluded.invested_amount,
+                reconstructed = 0
+        ''', totals)
+        cursor.executemany('''
+            INSERT INTO asset_snapshots (date, user_id, symbol, quantity, price, total_value)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(date, symbol, user_id) DO UPDATE SET
+                quantity = excluded.quantity,
+                price = excluded.price,
+                total_value = excluded.total_value,
+                reconstructed = 0
+        ''', assets)
+        conn.commit()
+        conn.close()
+        return len(totals)
+
+    def get_asset_history(self, user_id, start_date):
+        """
+        Recorded (not reconstructed) holdings of a user from the last snapshot
+        on or before start_date onwards: {date: [(symbol, quantity, price)]}.
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT date, symbol, quantity, price FROM asset_snapshots
+            WHERE user_id = ? AND reconstructed = 0 AND date >= COALESCE(
+                (SELECT MAX(date) FROM asset_snapshots
+                 WHERE user_id = ? AND reconstructed = 0 AND date <= ?), ?)
+            ORDER BY date ASC
+        ''', (user_id, user_id, start_date, start_date))
+        history = {}
+        for date, symbol, quantity, price in cursor.fetchall():
+            history.setdefault(date, []).append((symbol, quantity, price))
+        conn.close()
+        return history
+
+    def get_snapshot_dates(self, user_id, start_date):
+        """Dates with a portfolio snapshot (recorded or reconstructed) since start_date."""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT date FROM portfolio_snapshots WHERE user_id = ? AND date >= ?",
+            (user_id, start_date)
+        )
+        dates = {row[0] for row in cursor.fetchall()}
+        conn.close()
+        return dates
+
+    def save_reconstructed_snapshots(self, user_id, snapshots):
+        """
+        Writes backfilled days for one user in a single transaction, flagged
+        as reconstructed. `snapshots` maps date -> list of asset dicts. Days
+        that already have a snapshot are left untouched. Returns days written.
+        """
+        totals, assets = [], []
+        for date_str, day_assets in snapshots.items():
+            totals.append((date_str, user_id, sum(a["Total Value"] for a in day_assets)))
+            assets.extend(
+                (date_str, user_id, a["Symbol"], a["Quantity"], a["Last Price"], a["Total Value"])
+                for a in day_assets
+            )
+        if not totals:
+            return 0
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT INTO portfolio_snapshots (date, user_id, total_value, invested_amount, reconstructed)
+            VALUES (?, ?, ?, 0.0, 1)
+            ON CONFLICT(date, user_id) DO NOTHING
+        ''', totals)
+        written = conn.total_changes
+        cursor.executemany('''
+            INSERT INTO asset_snapshots (date, user_id, symbol, quantity, price, total_value, reconstructed)
+            VALUES (?, ?, ?, ?, ?, ?, 1)
+            ON CONFLICT(date, symbol, user_id) DO NOTHING
+        ''', assets)
+        conn.commit()
+        conn.close()
+        return written
+
+    def get_history(self, days=30, user_id='admin', currency='ARS', fx_kind=FX_CCL):
+        """
+        Returns history for a specific user. With currency='USD', values are
+        converted with the stored FX series (rate in effect on each date).
+        """
+        import pandas as pd
+
         conn = sqlite3.connect(self.db_path)
         start_date = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
         query = "SELECT * FROM portfolio_snapshots WHERE date >= ? AND user_id = ? ORDER BY date ASC"
         df = pd.read_sql_query(query, conn, params=(start_date, user_id))
         conn.close()
+        if currency == 'USD':
+            df = self._to_usd(df, fx_kind)
         return df
 
-    def calculate_gains(self, current_value, user_id='admin'):
-        history = self.get_history(days=40, user_id=user_id)
+    def _to_usd(self, df, fx_kind):
+        """Replaces ARS value columns with their USD equivalent (keeps *_ars copies)."""
+        converted = FXStore(self.db_path).convert(df, fx_kind, ['total_value', 'invested_amount'])
+        for col in ['total_value', 'invested_amount']:
+            converted[f"{col}_ars"] = converted[col]
+            converted[col] = converted[f"{col}_usd"]
+        return converted.drop(columns=['total_value_usd', 'invested_amount_usd'])
+
+    def calculate_gains(self, current_value, user_id='admin', currency='ARS', fx_kind=FX_CCL):
+        """
+        Daily/weekly/monthly gains against stored snapshots. current_value is in
+        ARS; with currency='USD' both sides are converted at their own date's rate.
+        """
+        history = self.get_history(days=40, user_id=user_id, currency=currency, fx_kind=fx_kind)
         if history.empty:
             return {}
+        if currency == 'USD':
+            rate = FXStore(self.db_path).latest_rate(fx_kind)
+            if not rate:
+                return {}
+            current_value = current_value / rate
             
         def get_value_days_ago(n_days):
             target_date = (datetime.now() - timedelta(days=n_days)).strftime("%Y-%m-%d")
@@ -237,6 +383,34 @@ class PortfolioManager:
         conn.close()
         return enriched_assets
 
+    def get_active_users(self, days=7):
+        """Returns user ids with at least one recorded (not reconstructed) snapshot in the last `days` days."""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        start_date = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
+        cursor.execute(
+            "SELECT DISTINCT user_id FROM portfolio_snapshots WHERE date >= ? AND reconstructed = 0 ORDER BY user_id",
+            (start_date,)
+        )
+        users = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        return users
+
+    def get_latest_assets(self, user_id='admin'):
+        """Returns the holdings from the user's most recent asset snapshot."""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT symbol, quantity, price, total_value FROM asset_snapshots
+            WHERE user_id = ? AND date = (SELECT MAX(date) FROM asset_snapshots WHERE user_id = ?)
+        ''', (user_id, user_id))
+        rows = cursor.fetchall()
+        conn.close()
+        return [
+            {"Symbol": symbol, "Quantity": qty, "Last Price": price, "Total Value": value}
+            for symbol, qty, price, value in rows
+        ]
+
     def save_analysis(self, model, investment_amount, portfolio_value, response, user_id='admin'):
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         conn = sqlite3.connect(self.db_path)
@@ -245,10 +419,134 @@ class PortfolioManager:
             INSERT INTO ai_analyses (timestamp, user_id, model, investment_amount, portfolio_value, response)
             VALUES (?, ?, ?, ?, ?, ?)
         ''', (timestamp, user_id, model, investment_amount, portfolio_value, response))
+        analysis_id = cursor.lastrowid
         conn.commit()
         conn.close()
-    
+        return analysis_id
+
+    def save_analyses(self, analyses):
+        """
+        Bulk insert of analyses in one transaction. Each item is a dict with
+        user_id, model, investment_amount, portfolio_value and response.
+        Returns the number of rows written.
+        """
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        rows = [
+            (timestamp, a['user_id'], a['model'], a.get('investment_amount', 0.0),
+             a.get('portfolio_value', 0.0), a['response'])
+            for a in analyses
+        ]
+        if not rows:
+            return 0
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT INTO ai_analyses (timestamp, user_id, model, investment_amount, portfolio_value, response)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', rows)
+        conn.commit()
+        conn.close()
+        return len(rows)
+
+    def get_last_investment_amount(self, user_id='admin', default=0.0):
+        """Amount used in the user's most recent analysis (default if none)."""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT investment_amount FROM ai_analyses WHERE user_id = ? ORDER BY id DESC LIMIT 1",
+            (user_id,)
+        )
+        row = cursor.fetchone()
+        conn.close()
+        return row[0] if row and row[0] is not None else default
+
+    def get_analysis(self, analysis_id):
+        """Returns a single analysis as a dict (None if missing)."""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, timestamp, user_id, model, investment_amount, portfolio_value, response
+            FROM ai_analyses WHERE id = ?
+        ''', (analysis_id,))
+        row = cursor.fetchone()
+        conn.close()
+        if not row:
+            return None
+        keys = ["id", "timestamp", "user_id", "model", "investment_amount", "portfolio_value", "response"]
+        return dict(zip(keys, row))
+
+    def find_analysis(self, response, user_id='admin'):
+        """Id of the user's latest analysis with exactly this response (None if none)."""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id FROM ai_analyses WHERE user_id = ? AND response = ? ORDER BY id DESC LIMIT 1",
+            (user_id, response)
+        )
+        row = cursor.fetchone()
+        conn.close()
+        return row[0] if row else None
+
+    def save_recommendations(self, analysis_id, trades, user_id='admin'):
+        """Stores the trades of a structured analysis. Returns rows written."""
+        created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        rows = [
+            (analysis_id, user_id, created_at, t['ticker'], t['side'], t.get('quantity', 0.0),
+             t.get('limit_price', 0.0), t.get('amount', 0.0), t.get('rationale', ''))
+            for t in trades
+        ]
+        if not rows:
+            return 0
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT INTO ai_recommendations (analysis_id, user_id, created_at, ticker, side,
+                                            quantity, limit_price, amount, rationale)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        conn.commit()
+        conn.close()
+        return len(rows)
+
+    def get_recommendations(self, user_id='admin', days=30, ticker=None):
+        """Trades recommended to the user in the last `days` days, newest first."""
+        import pandas as pd
+
+        start = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
+        query = '''
+            SELECT analysis_id, created_at, ticker, side, quantity, limit_price, amount, rationale
+            FROM ai_recommendations WHERE user_id = ? AND created_at >= ?
+        '''
+        params = [user_id, start]
+        if ticker:
+            query += " AND ticker = ?"
+            params.append(ticker.upper())
+        query += " ORDER BY created_at DESC, id ASC"
+        conn = sqlite3.connect(self.db_path)
+        df = pd.read_sql_query(query, conn, params=params)
+        conn.close()
+        return df
+
+    def get_recommendation_summary(self, user_id='admin', days=30):
+        """Per ticker and side: times recommended, total amount and average limit price."""
+        import pandas as pd
+
+        start = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
+        conn = sqlite3.connect(self.db_path)
+        df = pd.read_sql_query('''
+            SELECT ticker, side, COUNT(*) AS times, SUM(amount) AS total_amount,
+                   AVG(limit_price) AS avg_limit_price, MAX(created_at) AS last_recommended
+            FROM ai_recommendations
+            WHERE user_id = ? AND created_at >= ?
+            GROUP BY ticker, side
+            ORDER BY total_amount DESC
+        ''', conn, params=(user_id, start))
+        conn.close()
+        return df
+
     def get_analyses(self, limit=10, user_id='admin'):
+        import pandas as pd
+
         conn = sqlite3.connect(self.db_path)
         query = "SELECT id, timestamp, model, investment_amount, portfolio_value, response FROM ai_analyses WHERE user_id = ? ORDER BY id DESC LIMIT ?"
         df = pd.read_sql_query(query, conn, params=(user_id, limit))
@@ -0,0 +1,203 @@
+import sqlite3
+import time
+from functools import lru_cache
+from datetime import datetime, timedelta
+from .db import resolve_db_path, ensure_db_dir
+
+class UsageStore:
+    """
+    Gemini token usage per call, hourly rollups by user and model, and
+    per-user token buckets for quotas. Rollups are updated in the same
+    transaction as the raw row, so reports never scan the raw log.
+    """
+
+    def __init__(self, db_path="data/inver.db", retention_days=30):
+        self.db_path = resolve_db_path(db_path)
+        self.retention_days = retention_days
+        ensure_db_dir(self.db_path)
+        self.init_db()
+
+    def _connect(self):
+        # isolation_level=None: transactions are managed explicitly (BEGIN IMMEDIATE)
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def init_db(self):
+        conn = self._connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS ai_usage (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ts REAL,
+                user_id TEXT,
+                model TEXT,
+                kind TEXT,
+                status TEXT,
+                prompt_tokens INTEGER,
+                cached_tokens INTEGER,
+                thought_tokens INTEGER,
+                output_tokens INTEGER,
+                latency REAL
+            )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_usage_ts ON ai_usage (ts)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_usage_user ON ai_usage (user_id, ts)")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS ai_usage_hourly (
+                hour TEXT,
+                user_id TEXT,
+                model TEXT,
+                kind TEXT,
+                calls INTEGER,
+                prompt_tokens INTEGER,
+                cached_tokens INTEGER,
+                thought_tokens INTEGER,
+                output_tokens INTEGER,
+                latency_sum REAL,
+                PRIMARY KEY (hour, user_id, model, kind)
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS token_buckets (
+                user_id TEXT PRIMARY KEY,
+                tokens REAL,
+                updated_at REAL
+            )
+        ''')
+        conn.close()
+
+    def record(self, user_id, model, usage=None, latency=0.0, status="ok", kind="generate"):
+        """
+        Logs one call from its usageMetadata (promptTokenCount,
+        cachedContentTokenCount, thoughtsTokenCount, candidatesTokenCount)
+        and adds it to the hourly rollup.
+        """
+        usage = usage or {}
+        now = time.time()
+        hour = datetime.fromtimestamp(now).strftime("%Y-%m-%d %H:00")
+        model = (model or "unknown").replace("models/", "")
+        user_id = user_id or "unknown"
+        tokens = (
+            int(usage.get("promptTokenCount") or 0),
+            int(usage.get("cachedContentTokenCount") or 0),
+            int(usage.get("thoughtsTokenCount") or 0),
+            int(usage.get("candidatesTokenCount") or 0),
+        )
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute('''
+                INSERT INTO ai_usage (ts, user_id, model, kind, status, prompt_tokens,
+                                      cached_tokens, thought_tokens, output_tokens, latency)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (now, user_id, model, kind, status) + tokens + (float(latency),))
+            conn.execute('''
+                INSERT INTO ai_usage_hourly (hour, user_id, model, kind, calls, prompt_tokens,
+                                             cached_tokens, thought_tokens, output_tokens, latency_sum)
+                VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?, ?)
+                ON CONFLICT(hour, user_id, model, kind) DO UPDATE SET
+                    calls = calls + 1,
+                    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                    cached_tokens = cached_tokens + excluded.cached_tokens,
+                    thought_tokens = thought_tokens + excluded.thought_tokens,
+                    output_tokens = output_tokens + excluded.output_tokens,
+                    latency_sum = latency_sum + excluded.latency_sum
+            ''', (hour, user_id, model, kind) + tokens + (float(latency),))
+            conn.execute("DELETE FROM ai_usage WHERE ts < ?", (now - self.retention_days * 86400,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def get_rollups(self, days=7, user_id=None):
+        """Hourly rollup rows of the last `days` days as dicts."""
+        start = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d %H:00")
+        query = '''
+            SELECT hour, user_id, model, kind, calls, prompt_tokens, cached_tokens,
+                   thought_tokens, output_tokens, latency_sum
+            FROM ai_usage_hourly WHERE hour >= ?
+        '''
+        params = [start]
+        if user_id:
+            query += " AND user_id = ?"
+            params.append(user_id)
+        conn = self._connect()
+        rows = conn.execute(query + " ORDER BY hour ASC", params).fetchall()
+        conn.close()
+        keys = ["hour", "user_id", "model", "kind", "calls", "prompt_tokens", "cached_tokens",
+                "thought_tokens", "output_tokens", "latency_sum"]
+        return [dict(zip(keys, row)) for row in rows]
+
+    def _refill(self, conn, user_id, capacity, refill_per_hour, now):
+        row = conn.execute(
+            "SELECT tokens, updated_at FROM token_buckets WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if row is None:
+            return float(capacity)
+        tokens, updated_at = row
+        return min(float(capacity), tokens + (now - updated_at) * max(refill_per_hour, 0) / 3600.0)
+
+    def _save_bucket(self, conn, user_id, tokens, now):
+        conn.execute('''
+            INSERT INTO token_buckets (user_id, tokens, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at
+        ''', (user_id, tokens, now))
+
+    def try_consume(self, user_id, amount, capacity, refill_per_hour):
+        """
+        Token bucket: refills at refill_per_hour up to capacity and takes
+        `amount` if available. Returns (allowed, tokens_left, retry_after_s).
+        Requests larger than the bucket are charged at most its capacity.
+        With refill_per_hour <= 0 the bucket never refills (retry_after is inf).
+        """
+        amount = min(float(amount), float(capacity))
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            tokens = self._refill(conn, user_id, capacity, refill_per_hour, now)
+            allowed = tokens >= amount
+            if allowed:
+                tokens -= amount
+            self._save_bucket(conn, user_id, tokens, now)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        if allowed:
+            retry_after = 0
+        elif refill_per_hour <= 0:
+            retry_after = float("inf")
+        else:
+            retry_after = (amount - tokens) / refill_per_hour * 3600.0
+        return allowed, tokens, retry_after
+
+    def settle(self, user_id, reserved, actual, capacity, refill_per_hour):
+        """Adjusts a reservation to the tokens actually used (may leave the bucket negative)."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            tokens = self._refill(conn, user_id, capacity, refill_per_hour, now)
+            tokens = min(float(capacity), tokens + float(reserved) - float(actual))
+            self._save_bucket(conn, user_id, tokens, now)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def get_bucket(self, user_id, capacity, refill_per_hour):
+        """Tokens currently available to the user (without consuming)."""
+        conn = self._connect()
+        tokens = self._refill(conn, user_id, capacity, refill_per_hour, time.time())
+        conn.close()
+        return tokens
+
+@lru_cache
+def get_usage_store():
+    """Process-wide UsageStore on data/inver.db."""
+    return UsageStore()
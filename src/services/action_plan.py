@@ -0,0 +1,125 @@
+import json
+
+# responseSchema (OpenAPI subset) for structured analyses
+ACTION_PLAN_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "market_summary": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "diagnostics": {
+            "type": "OBJECT",
+            "properties": {
+                "strengths": {"type": "ARRAY", "items": {"type": "STRING"}},
+                "risks": {"type": "ARRAY", "items": {"type": "STRING"}},
+            },
+            "required": ["strengths", "risks"],
+        },
+        "trades": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "ticker": {"type": "STRING"},
+                    "side": {"type": "STRING", "enum": ["BUY", "SELL"]},
+                    "quantity": {"type": "NUMBER"},
+                    "limit_price": {"type": "NUMBER"},
+                    "amount": {"type": "NUMBER"},
+                    "rationale": {"type": "STRING"},
+                },
+                "required": ["ticker", "side", "quantity", "limit_price", "amount", "rationale"],
+            },
+        },
+        "outlook": {"type": "STRING"},
+    },
+    "required": ["market_summary", "diagnostics", "trades", "outlook"],
+}
+
+STRUCTURED_OUTPUT_INSTRUCTIONS = """
+**FORMATO DE RESPUESTA:** Respondé únicamente con un objeto JSON que siga el esquema indicado (sin markdown).
+- `market_summary`: 3 bullets sobre el clima del mercado hoy.
+- `diagnostics`: qué está bien (`strengths`) y qué es peligroso (`risks`) en mi tenencia actual.
+- `trades`: el plan de acción; `side` es BUY o SELL, `limit_price` y `amount` en ARS. Usá todo el monto disponible más lo generado por ventas.
+- `outlook`: qué esperar de estos movimientos en el corto/mediano plazo.
+"""
+
+SIDE_LABELS = {"BUY": "Compra", "SELL": "Venta"}
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+def parse_action_plan(text):
+    """
+    Parses a structured answer into a normalized plan dict (None if the text
+    is not a JSON object). Trades without a ticker or side, or that are not
+    objects, are dropped.
+    """
+    text = (text or "").strip()
+    if text.startswith("```"):
+        text = text.strip("`")
+        text = text[text.find("{"):] if "{" in text else text
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+
+    diagnostics = data.get("diagnostics")
+    if not isinstance(diagnostics, dict):
+        diagnostics = {}
+    trades = []
+    for trade in data.get("trades") or []:
+        if not isinstance(trade, dict):
+            continue
+        ticker = str(trade.get("ticker") or "").strip().upper()
+        side = str(trade.get("side") or "").strip().upper()
+        if not ticker or side not in SIDE_LABELS:
+            continue
+        trades.append({
+            "ticker": ticker,
+            "side": side,
+            "quantity": _number(trade.get("quantity")),
+            "limit_price": _number(trade.get("limit_price")),
+            "amount": _number(trade.get("amount")),
+            "rationale": str(trade.get("rationale") or "").strip(),
+        })
+    return {
+        "market_summary": [str(item) for item in data.get("market_summary") or []],
+        "diagnostics": {
+            "strengths": [str(item) for item in diagnostics.get("strengths") or []],
+            "risks": [str(item) for item in diagnostics.get("risks") or []],
+        },
+        "trades": trades,
+        "outlook": str(data.get("outlook") or ""),
+    }
+
+def render_action_plan(plan):
+    """Markdown rendering of a plan, in the same sections as the free-form answer."""
+    lines = ["### Resumen de Mercado"]
+    lines += [f"- {item}" for item in plan["market_summary"]] or ["- Sin datos."]
+
+    lines += ["", "### Diagnóstico de Portafolio", "**Fortalezas**"]
+    lines += [f"- {item}" for item in plan["diagnostics"]["strengths"]] or ["- Sin observaciones."]
+    lines += ["", "**Riesgos**"]
+    lines += [f"- {item}" for item in plan["diagnostics"]["risks"]] or ["- Sin observaciones."]
+
+    lines += ["", "### Plan de Acción"]
+    if plan["trades"]:
+        lines += [
+            "| Ticker | Acción | Cantidad | Precio Límite (ARS) | Monto Total (ARS) | Fundamento |",
+            "|--------|--------|----------|---------------------|-------------------|------------|",
+        ]
+        for trade in plan["trades"]:
+            rationale = trade["rationale"].replace("|", "/").replace("\n", " ")
+            lines.append(
+                f"| {trade['ticker']} | {SIDE_LABELS[trade['side']]} | {trade['quantity']:,.0f} | "
+                f"${trade['limit_price']:,.2f} | ${trade['amount']:,.2f} | {rationale} |"
+            )
+    else:
+        lines.append("Sin operaciones sugeridas.")
+
+    if plan["outlook"]:
+        lines += ["", "### Proyección", plan["outlook"]]
+    return "\n".join(lines)
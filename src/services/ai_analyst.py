@@ -1,14 +1,123 @@
 import requests
 import json
+import time
+import hashlib
+import threading
+import re
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+from ..data.cache_store import get_cache_store
+from ..data.model_stats import get_model_stats
+from ..data.usage_store import get_usage_store
+from .action_plan import (
+    ACTION_PLAN_SCHEMA, STRUCTURED_OUTPUT_INSTRUCTIONS, parse_action_plan, render_action_plan
+)
+
+# Model catalog cache shared by all AIAnalyst instances in this process
+# (backed by the disk cache so other sessions and processes reuse it)
+CATALOG_TTL = 6 * 3600
+CATALOG_RETENTION = 7 * 86400
+_CATALOG_MEMORY = {}
+_CATALOG_REFRESHING = set()
+_CATALOG_LOCK = threading.Lock()
+
+# Response cache: identical normalized inputs within the TTL reuse the answer
+RESPONSE_CACHE_NAMESPACE = "ai_response"
+RESPONSE_CACHE_TTL = 6 * 3600
+
+# Explicit context caching of the static instruction prefix (cachedContents API)
+CONTEXT_CACHE_TTL = 3600
+CONTEXT_CACHE_MARGIN = 120      # stop reusing a handle this long before it expires
+CONTEXT_CACHE_RETRY = 6 * 3600  # wait before retrying after the API refused to cache
+
+# Input token budget per request (instructions + portfolio + context + news)
+INPUT_TOKEN_BUDGET = 12000
+MAX_NEWS_TRIMMED = 5
+COMPACT_MIN_WEIGHT = 1.0        # % below which holdings are grouped as "Otros" when compacting
+
+# Model routing: latency/health stats over a recent window drive model choice
+ROUTING_WINDOW = 24 * 3600
+HEALTH_WINDOW = 3600            # failures older than this stop counting, so a model can recover
+ROUTING_MIN_CALLS = 5           # below this a model has no reliable stats yet
+MAX_FAILURE_RATE = 0.3          # timeouts + server errors above this mark a model unhealthy
+MAX_MODEL_ATTEMPTS = 3
+MIN_TIMEOUT = 10
+MAX_TIMEOUT = 180
+TIMEOUT_HEADROOM = 1.5          # adaptive timeout = p95 (timeouts included) x headroom
+RETRYABLE_STATUSES = ("timeout", "server_error")
+
+# Quota reservation: prompt chars per token and expected answer size
+CHARS_PER_TOKEN = 4
+# Inputs estimated (at CHARS_PER_TOKEN) under this share of the budget skip countTokens
+LOCAL_ESTIMATE_MARGIN = 0.8
+EXPECTED_OUTPUT_TOKENS = 2500
+EXPECTED_REASONING_TOKENS = 6000
+
+def model_capability(model_name):
+    """'reasoning' for thinking/pro/Gemini 3 models, 'flash' otherwise."""
+    name = model_name.replace("models/", "")
+    if "thinking" in name or "gemini-3" in name or "pro" in name:
+        return "reasoning"
+    return "flash"
+
+def _round_sig(value, digits=3):
+    """Rounds to `digits` significant figures (a ~0.5% tolerance for 3)."""
+    if not value:
+        return 0.0
+    return float(f"{float(value):.{digits}g}")
+
+def clean_ai_response(text):
+    """Cleans AI response for better display in Streamlit."""
+    text = re.sub(r'\$(\d[\d,\.]*[kKmM]?)\$', r'$\1', text) 
+    text = re.sub(r'\$([A-Z]{2,})\$', r'\1', text) 
+    text = re.sub(r'\n{3,}', '\n\n', text)
+    return text.strip()
+
+def create_session(retry_responses=True):
+    """
+    Gemini HTTP session with retries. With retry_responses=False only connection
+    errors are retried: timeouts and 5xx return at once so the router
+    can fall back to another model instead of waiting on the same one.
+    """
+    session = requests.Session()
+    if retry_responses:
+        options = dict(total=3, connect=3, read=3, status=3, backoff_factor=0.5,
+                       status_forcelist=(429, 500, 502, 503, 504))
+    else:
+        options = dict(total=1, connect=1, read=False, status=0, backoff_factor=0.5)
+    try:
+        retry = Retry(allowed_methods=frozenset(["GET", "POST"]), **options)
+    except TypeError:
+        retry = Retry(method_whitelist=["GET", "POST"], **options)
+
+    adapter = HTTPAdapter(max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
 class AIAnalyst:
-    def __init__(self, api_key, timeout=20):
+    def __init__(self, api_key, timeout=20, catalog_ttl=CATALOG_TTL,
+                 input_token_budget=INPUT_TOKEN_BUDGET, use_context_cache=True, base_url=None,
+                 user_id=None, quota=None):
         self.api_key = api_key
-        self.base_url = "https://generativelanguage.googleapis.com/v1beta"
+        # Usage is attributed to user_id; quota=(capacity, refill_per_hour) enables the token bucket
+        self.user_id = user_id
+        self.quota = quota
+        self.base_url = base_url or "https://generativelanguage.googleapis.com/v1beta"
         self.timeout = timeout
-        self.session = self._create_session()
+        self.catalog_ttl = catalog_ttl
+        self.response_cache_ttl = RESPONSE_CACHE_TTL
+        self.context_cache_ttl = CONTEXT_CACHE_TTL
+        self.input_token_budget = input_token_budget
+        self.use_context_cache = use_context_cache
+        # Details about the last analysis call (e.g. whether it was served from cache)
+        self.last_call = {}
+        self.session = create_session()
+        # Generation calls fail fast so the router can fall back to another model
+        self.call_session = create_session(retry_responses=False)
+        # Shared per process: the analyst is rebuilt on every Streamlit rerun
+        self.stats = get_model_stats()
+        self.usage = get_usage_store()
         # Prioritize Gemini 3 Pro as default
         self.preferred_models = [
             "gemini-3-pro-preview",
@@ -57,39 +166,106 @@ Las sugerencias deben ser ejecutables en IOL:
     
     5.  **Proyección:** Qué esperar de estos movimientos en el corto/mediano plazo."""
 
+    def _catalog_key(self):
+        # Never store the raw key: entries are keyed by a hash of it
+        digest = hashlib.sha256((self.api_key or "").encode()).hexdigest()[:16]
+        return f"gemini_models:{digest}"
+
+    def _fetch_model_catalog(self):
+        """Downloads the model list from the API. Returns None on failure."""
+        try:
+            url = f"{self.base_url}/models?key={self.api_key}"
+            response = self.session.get(url, timeout=self.timeout)
+            if response.status_code != 200:
+                return None
+            return [
+                {
+                    "name": m.get('name', ''),
+                    "supportedGenerationMethods": m.get('supportedGenerationMethods', []),
+                }
+                for m in response.json().get('models', [])
+            ]
+        except Exception as e:
+            print(f"Error listing models: {e}")
+            return None
+
+    def refresh_model_catalog(self):
+        """Fetches the catalog and stores it in memory and in the shared disk cache."""
+        models = self._fetch_model_catalog()
+        if models is None:
+            return None
+        entry = {"fetched_at": time.time(), "models": models}
+        key = self._catalog_key()
+        _CATALOG_MEMORY[key] = entry
+        try:
+            get_cache_store().set(key, entry, CATALOG_RETENTION)
+        except Exception as e:
+            print(f"Could not persist model catalog: {e}")
+        return models
+
+    def _refresh_catalog_async(self, key):
+        with _CATALOG_LOCK:
+            if key in _CATALOG_REFRESHING:
+                return
+            _CATALOG_REFRESHING.add(key)
+
+        def worker():
+            try:
+                self.refresh_model_catalog()
+            finally:
+                with _CATALOG_LOCK:
+                    _CATALOG_REFRESHING.discard(key)
+
+        threading.Thread(target=worker, daemon=True).start()
+
+    def get_model_catalog(self):
+        """
+        Returns the cached model catalog (stale-while-revalidate): a stale entry
+        is served immediately and refreshed in the background. Only a completely
+        cold cache (never fetched for this key) waits on the network.
+        """
+        key = self._catalog_key()
+        entry = _CATALOG_MEMORY.get(key)
+        if entry is None:
+            try:
+                entry = get_cache_store().get(key)
+            except Exception:
+                entry = None
+            if entry is not None:
+                _CATALOG_MEMORY[key] = entry
+        if entry is None:
+            return self.refresh_model_catalog() or []
+        if time.time() - entry["fetched_at"] > self.catalog_ttl:
+            self._refresh_catalog_async(key)
+        return entry["models"]
+
     def get_first_available_model(self):
         """
-        Queries the API to find a model that supports generateContent.
+        Finds a model that supports generateContent using the cached catalog.
         Prioritizes models in self.preferred_models.
         """
-        try:
-            url = f"{self.base_url}/models?key={self.api_key}"
-            response = self.session.get(url, timeout=self.timeout)
-            if response.status_code == 200:
-                data = response.json()
-                available_models = [
-                    m.get('name', '').replace('models/', '') 
-                    for m in data.get('models', []) 
-                    if 'generateContent' in m.get('supportedGenerationMethods', [])
-                ]
-                
-                for pref in self.preferred_models:
-                    if pref in available_models:
-                        return f"models/{pref}"
-                
-                for model in data.get('models', []):
-                    name = model.get('name', '')
-                    methods = model.get('supportedGenerationMethods', [])
-                    if 'generateContent' in methods and 'gemini' in name:
-                        if 'flash' in name: return name
-                        if 'pro' in name: return name
-                
-                if available_models:
-                    return f"models/{available_models[0]}"
-                    
-            return "models/gemini-pro"
-        except:
-            return "models/gemini-pro"
+        models = self.get_model_catalog()
+        available_models = [
+            m.get('name', '').replace('models/', '')
+            for m in models
+            if 'generateContent' in m.get('supportedGenerationMethods', [])
+        ]
+
+        for pref in self.preferred_models:
+            if pref in available_models:
+                return f"models/{pref}"
+
+        for model in models:
+            name = model.get('name', '')
+            methods = model.get('supportedGenerationMethods', [])
+            if 'generateContent' in methods and 'gemini' in name:
+                if 'flash' in name: return name
+                if 'pro' in name: return name
+
+        if available_models:
+            return f"models/{available_models[0]}"
+
+        return "models/gemini-pro"
             
     def validate_key(self):
         """Simple check to verify if the API key is valid."""
@@ -102,46 +278,207 @@ Las sugerencias deben ser ejecutables en IOL:
             return False
 
     def list_models(self):
-        """Returns a list of available models that support content generation."""
+        """Returns a list of available models that support content generation (cached)."""
+        return [
+            m.get('name', '').replace('models/', '')
+            for m in self.get_model_catalog()
+            if 'generateContent' in m.get('supportedGenerationMethods', [])
+        ]
+
+    def get_model_health(self, window=ROUTING_WINDOW):
+        """Recent per-model stats (see ModelStats.get_stats)."""
         try:
-            url = f"{self.base_url}/models?key={self.api_key}"
-            response = self.session.get(url, timeout=self.timeout)
-            if response.status_code == 200:
-                data = response.json()
-                models = [
-                    m.get('name', '').replace('models/', '') 
-                    for m in data.get('models', []) 
-                    if 'generateContent' in m.get('supportedGenerationMethods', [])
-                ]
-                return models
-            return []
-        except:
-            return []
+            return self.stats.get_stats(window)
+        except Exception as e:
+            print(f"Model stats unavailable: {e}")
+            return {}
 
-    def analyze_portfolio(self, portfolio_data, investment_amount, context_data, 
-                          news_headlines=[], model_name=None, reasoning_enabled=True, 
-                          prompt_template=None, use_grounding=True):
+    @staticmethod
+    def _is_healthy(stats):
+        if not stats or stats["calls"] < ROUTING_MIN_CALLS:
+            return True
+        return stats["timeout_rate"] + stats["error_rate"] <= MAX_FAILURE_RATE
+
+    def route_models(self, capability=None, limit=MAX_MODEL_ATTEMPTS):
         """
-        Generates an investment recommendation using Gemini REST API.
-        - use_grounding: If True, enables Google Search grounding for real-time data.
+        Available models ordered for routing: healthy models with measured
+        latency (fastest p50 first), then unmeasured ones in preference
+        order, then unhealthy ones. Health only looks at the last
+        HEALTH_WINDOW, so a model that failed gets traffic again once its
+        failures age out. capability ('reasoning' / 'flash') restricts the
+        list when any model matches it.
+        """
+        available = self.list_models()
+        preference = {name: i for i, name in enumerate(self.preferred_models)}
+        candidates = [f"models/{m}" for m in available if m in preference] or \
+                     [f"models/{m}" for m in available if "gemini" in m]
+        if capability:
+            matching = [m for m in candidates if model_capability(m) == capability]
+            candidates = matching or candidates
+        if not candidates:
+            return [self.get_first_available_model()]
+
+        health = self.get_model_health()
+        recent = self.get_model_health(HEALTH_WINDOW)
+
+        def rank(model):
+            stats = health.get(model)
+            measured = bool(stats and stats["calls"] >= ROUTING_MIN_CALLS and stats["p50"] is not None)
+            if not self._is_healthy(recent.get(model)):
+                group = 2
+            else:
+                group = 0 if measured else 1
+            latency = stats["p50"] if measured else 0
+            return (group, latency, preference.get(model.replace("models/", ""), len(preference)))
+
+        return sorted(candidates, key=rank)[:limit]
+
+    def timeout_for(self, model_name):
+        """
+        Adaptive read timeout: the model's p95 latency (timed-out calls
+        counted at their timeout) times TIMEOUT_HEADROOM, clamped to
+        [MIN_TIMEOUT, MAX_TIMEOUT]. Falls back to self.timeout without stats.
+        """
+        stats = self.get_model_health().get(model_name)
+        if not stats or stats["calls"] < ROUTING_MIN_CALLS or stats["timeout_p95"] is None:
+            return self.timeout
+        return max(MIN_TIMEOUT, min(MAX_TIMEOUT, stats["timeout_p95"] * TIMEOUT_HEADROOM))
+
+    def _candidate_models(self, model_name, reasoning_enabled, allow_fallback=False):
         """
+        Models to try in order: the routed list when none is requested;
+        otherwise only the requested one, followed by routed fallbacks if
+        allow_fallback is set.
+        """
+        if model_name and not allow_fallback:
+            return [self._resolve_model(model_name)]
+        routed = self.route_models("reasoning" if reasoning_enabled else "flash")
         if not model_name:
-            model_name = self.get_first_available_model()
-        
-        # 1. Prepare Enriched Portfolio Data
-        portfolio_summary = ""
-        total_portfolio_value = sum(item.get('Total Value', 0) for item in portfolio_data) if portfolio_data else 0
-        
+            return routed
+        first = self._resolve_model(model_name)
+        return ([first] + [m for m in routed if m != first])[:MAX_MODEL_ATTEMPTS]
+
+    @staticmethod
+    def _exception_status(error):
+        # Read timeouts while streaming surface as ConnectionError
+        if isinstance(error, requests.exceptions.Timeout) or "timed out" in str(error).lower():
+            return "timeout"
+        if isinstance(error, requests.exceptions.RequestException):
+            return "server_error"
+        return "error"
+
+    @staticmethod
+    def _http_status(status_code):
+        return "server_error" if status_code == 429 or status_code >= 500 else "error"
+
+    def _record_call(self, model_name, started, status, usage=None, kind="generate"):
+        """
+        Logs a call outcome for routing and token accounting; usage is the
+        response usageMetadata.
+        """
+        latency = time.time() - started
+        usage = usage or {}
+        tokens = (usage.get('candidatesTokenCount') or 0) + (usage.get('thoughtsTokenCount') or 0)
+        self.last_call.setdefault("attempts", []).append(
+            {"model": model_name, "status": status, "latency": round(latency, 2)}
+        )
+        self.last_call["tokens_used"] = self.last_call.get("tokens_used", 0) + (
+            usage.get('totalTokenCount')
+            or (usage.get('promptTokenCount') or 0) + tokens
+        )
+        try:
+            self.stats.record(model_name, latency, status, tokens)
+        except Exception as e:
+            print(f"Could not record model stats: {e}")
+        try:
+            self.usage.record(self.user_id, model_name, usage, latency, status, kind)
+        except Exception as e:
+            print(f"Could not record usage: {e}")
+
+    def _estimate_tokens(self, portfolio_data, investment_amount, context_data, news_headlines,
+                         prompt_template, reasoning_enabled):
+        """Rough token cost of a request (prompt + expected answer), for quota reservations."""
+        prompt = self.build_prompt(portfolio_data, investment_amount, context_data, news_headlines, prompt_template)
+        expected = EXPECTED_REASONING_TOKENS if reasoning_enabled else EXPECTED_OUTPUT_TOKENS
+        return len(prompt) // CHARS_PER_TOKEN + expected
+
+    def _reserve_quota(self, estimate):
+        """
+        Takes the estimate from the user's token bucket before a request.
+        Returns None if allowed, or the message to show when over quota.
+        Fails open if the usage store is unavailable.
+        """
+        if not (self.quota and self.user_id):
+            return None
+        capacity, refill_per_hour = self.quota
+        try:
+            allowed, _, retry_after = self.usage.try_consume(self.user_id, estimate, capacity, refill_per_hour)
+        except Exception as e:
+            print(f"Quota check failed: {e}")
+            return None
+        if allowed:
+            self.last_call["reserved_tokens"] = min(estimate, capacity)
+            return None
+        self.last_call["quota_exceeded"] = True
+        if retry_after == float("inf"):
+            return "Alcanzaste tu cuota de uso de IA."
+        minutes = int(retry_after // 60) + 1
+        return f"Alcanzaste tu cuota de uso de IA. Volvé a intentar en ~{minutes} min."
+
+    def _settle_quota(self):
+        """Replaces the reservation with the tokens actually used."""
+        reserved = self.last_call.pop("reserved_tokens", None)
+        if reserved is None:
+            return
+        capacity, refill_per_hour = self.quota
+        try:
+            self.usage.settle(self.user_id, reserved, self.last_call.get("tokens_used", 0),
+                              capacity, refill_per_hour)
+        except Exception as e:
+            print(f"Could not settle quota: {e}")
+
+    def get_quota_remaining(self):
+        """Tokens left in the user's bucket (None when no quota applies)."""
+        if not (self.quota and self.user_id):
+            return None
+        return self.usage.get_bucket(self.user_id, *self.quota)
+
+    def _portfolio_table(self, portfolio_data, compact=False):
+        """
+        Markdown table of the holdings. The compact form drops descriptions and
+        prices and groups holdings under COMPACT_MIN_WEIGHT % into "Otros".
+        """
         if not portfolio_data:
-            portfolio_summary = "El portafolio está vacío actualmente."
+            return "El portafolio está vacío actualmente."
+        total_portfolio_value = sum(item.get('Total Value', 0) for item in portfolio_data)
+
+        def _weight(item):
+            return (item.get('Total Value', 0) / total_portfolio_value * 100) if total_portfolio_value > 0 else 0
+
+        if compact:
+            table = "| Símbolo | Valor | Var. Diaria | Peso % |\n"
+            table += "|---------|-------|-------------|--------|\n"
+            others = [item for item in portfolio_data if _weight(item) < COMPACT_MIN_WEIGHT]
+            for item in portfolio_data:
+                if _weight(item) >= COMPACT_MIN_WEIGHT:
+                    table += f"| {item.get('Symbol', 'N/A')} | ${item.get('Total Value', 0):,.0f} | {item.get('Daily Var %', 0):.1f}% | {_weight(item):.1f}% |\n"
+            if others:
+                others_value = sum(item.get('Total Value', 0) for item in others)
+                others_weight = sum(_weight(item) for item in others)
+                table += f"| Otros ({len(others)}) | ${others_value:,.0f} | - | {others_weight:.1f}% |\n"
         else:
-            portfolio_summary = "| Símbolo | Descripción | Cantidad | Precio | Valor | Var. Diaria | Peso % |\n"
-            portfolio_summary += "|---------|-------------|----------|--------|-------|-------------|--------|\n"
+            table = "| Símbolo | Descripción | Cantidad | Precio | Valor | Var. Diaria | Peso % |\n"
+            table += "|---------|-------------|----------|--------|-------|-------------|--------|\n"
             for item in portfolio_data:
-                weight = (item.get('Total Value', 0) / total_portfolio_value * 100) if total_portfolio_value > 0 else 0
-                portfolio_summary += f"| {item.get('Symbol', 'N/A')} | {item.get('Description', '')[:25]} | {item.get('Quantity', 0)} | ${item.get('Last Price', 0):,.2f} | ${item.get('Total Value', 0):,.2f} | {item.get('Daily Var %', 0):.2f}% | {weight:.1f}% |\n"
-            
-            portfolio_summary += f"\n**Valor Total del Portafolio:** ${total_portfolio_value:,.2f} ARS"
+                table += f"| {item.get('Symbol', 'N/A')} | {item.get('Description', '')[:25]} | {item.get('Quantity', 0)} | ${item.get('Last Price', 0):,.2f} | ${item.get('Total Value', 0):,.2f} | {item.get('Daily Var %', 0):.2f}% | {_weight(item):.1f}% |\n"
+
+        table += f"\n**Valor Total del Portafolio:** ${total_portfolio_value:,.2f} ARS"
+        return table
+
+    def build_user_input(self, portfolio_data, investment_amount, context_data,
+                         news_headlines=None, compact=False):
+        """Per-request part of the prompt: portfolio, market context and news."""
+        portfolio_summary = self._portfolio_table(portfolio_data, compact)
 
         # Market context
         def _format_price(value):
@@ -161,12 +498,7 @@ Las sugerencias deben ser ejecutables en IOL:
             
         news_str = "\n".join(news_headlines) if news_headlines else "No se encontraron noticias recientes relevantes."
 
-        # 2. Construct Prompt
-        base_prompt = prompt_template if prompt_template else self.default_prompt
-        
-        prompt_text = f"""{base_prompt}
-
----
+        return f"""---
 **INPUT DEL USUARIO:**
 * **Perfil de Riesgo:** Moderado/Agresivo
 * **Monto a invertir:** ${investment_amount:,.2f} ARS
@@ -185,87 +517,571 @@ Las sugerencias deben ser ejecutables en IOL:
 Por favor, realiza tu análisis y proporciona recomendaciones concretas y ejecutables en IOL.
 """
 
-        # 3. Call API
-        try:
-            if not model_name.startswith("models/"):
-                model_name = f"models/{model_name}"
-                
-            url = f"{self.base_url}/{model_name}:generateContent?key={self.api_key}"
-            
-            headers = {'Content-Type': 'application/json'}
-            data = {
-                "contents": [{"parts": [{"text": prompt_text}]}]
-            }
-            
-            # Enable Google Search Grounding + Code Execution
-            if use_grounding:
-                data["tools"] = [
-                    {"google_search": {}},
-                    {"code_execution": {}}
-                ]
-            
-            # Thinking Config for supported models
-            if reasoning_enabled and ("thinking" in model_name or "gemini-3" in model_name):
-                data["generationConfig"] = {
-                    "thinkingConfig": {
-                        "includeThoughts": True 
-                    }
+    def build_prompt(self, portfolio_data, investment_amount, context_data,
+                     news_headlines=None, prompt_template=None):
+        """Builds the full prompt text from the portfolio, context and news."""
+        base_prompt = prompt_template if prompt_template else self.default_prompt
+        user_input = self.build_user_input(portfolio_data, investment_amount, context_data, news_headlines)
+        return f"{base_prompt}\n\n{user_input}"
+
+    @staticmethod
+    def _tools(use_grounding):
+        # Google Search Grounding + Code Execution
+        if not use_grounding:
+            return []
+        return [
+            {"google_search": {}},
+            {"code_execution": {}}
+        ]
+
+    def _build_request(self, user_text, model_name, reasoning_enabled=True, use_grounding=True,
+                       system_text=None, cached_content=None, response_schema=None):
+        """
+        Returns the generateContent request body. With cached_content the
+        instructions and tools come from the cache and must not be re-sent.
+        response_schema requests JSON output following that schema.
+        """
+        data = {
+            "contents": [{"role": "user", "parts": [{"text": user_text}]}]
+        }
+        if cached_content:
+            data["cachedContent"] = cached_content
+        else:
+            if system_text:
+                data["systemInstruction"] = {"parts": [{"text": system_text}]}
+            tools = self._tools(use_grounding)
+            if tools:
+                data["tools"] = tools
+        
+        # Thinking Config for supported models
+        if reasoning_enabled and ("thinking" in model_name or "gemini-3" in model_name):
+            data["generationConfig"] = {
+                "thinkingConfig": {
+                    "includeThoughts": True 
                 }
-            
-            response = self.session.post(url, headers=headers, json=data, timeout=self.timeout)
-            
-            if response.status_code == 200:
-                result = response.json()
-                try:
-                    # Handle parts and filter out thinking blocks
-                    parts = result['candidates'][0]['content']['parts']
-                    
-                    cleaned_parts = []
-                    for part in parts:
-                        # Gemini 3/2.5 Thinking models return thoughts in a part with "thought": true
-                        # We skip these to return only the final answer.
-                        if part.get('thought', False):
-                            continue
-                        
-                        if 'text' in part:
-                            cleaned_parts.append(part['text'])
-                            
-                    text = "\n".join(cleaned_parts)
-                    return text, model_name
-                except (KeyError, IndexError):
-                    if 'promptFeedback' in result:
-                        return f"Model blocked response: {result['promptFeedback']}", model_name
-                    return f"Error parsing result: {result}", model_name
-            else:
-                return f"Error from API ({model_name}): {response.status_code} - {response.text}", model_name
-                
+            }
+        if response_schema:
+            data.setdefault("generationConfig", {}).update(
+                responseMimeType="application/json", responseSchema=response_schema
+            )
+        return data
+
+    def _context_cache_key(self, model_name, system_text, use_grounding):
+        payload = json.dumps({
+            "api_key": self._catalog_key(),
+            "model": model_name,
+            "system": hashlib.sha256(system_text.encode()).hexdigest(),
+            "tools": self._tools(use_grounding),
+        }, sort_keys=True)
+        return f"gemini_context:{hashlib.sha256(payload.encode()).hexdigest()}"
+
+    def _get_context_cache(self, model_name, system_text, use_grounding):
+        """
+        Returns the name of a cachedContents entry holding the instructions and
+        tools, creating it on first use. The handle is kept in the shared disk
+        cache until shortly before it expires. Returns None when the API
+        refuses to cache the prefix (e.g. below the model's minimum size);
+        that answer is remembered for CONTEXT_CACHE_RETRY seconds.
+        """
+        key = self._context_cache_key(model_name, system_text, use_grounding)
+        try:
+            entry = get_cache_store().get(key)
+        except Exception:
+            entry = None
+        if entry is not None:
+            return entry.get("name"), key
+
+        body = {
+            "model": model_name,
+            "systemInstruction": {"parts": [{"text": system_text}]},
+            "ttl": f"{self.context_cache_ttl}s",
+        }
+        tools = self._tools(use_grounding)
+        if tools:
+            body["tools"] = tools
+        try:
+            url = f"{self.base_url}/cachedContents?key={self.api_key}"
+            response = self.session.post(url, json=body, timeout=self.timeout)
+        except Exception as e:
+            print(f"Could not create context cache: {e}")
+            return None, key
+
+        if response.status_code == 200:
+            name = response.json().get("name")
+            ttl = max(self.context_cache_ttl - CONTEXT_CACHE_MARGIN, 60)
+        else:
+            name, ttl = None, CONTEXT_CACHE_RETRY
+        try:
+            get_cache_store().set(key, {"name": name}, ttl)
+        except Exception as e:
+            print(f"Could not store context cache handle: {e}")
+        return name, key
+
+    def _count_tokens(self, model_name, text):
+        """Input tokens of text for model_name via countTokens. None on failure."""
+        try:
+            url = f"{self.base_url}/{model_name}:countTokens?key={self.api_key}"
+            body = {"contents": [{"role": "user", "parts": [{"text": text}]}]}
+            response = self.session.post(url, json=body, timeout=self.timeout)
+            if response.status_code != 200:
+                return None
+            return response.json().get("totalTokens")
         except Exception as e:
-            return f"Error generating analysis: {e}", "Unknown Model"
+            print(f"Error counting tokens: {e}")
+            return None
 
-    def _create_session(self):
-        session = requests.Session()
+    def _prefix_tokens(self, model_name, system_text):
+        """Token count of the instruction prefix, cached since it rarely changes."""
+        digest = hashlib.sha256(f"{model_name}\n{system_text}".encode()).hexdigest()
+        key = f"gemini_tokens:{digest}"
         try:
-            retry = Retry(
-                total=3,
-                connect=3,
-                read=3,
-                status=3,
-                backoff_factor=0.5,
-                status_forcelist=(429, 500, 502, 503, 504),
-                allowed_methods=frozenset(["GET", "POST"])
+            return get_cache_store().get_or_set(
+                key, CATALOG_RETENTION, lambda: self._count_tokens(model_name, system_text)
             )
-        except TypeError:
-            retry = Retry(
-                total=3,
-                connect=3,
-                read=3,
-                status=3,
-                backoff_factor=0.5,
-                status_forcelist=(429, 500, 502, 503, 504),
-                method_whitelist=["GET", "POST"]
+        except Exception:
+            return self._count_tokens(model_name, system_text)
+
+    def fit_user_input(self, model_name, system_text, portfolio_data, investment_amount,
+                       context_data, news_headlines=None, count_tokens=True):
+        """
+        Builds the per-request input so instructions + input stay within
+        self.input_token_budget. Progressively trims news and compacts the
+        portfolio table. Sizes are first estimated locally (CHARS_PER_TOKEN);
+        countTokens is only called when the estimate comes within
+        LOCAL_ESTIMATE_MARGIN of the budget, and later candidates are
+        estimated from the first count, so usually at most two calls are
+        made. With count_tokens=False only the local estimate is used. If
+        tokens cannot be counted the full input is used.
+        """
+        news = list(news_headlines or [])
+        variants = [
+            (False, news),
+            (False, news[:MAX_NEWS_TRIMMED]),
+            (True, news[:MAX_NEWS_TRIMMED]),
+            (True, []),
+        ]
+        candidates = []
+        for compact, headlines in variants:
+            text = self.build_user_input(portfolio_data, investment_amount, context_data, headlines, compact)
+            if text not in candidates:
+                candidates.append(text)
+
+        budget = self.input_token_budget
+        prefix_estimate = len(system_text) // CHARS_PER_TOKEN
+        estimates = [prefix_estimate + len(text) // CHARS_PER_TOKEN for text in candidates]
+        self.last_call["trim_level"] = 0
+        if estimates[0] <= budget * LOCAL_ESTIMATE_MARGIN:
+            return candidates[0]
+        if not count_tokens:
+            for level, (text, estimate) in enumerate(zip(candidates, estimates)):
+                if estimate <= budget or level == len(candidates) - 1:
+                    self.last_call["trim_level"] = level
+                    return text
+
+        prefix_tokens = self._prefix_tokens(model_name, system_text)
+        tokens = self._count_tokens(model_name, candidates[0]) if prefix_tokens is not None else None
+        if tokens is None:
+            return candidates[0]
+        self.last_call["input_tokens"] = prefix_tokens + tokens
+        if prefix_tokens + tokens <= self.input_token_budget:
+            return candidates[0]
+
+        tokens_per_char = tokens / max(len(candidates[0]), 1)
+        for level, text in enumerate(candidates[1:], start=1):
+            is_last = level == len(candidates) - 1
+            if not is_last and prefix_tokens + len(text) * tokens_per_char > budget:
+                continue  # estimated over budget: skip the count
+            counted = self._count_tokens(model_name, text)
+            if counted is not None:
+                self.last_call["input_tokens"] = prefix_tokens + counted
+            if counted is None or prefix_tokens + counted <= budget:
+                self.last_call["trim_level"] = level
+                return text
+            if is_last:
+                print(f"Prompt exceeds the input budget of {budget} tokens even after trimming.")
+                self.last_call["trim_level"] = level
+                return text
+        return candidates[-1]
+
+    def _prepare_request(self, portfolio_data, investment_amount, context_data, news_headlines,
+                         model_name, reasoning_enabled, prompt_template, use_grounding,
+                         structured_output=False):
+        """
+        Returns (body, fallback_body, context_key). body references the cached
+        instruction prefix when available; fallback_body (or None) sends it
+        inline, for when the cache entry has expired server-side.
+        Structured requests are always inline: JSON output only combines with
+        Google Search on Gemini 3 and never with code execution, so their
+        tools differ from the cached ones.
+        """
+        system_text = prompt_template if prompt_template else self.default_prompt
+        user_text = self.fit_user_input(
+            model_name, system_text, portfolio_data, investment_amount, context_data, news_headlines
+        )
+        if structured_output:
+            data = self._build_request(
+                user_text + STRUCTURED_OUTPUT_INSTRUCTIONS, model_name, reasoning_enabled,
+                use_grounding=False, system_text=system_text, response_schema=ACTION_PLAN_SCHEMA
             )
+            if use_grounding and "gemini-3" in model_name:
+                data["tools"] = [{"google_search": {}}]
+            self.last_call["context_cache"] = None
+            return data, None, None
+        inline = self._build_request(user_text, model_name, reasoning_enabled, use_grounding, system_text)
+        cached_content, context_key = (None, None)
+        if self.use_context_cache:
+            cached_content, context_key = self._get_context_cache(model_name, system_text, use_grounding)
+        self.last_call["context_cache"] = cached_content
+        if not cached_content:
+            return inline, None, None
+        body = self._build_request(
+            user_text, model_name, reasoning_enabled, use_grounding, cached_content=cached_content
+        )
+        return body, inline, context_key
+
+    def build_request_body(self, portfolio_data, investment_amount, context_data, news_headlines=None,
+                           model_name=None, reasoning_enabled=True, prompt_template=None, use_grounding=True):
+        """
+        Self-contained generateContent body (instructions inline), e.g. for
+        batch requests. Sized with the local token estimate only, so building
+        a batch makes no countTokens calls.
+        """
+        model_name = self._resolve_model(model_name)
+        system_text = prompt_template if prompt_template else self.default_prompt
+        user_text = self.fit_user_input(
+            model_name, system_text, portfolio_data, investment_amount, context_data, news_headlines,
+            count_tokens=False
+        )
+        return self._build_request(user_text, model_name, reasoning_enabled, use_grounding, system_text)
+
+    @classmethod
+    def response_text(cls, result):
+        """Answer text of a GenerateContentResponse dict (None if it has no candidates)."""
+        candidates = result.get('candidates') or []
+        if not candidates:
+            return None
+        return "\n".join(cls._answer_parts(candidates[0]))
+
+    def _forget_context_cache(self, context_key):
+        try:
+            get_cache_store().delete(context_key)
+        except Exception:
+            pass
+        self.last_call["context_cache"] = None
+
+    def _resolve_model(self, model_name):
+        if not model_name:
+            model_name = self.route_models()[0]
+        if not model_name.startswith("models/"):
+            model_name = f"models/{model_name}"
+        return model_name
+
+    @staticmethod
+    def _answer_parts(candidate):
+        """Text of the non-thought parts of a candidate."""
+        # Gemini 3/2.5 Thinking models return thoughts in a part with "thought": true
+        # We skip these to return only the final answer.
+        return [
+            part['text']
+            for part in candidate.get('content', {}).get('parts', [])
+            if not part.get('thought', False) and 'text' in part
+        ]
+
+    def response_cache_key(self, portfolio_data, investment_amount, model_name,
+                           reasoning_enabled=True, prompt_template=None, use_grounding=True,
+                           structured_output=False):
+        """
+        Content-addressed key for an analysis request. Holdings are normalized
+        (sorted, values rounded to ~0.5%, weights to 1pp) so tiny price moves
+        still hit, and the date bucket expires grounded answers daily.
+        model_name is the user's selection ("auto" when None), not the routed
+        model, whose order shifts with latency and error stats.
+        """
+        total = sum(item.get('Total Value', 0) or 0 for item in portfolio_data or [])
+        holdings = sorted(
+            (
+                str(item.get('Symbol', '')),
+                _round_sig(item.get('Quantity', 0)),
+                round((item.get('Total Value', 0) or 0) / total * 100) if total else 0,
+            )
+            for item in portfolio_data or []
+        )
+        template = prompt_template if prompt_template else self.default_prompt
+        payload = {
+            "holdings": holdings,
+            "total": _round_sig(total),
+            "amount": round(float(investment_amount or 0), 2),
+            "template": hashlib.sha256(template.encode()).hexdigest(),
+            "model": model_name.replace("models/", "") if model_name else "auto",
+            "reasoning": bool(reasoning_enabled),
+            "grounding": bool(use_grounding),
+            "date": time.strftime("%Y-%m-%d"),
+        }
+        if structured_output:
+            payload["structured"] = True
+        digest = hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+        return f"{RESPONSE_CACHE_NAMESPACE}:{digest}"
+
+    def _cached_response(self, key):
+        cache = get_cache_store()
+        try:
+            text = cache.get(key)
+            cache.record(RESPONSE_CACHE_NAMESPACE, text is not None)
+            return text
+        except Exception as e:
+            print(f"Response cache unavailable: {e}")
+            return None
+
+    def _store_response(self, key, text):
+        try:
+            get_cache_store().set(key, text, self.response_cache_ttl)
+        except Exception as e:
+            print(f"Could not cache response: {e}")
+
+    def get_cache_stats(self):
+        """Hit/miss counters of the response cache (all processes)."""
+        return get_cache_store().get_stats(RESPONSE_CACHE_NAMESPACE)
+
+    def analyze_portfolio(self, portfolio_data, investment_amount, context_data, 
+                          news_headlines=[], model_name=None, reasoning_enabled=True, 
+                          prompt_template=None, use_grounding=True,
+                          use_cache=True, force_refresh=False, structured_output=False,
+                          allow_fallback=False):
+        """
+        Generates an investment recommendation using Gemini REST API.
+        - model_name: None lets the router pick the fastest healthy model; on a
+          timeout or server error the next routed model is tried. An explicit
+          model only falls back to others with allow_fallback. The model that
+          answered is returned (and in self.last_call["model"]).
+        - use_grounding: If True, enables Google Search grounding for real-time data.
+        - use_cache / force_refresh: reuse (or bypass) a cached answer for the
+          same normalized inputs. self.last_call["cached"] tells which happened.
+        - structured_output: request JSON following ACTION_PLAN_SCHEMA. The
+          returned text is the plan rendered as markdown and the parsed plan
+          (market_summary, diagnostics, trades, outlook) is in
+          self.last_call["plan"] (None if the answer could not be parsed).
+        API failures are returned as text and also set self.last_call["error"].
+        The instructions go in a cached context when possible and the input is
+        fitted to self.input_token_budget (see fit_user_input).
+        """
+        self.last_call = {"cached": False}
+        requested = model_name
+        try:
+            candidates = self._candidate_models(model_name, reasoning_enabled, allow_fallback)
+        except Exception as e:
+            return self._failed(f"Error generating analysis: {e}"), "Unknown Model"
+        model_name = candidates[0]
+
+        key = None
+        if use_cache:
+            key = self.response_cache_key(
+                portfolio_data, investment_amount, requested,
+                reasoning_enabled, prompt_template, use_grounding, structured_output
+            )
+            if not force_refresh:
+                cached = self._cached_response(key)
+                if cached is not None:
+                    self.last_call.update(cached=True, model=model_name)
+                    if structured_output:
+                        return self._render_structured(cached), model_name
+                    return cached, model_name
+
+        quota_message = self._reserve_quota(self._estimate_tokens(
+            portfolio_data, investment_amount, context_data, news_headlines, prompt_template, reasoning_enabled
+        ))
+        if quota_message:
+            return quota_message, model_name
+
+        for attempt_model in candidates:
+            try:
+                data, fallback, context_key = self._prepare_request(
+                    portfolio_data, investment_amount, context_data, news_headlines,
+                    attempt_model, reasoning_enabled, prompt_template, use_grounding,
+                    structured_output
+                )
+            except Exception as e:
+                self._settle_quota()
+                return self._failed(f"Error generating analysis: {e}"), attempt_model
+            text, status = self._generate(attempt_model, data, fallback, context_key)
+            if status not in RETRYABLE_STATUSES:
+                break
+            print(f"{attempt_model} failed ({status}), trying next model...")
+        self._settle_quota()
+
+        self.last_call["model"] = attempt_model
+        if status != "ok":
+            return self._failed(text), attempt_model
+        raw_text = text
+        if structured_output:
+            text = self._render_structured(raw_text)
+        if key and (not structured_output or self.last_call["plan"] is not None):
+            self._store_response(key, raw_text)
+        return text, attempt_model
+
+    def _failed(self, message):
+        """Records an API failure in last_call["error"] and returns its message."""
+        self.last_call["error"] = message
+        return message
+
+    def _render_structured(self, text):
+        """Parses a JSON answer into last_call["plan"] and returns its markdown."""
+        plan = parse_action_plan(text)
+        self.last_call["plan"] = plan
+        return render_action_plan(plan) if plan is not None else text
+
+    def _generate(self, model_name, data, fallback=None, context_key=None):
+        """
+        Blocking generateContent call with the model's adaptive timeout.
+        Returns (text, status); status as in ModelStats.record. If the cached
+        context is rejected the request is retried with fallback.
+        """
+        url = f"{self.base_url}/{model_name}:generateContent?key={self.api_key}"
+        headers = {'Content-Type': 'application/json'}
+        timeout = self.timeout_for(model_name)
+        started = time.time()
+        try:
+            response = self.call_session.post(url, headers=headers, json=data, timeout=timeout)
+            if response.status_code in (400, 403, 404) and fallback is not None:
+                self._forget_context_cache(context_key)
+                response = self.call_session.post(url, headers=headers, json=fallback, timeout=timeout)
+        except Exception as e:
+            status = self._exception_status(e)
+            self._record_call(model_name, started, status)
+            return f"Error generating analysis: {e}", status
+
+        if response.status_code != 200:
+            status = self._http_status(response.status_code)
+            self._record_call(model_name, started, status)
+            return f"Error from API ({model_name}): {response.status_code} - {response.text}", status
+
+        result = response.json()
+        self._record_call(model_name, started, "ok", result.get('usageMetadata'))
+        text = self.response_text(result)
+        if text is None:
+            if 'promptFeedback' in result:
+                return f"Model blocked response: {result['promptFeedback']}", "error"
+            return f"Error parsing result: {result}", "error"
+        return text, "ok"
+
+    def stream_portfolio_analysis(self, portfolio_data, investment_amount, context_data,
+                                  news_headlines=None, model_name=None, reasoning_enabled=True,
+                                  prompt_template=None, use_grounding=True,
+                                  use_cache=True, force_refresh=False, allow_fallback=False):
+        """
+        Streaming variant of analyze_portfolio using streamGenerateContent (SSE).
+        Returns (chunks, model_name): chunks is a generator yielding answer text
+        as it arrives, with thought parts filtered out. The timeout applies
+        between chunks, so long answers no longer hit it. A cache hit yields
+        the stored answer as a single chunk; a complete stream is cached.
+        If a model fails before sending any text the next routed model is
+        used (for an explicit model only with allow_fallback);
+        self.last_call["model"] holds the one that answered.
+        """
+        self.last_call = {"cached": False}
+        requested = model_name
+        candidates = self._candidate_models(model_name, reasoning_enabled, allow_fallback)
+        model_name = candidates[0]
+        self.last_call["model"] = model_name
+
+        key = None
+        if use_cache:
+            key = self.response_cache_key(
+                portfolio_data, investment_amount, requested,
+                reasoning_enabled, prompt_template, use_grounding
+            )
+            if not force_refresh:
+                cached = self._cached_response(key)
+                if cached is not None:
+                    self.last_call["cached"] = True
+                    return iter([cached]), model_name
+
+        def prepare(attempt_model):
+            return self._prepare_request(
+                portfolio_data, investment_amount, context_data, news_headlines,
+                attempt_model, reasoning_enabled, prompt_template, use_grounding
+            )
+
+        quota_message = self._reserve_quota(self._estimate_tokens(
+            portfolio_data, investment_amount, context_data, news_headlines, prompt_template, reasoning_enabled
+        ))
+        if quota_message:
+            return iter([quota_message]), model_name
+
+        on_complete = (lambda text: self._store_response(key, text)) if key else None
+        return self._settled(self._stream(candidates, prepare, on_complete)), model_name
+
+    def _settled(self, chunks):
+        # Settles the quota reservation once the stream ends or is abandoned
+        try:
+            yield from chunks
+        finally:
+            self._settle_quota()
+
+    def _stream(self, candidates, prepare, on_complete=None):
+        """
+        Yields answer text from an SSE stream; calls on_complete(full_text) on
+        success. Falls back to the next candidate if a model times out or
+        fails with a server error before any text was sent.
+        """
+        headers = {'Content-Type': 'application/json'}
+        for index, model_name in enumerate(candidates):
+            can_fallback = index < len(candidates) - 1
+            self.last_call["model"] = model_name
+            url = f"{self.base_url}/{model_name}:streamGenerateContent?alt=sse&key={self.api_key}"
+            timeout = (10, self.timeout_for(model_name))
+            started = time.time()
+            try:
+                data, fallback, context_key = prepare(model_name)
+                response = self.call_session.post(url, headers=headers, json=data, stream=True, timeout=timeout)
+                if response.status_code in (400, 403, 404) and fallback is not None:
+                    response.close()
+                    self._forget_context_cache(context_key)
+                    response = self.call_session.post(url, headers=headers, json=fallback, stream=True, timeout=timeout)
+            except Exception as e:
+                status = self._exception_status(e)
+                self._record_call(model_name, started, status, kind="stream")
+                if status in RETRYABLE_STATUSES and can_fallback:
+                    continue
+                yield self._failed(f"Error generating analysis: {e}")
+                return
+
+            received = []
+            usage = None
+            with response:
+                if response.status_code != 200:
+                    status = self._http_status(response.status_code)
+                    self._record_call(model_name, started, status, kind="stream")
+                    if status in RETRYABLE_STATUSES and can_fallback:
+                        continue
+                    yield self._failed(f"Error from API ({model_name}): {response.status_code} - {response.text}")
+                    return
+                try:
+                    for line in response.iter_lines(decode_unicode=True):
+                        if not line or not line.startswith("data:"):
+                            continue
+                        try:
+                            event = json.loads(line[len("data:"):].strip())
+                        except ValueError:
+                            continue
+                        usage = event.get('usageMetadata', usage)
+                        if 'candidates' not in event:
+                            if 'promptFeedback' in event:
+                                self._record_call(model_name, started, "error", usage, kind="stream")
+                                yield self._failed(f"Model blocked response: {event['promptFeedback']}")
+                                return
+                            continue
+                        for text in self._answer_parts(event['candidates'][0]):
+                            received.append(text)
+                            yield text
+                except Exception as e:
+                    status = self._exception_status(e)
+                    self._record_call(model_name, started, status, usage, kind="stream")
+                    if not received and status in RETRYABLE_STATUSES and can_fallback:
+                        continue
+                    yield "\n\n" + self._failed(f"Error while streaming analysis: {e}")
+                    return
 
-        adapter = HTTPAdapter(max_retries=retry)
-        session.mount("https://", adapter)
-        session.mount("http://", adapter)
-        return session
+            self._record_call(model_name, started, "ok", usage, kind="stream")
+            if received and on_complete:
+                on_complete("".join(received))
+            return
@@ -0,0 +1,68 @@
+from ..data.usage_store import get_usage_store
+
+# ESTIMATED list prices in USD per 1M tokens: (input, cached input, output).
+# Thought tokens are billed as output; batch calls get BATCH_DISCOUNT.
+# Update when Google changes pricing: this is for budgeting, not billing.
+PRICING = {
+    "gemini-3-pro": (2.00, 0.20, 12.00),
+    "gemini-3-flash": (0.50, 0.05, 3.00),
+    "gemini-2.5-pro": (1.25, 0.125, 10.00),
+    "gemini-2.5-flash-lite": (0.10, 0.01, 0.40),
+    "gemini-2.5-flash": (0.30, 0.03, 2.50),
+    "gemini-2.0-flash-lite": (0.075, 0.0188, 0.30),
+    "gemini-2.0-flash": (0.10, 0.025, 0.40),
+    "gemini-1.5-pro": (1.25, 0.3125, 5.00),
+    "gemini-1.5-flash": (0.075, 0.0188, 0.30),
+}
+DEFAULT_PRICING = PRICING["gemini-2.5-flash"]
+BATCH_DISCOUNT = 0.5
+
+def model_pricing(model):
+    """Pricing row of the longest PRICING prefix matching the model name."""
+    name = (model or "").replace("models/", "")
+    matches = [prefix for prefix in PRICING if name.startswith(prefix)]
+    return PRICING[max(matches, key=len)] if matches else DEFAULT_PRICING
+
+def estimate_cost(model, prompt_tokens=0, cached_tokens=0, thought_tokens=0, output_tokens=0, kind="generate"):
+    """Estimated USD cost of a call (or of summed rollups)."""
+    input_price, cached_price, output_price = model_pricing(model)
+    uncached = max(0, (prompt_tokens or 0) - (cached_tokens or 0))
+    cost = (
+        uncached * input_price
+        + (cached_tokens or 0) * cached_price
+        + ((thought_tokens or 0) + (output_tokens or 0)) * output_price
+    ) / 1_000_000
+    return cost * BATCH_DISCOUNT if kind == "batch" else cost
+
+def quota_for(api_key, settings):
+    """
+    (capacity, refill_per_hour) when the call is paid from the shared server
+    key and quotas are enabled; None for users on their own key.
+    """
+    if not api_key or api_key != settings.GEMINI_API_KEY or settings.AI_TOKEN_QUOTA <= 0:
+        return None
+    return settings.AI_TOKEN_QUOTA, settings.AI_TOKEN_REFILL_PER_HOUR
+
+def usage_report(days=7, store=None):
+    """
+    Spend by user and model over the last `days` days, from the hourly
+    rollups. Returns a DataFrame with token totals and estimated_cost_usd.
+    """
+    import pandas as pd
+
+    rows = (store or get_usage_store()).get_rollups(days=days)
+    columns = ["user_id", "model", "calls", "prompt_tokens", "cached_tokens",
+               "thought_tokens", "output_tokens", "avg_latency_s", "estimated_cost_usd"]
+    if not rows:
+        return pd.DataFrame(columns=columns)
+    df = pd.DataFrame(rows)
+    df["estimated_cost_usd"] = [
+        estimate_cost(r.model, r.prompt_tokens, r.cached_tokens, r.thought_tokens, r.output_tokens, r.kind)
+        for r in df.itertuples()
+    ]
+    grouped = df.groupby(["user_id", "model"], as_index=False)[
+        ["calls", "prompt_tokens", "cached_tokens", "thought_tokens", "output_tokens",
+         "latency_sum", "estimated_cost_usd"]
+    ].sum()
+    grouped["avg_latency_s"] = grouped["latency_sum"] / grouped["calls"].where(grouped["calls"] > 0)
+    return grouped[columns].sort_values("estimated_cost_usd", ascending=False)
@@ -0,0 +1,47 @@
+from .market_data import MarketData, to_news_symbol
+from .fx_rates import FXRates
+
+def gather_analysis_context(portfolio_data, market=None, fx=None):
+    """
+    Collects the market context (reference prices, FX rates, implied CCL)
+    and ranked news used as input for an AI analysis.
+    Returns (market_context, news_headlines).
+    """
+    market = market or MarketData()
+    fx = fx or FXRates()
+    symbols = [item.get('Symbol') for item in portfolio_data]
+    market_context = market.get_global_context(fx.price_symbols(symbols))
+    market_context.update(fx.get_context(symbols, market=market))
+    news = market.get_market_news(portfolio_data)
+    return market_context, news
+
+def prefetch_analysis_context(portfolios, market, fx):
+    """
+    Shared context for analysing many portfolios at once (nightly batch):
+    one price download for every holding and one news refresh for every
+    symbol. Returns the market context common to all of them (reference
+    prices and FX rates); see portfolio_analysis_context.
+    """
+    symbol_sets = [fx.price_symbols([item.get('Symbol') for item in data]) for data in portfolios]
+    news_symbols = set(market.macro_news_symbols)
+    for data in portfolios:
+        news_symbols.update(to_news_symbol(item.get('Symbol')) for item in data)
+    news_symbols.discard("")
+    try:
+        market.warm_closes(symbol_sets)
+    except Exception as e:
+        print(f"Error prefetching prices: {e}")
+    market.refresh_news(sorted(news_symbols), max_age=market.news_max_age)
+    market_context = market.get_global_context()
+    market_context.update(fx.get_context(market=market))
+    return market_context
+
+def portfolio_analysis_context(portfolio_data, shared_context, market, fx):
+    """
+    gather_analysis_context on top of a prefetched shared context: adds only
+    the portfolio's implied CCL and news, both served from the warm caches.
+    """
+    symbols = [item.get('Symbol') for item in portfolio_data]
+    market_context = dict(shared_context)
+    market_context.update(fx.get_ccl_context(symbols, market=market))
+    return market_context, market.get_market_news(portfolio_data)
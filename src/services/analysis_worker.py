@@ -0,0 +1,153 @@
+import os
+import sys
+import time
+import socket
+import logging
+import threading
+import multiprocessing
+
+from .ai_analyst import AIAnalyst, clean_ai_response
+from .ai_usage import quota_for
+from .analysis_context import gather_analysis_context
+from ..data.job_queue import JobQueue
+from ..data.portfolio_manager import PortfolioManager
+from ..data.auth_manager import AuthManager
+from ..settings import get_settings, SettingsError
+
+logging.basicConfig(
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    level=logging.INFO,
+    handlers=[
+        logging.StreamHandler(sys.stdout),
+        logging.FileHandler('update.log')
+    ]
+)
+
+IDLE_POLL_SECONDS = 2
+# Well under ANALYSIS_HEARTBEAT_TIMEOUT, so a busy worker is never taken for dead
+HEARTBEAT_SECONDS = 15
+
+class AnalysisFailed(RuntimeError):
+    """The model API failed; the job can be retried up to ANALYSIS_MAX_ATTEMPTS."""
+
+def run_job(job, settings, auth=None, pm=None):
+    """Executes one queued analysis and stores it in ai_analyses. Returns the analysis id."""
+    auth = auth or AuthManager()
+    pm = pm or PortfolioManager()
+    payload = job["payload"]
+    user_id = job["user_id"]
+
+    api_key = auth.get_user_keys(user_id).get("gemini") or settings.GEMINI_API_KEY
+    if not api_key:
+        raise RuntimeError(f"No Gemini API key available for {user_id}")
+
+    portfolio_data = payload.get("portfolio_data", [])
+    investment_amount = payload.get("investment_amount", 0.0)
+    market_context, news = gather_analysis_context(portfolio_data)
+
+    analyst = AIAnalyst(api_key, user_id=user_id, quota=quota_for(api_key, settings))
+    analysis_text, used_model = analyst.analyze_portfolio(
+        portfolio_data, investment_amount, market_context, news_headlines=news,
+        model_name=payload.get("model_name"),
+        reasoning_enabled=payload.get("reasoning_enabled", True),
+        prompt_template=payload.get("prompt_template"),
+        use_grounding=payload.get("use_grounding", True),
+        force_refresh=payload.get("force_refresh", False),
+        allow_fallback=payload.get("allow_fallback", False),
+        structured_output=payload.get("structured_output", False),
+    )
+    if analyst.last_call.get("quota_exceeded"):
+        raise RuntimeError(analysis_text)
+    if analyst.last_call.get("error"):
+        # Not saved as an analysis: the job fails and may be retried
+        raise AnalysisFailed(analyst.last_call["error"])
+    used_model = used_model.replace("models/", "")
+    portfolio_val = sum(item.get('Total Value', 0) for item in portfolio_data)
+    cleaned_text = clean_ai_response(analysis_text)
+    # A cached answer the user already has points the job at that analysis
+    analysis_id = pm.find_analysis(cleaned_text, user_id=user_id) if analyst.last_call.get("cached") else None
+    if analysis_id is None:
+        analysis_id = pm.save_analysis(used_model, investment_amount, portfolio_val, cleaned_text, user_id=user_id)
+        # Trades are recorded once per analysis, not again on every cache hit
+        plan = analyst.last_call.get("plan")
+        if plan:
+            pm.save_recommendations(analysis_id, plan["trades"], user_id=user_id)
+    return analysis_id
+
+def _beat(queue, job_id, worker_id, stop):
+    while not stop.wait(HEARTBEAT_SECONDS):
+        try:
+            queue.heartbeat(job_id, worker_id)
+        except Exception as e:
+            logging.warning(f"[{worker_id}] Heartbeat for job {job_id} failed: {e}")
+
+def worker_loop(worker_id, per_user_limit, max_jobs=None):
+    """Claims and runs jobs until max_jobs have been processed (forever if None)."""
+    settings = get_settings()
+    queue = JobQueue()
+    auth = AuthManager()
+    pm = PortfolioManager()
+    processed = 0
+    logging.info(f"[{worker_id}] Analysis worker started.")
+    while max_jobs is None or processed < max_jobs:
+        job = queue.claim(worker_id, per_user_limit=per_user_limit)
+        if job is None:
+            time.sleep(IDLE_POLL_SECONDS)
+            continue
+        processed += 1
+        started = time.time()
+        logging.info(f"[{worker_id}] Running job {job['id']} for {job['user_id']}...")
+        stop = threading.Event()
+        threading.Thread(target=_beat, args=(queue, job["id"], worker_id, stop), daemon=True).start()
+        try:
+            analysis_id = run_job(job, settings, auth=auth, pm=pm)
+            queue.complete(job["id"], analysis_id)
+            logging.info(f"[{worker_id}] Job {job['id']} done in {time.time() - started:.1f}s.")
+        except AnalysisFailed as e:
+            if queue.retry(job["id"], e, settings.ANALYSIS_MAX_ATTEMPTS):
+                logging.warning(f"[{worker_id}] Job {job['id']} failed, re-queued: {e}")
+            else:
+                logging.error(f"[{worker_id}] Job {job['id']} failed: {e}")
+        except Exception as e:
+            queue.fail(job["id"], e)
+            logging.error(f"[{worker_id}] Job {job['id']} failed: {e}")
+        finally:
+            stop.set()
+
+def main():
+    try:
+        settings = get_settings()
+    except SettingsError as exc:
+        logging.error(str(exc))
+        raise SystemExit(1)
+
+    requeued = JobQueue().requeue_stale(settings.ANALYSIS_HEARTBEAT_TIMEOUT, settings.ANALYSIS_MAX_ATTEMPTS)
+    if requeued:
+        logging.info(f"Re-queued {requeued} stale job(s).")
+
+    host = socket.gethostname()
+    processes = []
+    for n in range(max(1, settings.ANALYSIS_WORKERS)):
+        worker_id = f"{host}-{os.getpid()}-{n}"
+        proc = multiprocessing.Process(
+            target=worker_loop, args=(worker_id, settings.ANALYSIS_PER_USER_LIMIT), daemon=True
+        )
+        proc.start()
+        processes.append(proc)
+    logging.info(f"Started {len(processes)} analysis worker process(es).")
+
+    # Supervise: restart crashed workers, periodically recover stuck jobs
+    while True:
+        time.sleep(30)
+        JobQueue().requeue_stale(settings.ANALYSIS_HEARTBEAT_TIMEOUT, settings.ANALYSIS_MAX_ATTEMPTS)
+        for n, proc in enumerate(processes):
+            if not proc.is_alive():
+                logging.warning(f"Worker {n} exited (code {proc.exitcode}); restarting.")
+                worker_id = f"{host}-{os.getpid()}-{n}"
+                processes[n] = multiprocessing.Process(
+                    target=worker_loop, args=(worker_id, settings.ANALYSIS_PER_USER_LIMIT), daemon=True
+                )
+                processes[n].start()
+
+if __name__ == "__main__":
+    main()
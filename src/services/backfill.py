@@ -0,0 +1,110 @@
+import logging
+from bisect import bisect_left
+from datetime import date, timedelta
+
+from .market_calendar import MarketCalendar
+from .market_data import MarketData
+from ..data.portfolio_manager import PortfolioManager
+from ..settings import get_settings
+
+# Covers the 30-day comparison in calculate_gains with some margin
+BACKFILL_DAYS = 45
+# Days past the last recorded snapshot that are still reconstructed; beyond
+# that the account is treated as stopped (credentials removed, account closed)
+MAX_RECONSTRUCT_DAYS = 14
+
+def _close_on(closes, symbol, date_str):
+    """Last close of `symbol` on or before date_str (None if unknown)."""
+    if closes.empty or symbol not in closes.columns:
+        return None
+    series = closes[symbol].loc[:date_str].dropna()
+    return float(series.iloc[-1]) if not series.empty else None
+
+def find_gaps(calendar, history, snapshot_dates, start, end, max_distance=MAX_RECONSTRUCT_DAYS):
+    """
+    Trading days between start and end (dates) after the first recorded
+    holdings with no snapshot, at most max_distance days after the last
+    recorded snapshot before them.
+    """
+    recorded = sorted(date.fromisoformat(d) for d in history)
+    day = max(start, recorded[0] + timedelta(days=1))
+    gaps = []
+    while day <= end:
+        last = recorded[bisect_left(recorded, day) - 1]
+        if (
+            (day - last).days <= max_distance
+            and calendar.is_trading_day(day)
+            and day.isoformat() not in snapshot_dates
+        ):
+            gaps.append(day.isoformat())
+        day += timedelta(days=1)
+    return gaps
+
+def reconstruct_day(base_date, base_assets, day, closes):
+    """
+    Approximate holdings on `day`: the quantities of the last recorded
+    snapshot, repriced by the market move between base_date and `day`.
+    Prices without market data are carried forward unchanged.
+    """
+    assets = []
+    for symbol, quantity, price in base_assets:
+        reference, close = _close_on(closes, symbol, base_date), _close_on(closes, symbol, day)
+        # Scale the IOL price by the Yahoo move (IOL quotes some instruments per 100 nominal)
+        if reference and close and price:
+            price = price * close / reference
+        price = price or 0.0
+        assets.append({
+            "Symbol": symbol,
+            "Quantity": quantity or 0,
+            "Last Price": price,
+            "Total Value": (quantity or 0) * price,
+        })
+    return assets
+
+def backfill_gaps(days=BACKFILL_DAYS, pm=None, market=None, calendar=None):
+    """
+    Rebuilds missing trading days of the last `days` days for every active
+    user from their last recorded holdings and historical closes (one
+    batched download for all users). Rows are flagged as reconstructed and
+    written in one transaction per user. Returns the number of days written.
+    """
+    pm = pm or PortfolioManager()
+    market = market or MarketData()
+    calendar = calendar or MarketCalendar.from_settings(get_settings())
+
+    today = calendar.now().date()
+    start, end = today - timedelta(days=days), today - timedelta(days=1)
+    start_str = start.isoformat()
+
+    plans = {}
+    for user_id in pm.get_active_users(days=days):
+        history = pm.get_asset_history(user_id, start_str)
+        if not history:
+            continue
+        gaps = find_gaps(calendar, history, pm.get_snapshot_dates(user_id, start_str), start, end)
+        if gaps:
+            plans[user_id] = (history, gaps)
+    if not plans:
+        logging.info("Backfill: no gaps found.")
+        return 0
+
+    symbols = {symbol for history, _ in plans.values() for assets in history.values() for symbol, _, _ in assets}
+    earliest = min(min(history) for history, _ in plans.values())
+    # A few extra days so the base date always has a previous close
+    closes = market.get_historical_closes(symbols, date.fromisoformat(earliest) - timedelta(days=7), end)
+
+    written = 0
+    for user_id, (history, gaps) in plans.items():
+        base_dates = sorted(history)
+        snapshots = {}
+        for day in gaps:
+            base_date = max(d for d in base_dates if d < day)
+            snapshots[day] = reconstruct_day(base_date, history[base_date], day, closes)
+        try:
+            count = pm.save_reconstructed_snapshots(user_id, snapshots)
+        except Exception as e:
+            logging.error(f"Backfill failed for {user_id}: {e}")
+            continue
+        written += count
+        logging.info(f"Backfill: reconstructed {count} day(s) for {user_id}.")
+    return written
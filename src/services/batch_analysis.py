@@ -0,0 +1,290 @@
+import sys
+import json
+import time
+import hashlib
+import logging
+from datetime import datetime
+
+from .ai_analyst import AIAnalyst, clean_ai_response, create_session
+from .analysis_context import prefetch_analysis_context, portfolio_analysis_context
+from .market_data import MarketData
+from .fx_rates import FXRates
+from ..data.batch_store import BatchStore, TERMINAL_STATES
+from ..data.usage_store import get_usage_store
+from ..data.portfolio_manager import PortfolioManager
+from ..data.auth_manager import AuthManager
+from ..settings import get_settings
+
+BATCH_USE_GROUNDING = True
+
+class GeminiBatchClient:
+    """
+    Minimal REST client for Gemini batch mode: resumable JSONL upload through
+    the Files API, batch creation, status polling and result download.
+    """
+
+    def __init__(self, api_key, api_base="https://generativelanguage.googleapis.com", timeout=60):
+        self.api_key = api_key
+        self.api_base = api_base.rstrip("/")
+        self.base_url = f"{self.api_base}/v1beta"
+        self.timeout = timeout
+        self.session = create_session()
+
+    def _check(self, response, action):
+        if response.status_code != 200:
+            raise RuntimeError(f"{action} failed: {response.status_code} - {response.text[:500]}")
+        return response
+
+    def upload_jsonl(self, lines, display_name):
+        """Uploads JSONL request lines and returns the file name (files/...)."""
+        payload = "\n".join(json.dumps(line) for line in lines).encode("utf-8")
+        start = self._check(self.session.post(
+            f"{self.api_base}/upload/v1beta/files?key={self.api_key}",
+            headers={
+                "X-Goog-Upload-Protocol": "resumable",
+                "X-Goog-Upload-Command": "start",
+                "X-Goog-Upload-Header-Content-Length": str(len(payload)),
+                "X-Goog-Upload-Header-Content-Type": "application/jsonl",
+                "Content-Type": "application/json",
+            },
+            json={"file": {"display_name": display_name}},
+            timeout=self.timeout,
+        ), "Upload start")
+        upload_url = start.headers.get("X-Goog-Upload-URL")
+        if not upload_url:
+            raise RuntimeError("Upload start did not return an upload URL")
+
+        done = self._check(self.session.post(
+            upload_url,
+            headers={
+                "Content-Length": str(len(payload)),
+                "X-Goog-Upload-Offset": "0",
+                "X-Goog-Upload-Command": "upload, finalize",
+            },
+            data=payload,
+            timeout=self.timeout,
+        ), "Upload")
+        return done.json()["file"]["name"]
+
+    def create_batch(self, model_name, file_name, display_name):
+        """Starts a batch over an uploaded JSONL file. Returns the batch name (batches/...)."""
+        response = self._check(self.session.post(
+            f"{self.base_url}/{model_name}:batchGenerateContent?key={self.api_key}",
+            json={"batch": {"display_name": display_name, "input_config": {"file_name": file_name}}},
+            timeout=self.timeout,
+        ), "Batch creation")
+        return response.json()["name"]
+
+    def get_batch(self, name):
+        response = self._check(self.session.get(
+            f"{self.base_url}/{name}?key={self.api_key}", timeout=self.timeout
+        ), "Batch status")
+        return response.json()
+
+    def download_results(self, file_name):
+        """Downloads a result file and returns its parsed JSONL lines."""
+        response = self._check(self.session.get(
+            f"{self.api_base}/download/v1beta/{file_name}:download?alt=media&key={self.api_key}",
+            timeout=self.timeout,
+        ), "Result download")
+        results = []
+        for line in response.text.splitlines():
+            if line.strip():
+                results.append(json.loads(line))
+        return results
+
+def _key_hash(api_key):
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+def _group_users_by_key(users, auth, settings):
+    """{api_key: [user_id, ...]}: users without a personal key use the server key."""
+    groups = {}
+    for user_id in users:
+        api_key = auth.get_user_keys(user_id).get("gemini") or settings.GEMINI_API_KEY
+        if not api_key:
+            logging.warning(f"Batch: no Gemini API key for {user_id}, skipping.")
+            continue
+        groups.setdefault(api_key, []).append(user_id)
+    return groups
+
+def build_batch_requests(analyst, model_name, holdings, pm, context):
+    """
+    Returns (JSONL lines, metadata by request key) for the users in
+    `holdings` ({user_id: portfolio_data}) that hold something. `context` is
+    (shared_context, market, fx) from prefetch_analysis_context.
+    """
+    shared_context, market, fx = context
+    lines, requests = [], {}
+    for user_id, portfolio_data in holdings.items():
+        if not portfolio_data:
+            continue
+        investment_amount = pm.get_last_investment_amount(user_id=user_id)
+        market_context, news = portfolio_analysis_context(portfolio_data, shared_context, market, fx)
+        body = analyst.build_request_body(
+            portfolio_data, investment_amount, market_context, news,
+            model_name=model_name, use_grounding=BATCH_USE_GROUNDING
+        )
+        key = f"{user_id}:{datetime.now().strftime('%Y%m%d')}"
+        lines.append({"key": key, "request": body})
+        requests[key] = {
+            "user_id": user_id,
+            "investment_amount": investment_amount,
+            "portfolio_value": sum(item.get('Total Value', 0) or 0 for item in portfolio_data),
+        }
+    return lines, requests
+
+def submit_nightly_batches(settings=None):
+    """
+    Submits one batch per Gemini key for every opted-in user with a snapshot.
+    A key that already has a batch submitted today is skipped. Returns the
+    names of the batches created.
+    """
+    settings = settings or get_settings()
+    auth = AuthManager()
+    pm = PortfolioManager()
+    store = BatchStore()
+
+    users = auth.get_batch_users()
+    if not users:
+        logging.info("Batch: no users opted in.")
+        return []
+
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+    holdings = {user_id: pm.get_latest_assets(user_id=user_id) for user_id in users}
+    context = None
+    created = []
+    for api_key, user_ids in _group_users_by_key(users, auth, settings).items():
+        key_hash = _key_hash(api_key)
+        if store.submitted_since(key_hash, today):
+            logging.info(f"Batch: already submitted today for {len(user_ids)} user(s), skipping.")
+            continue
+        analyst = AIAnalyst(api_key, base_url=f"{settings.GEMINI_API_BASE.rstrip('/')}/v1beta",
+                            use_context_cache=False)
+        model_name = analyst._resolve_model(settings.BATCH_MODEL)
+        if context is None:
+            # Market and news I/O once for every user, not once per user
+            market, fx = MarketData(), FXRates()
+            context = (prefetch_analysis_context(list(filter(None, holdings.values())), market, fx), market, fx)
+        lines, requests = build_batch_requests(
+            analyst, model_name, {user_id: holdings[user_id] for user_id in user_ids}, pm, context
+        )
+        if not lines:
+            continue
+        client = GeminiBatchClient(api_key, settings.GEMINI_API_BASE)
+        display_name = f"inver-nightly-{datetime.now().strftime('%Y%m%d')}-{key_hash[:6]}"
+        try:
+            file_name = client.upload_jsonl(lines, display_name)
+            name = client.create_batch(model_name, file_name, display_name)
+        except Exception as e:
+            logging.error(f"Batch submission failed: {e}")
+            continue
+        store.add(name, key_hash, auth.encrypt(api_key), model_name, requests)
+        created.append(name)
+        logging.info(f"Batch {name} submitted with {len(lines)} request(s) on {model_name}.")
+    return created
+
+def _batch_results(client, status):
+    """Result lines of a succeeded batch (file output or inlined responses)."""
+    response = status.get("response") or {}
+    if response.get("responsesFile"):
+        return client.download_results(response["responsesFile"])
+    inlined = (response.get("inlinedResponses") or {}).get("inlinedResponses", [])
+    return [
+        {"key": (item.get("metadata") or {}).get("key"), **item}
+        for item in inlined
+    ]
+
+def import_results(batch, results, pm):
+    """Bulk-inserts the successful answers of a batch. Returns rows written."""
+    model = batch["model"].replace("models/", "")
+    usage = get_usage_store()
+    analyses = []
+    for result in results:
+        meta = batch["requests"].get(result.get("key"))
+        if meta is None:
+            continue
+        if "error" in result:
+            logging.warning(f"Batch {batch['name']}: request {result.get('key')} failed: {result['error']}")
+            continue
+        response = result.get("response") or {}
+        try:
+            usage.record(meta["user_id"], model, response.get("usageMetadata"), kind="batch")
+        except Exception as e:
+            logging.warning(f"Could not record batch usage: {e}")
+        text = AIAnalyst.response_text(response)
+        if not text:
+            continue
+        analyses.append({
+            "user_id": meta["user_id"],
+            "model": f"{model} (batch)",
+            "investment_amount": meta["investment_amount"],
+            "portfolio_value": meta["portfolio_value"],
+            "response": clean_ai_response(text),
+        })
+    return pm.save_analyses(analyses)
+
+def poll_batches(settings=None):
+    """
+    Checks every unfinished batch once; imports the ones that succeeded.
+    Returns the number of analyses imported.
+    """
+    settings = settings or get_settings()
+    store = BatchStore()
+    pending = store.get_pending()
+    if not pending:
+        return 0
+    auth = AuthManager()
+    pm = PortfolioManager()
+
+    imported = 0
+    for batch in pending:
+        api_key = auth.decrypt(batch["api_key_enc"])
+        if not api_key:
+            store.mark_imported(batch["name"], 0, error="API key could not be decrypted")
+            continue
+        client = GeminiBatchClient(api_key, settings.GEMINI_API_BASE)
+        try:
+            status = client.get_batch(batch["name"])
+        except Exception as e:
+            logging.error(f"Batch {batch['name']}: status check failed: {e}")
+            continue
+        state = (status.get("metadata") or {}).get("state", batch["state"])
+        if state != batch["state"]:
+            store.update_state(batch["name"], state)
+        if state not in TERMINAL_STATES:
+            continue
+        if state != "BATCH_STATE_SUCCEEDED":
+            store.mark_imported(batch["name"], 0, error=json.dumps(status.get("error") or state))
+            logging.warning(f"Batch {batch['name']} ended in {state}.")
+            continue
+        try:
+            count = import_results(batch, _batch_results(client, status), pm)
+        except Exception as e:
+            logging.error(f"Batch {batch['name']}: import failed: {e}")
+            continue
+        store.mark_imported(batch["name"], count)
+        imported += count
+        logging.info(f"Batch {batch['name']}: imported {count}/{len(batch['requests'])} analyses.")
+    return imported
+
+def main():
+    """
+    Manual entry point:
+        python -m src.services.batch_analysis submit | poll | run
+    `run` submits and polls until every batch is finished (useful with the stub).
+    """
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else "run"
+    if command in ("submit", "run"):
+        submit_nightly_batches()
+    if command == "poll":
+        poll_batches()
+    if command == "run":
+        while True:
+            poll_batches()
+            if not BatchStore().get_pending():
+                break
+            time.sleep(10)
+
+if __name__ == "__main__":
+    main()
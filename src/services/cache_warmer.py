@@ -0,0 +1,66 @@
+import logging
+from .market_data import MarketData, to_news_symbol
+from .fx_rates import FXRates
+from .ai_analyst import AIAnalyst
+from ..data.portfolio_manager import PortfolioManager
+from ..data.auth_manager import AuthManager
+from ..settings import get_settings
+
+def warm_caches(active_days=7):
+    """
+    Prefetches market context prices and news for every active user's holdings
+    into the shared caches, so the first dashboard render is served warm.
+    """
+    pm = PortfolioManager()
+    market = MarketData()
+    fx = FXRates()
+
+    users = pm.get_active_users(days=active_days)
+    holdings = {user_id: pm.get_latest_assets(user_id=user_id) for user_id in users}
+    logging.info(f"Warming caches for {len(users)} active user(s)...")
+
+    # 1. Prices: one batched download primes every user's context entry
+    symbol_sets = [
+        fx.price_symbols([asset.get('Symbol') for asset in assets])
+        for assets in holdings.values()
+    ]
+    try:
+        count = market.warm_closes(symbol_sets)
+        logging.info(f"Warmed prices for {count} tickers.")
+    except Exception as e:
+        logging.error(f"Price warm-up failed: {e}")
+
+    # 2. FX series (official, MEP, CCL) used for USD views and implied CCL
+    try:
+        written = fx.ensure_rates()
+        logging.info(f"FX rates up to date ({written} rows written).")
+    except Exception as e:
+        logging.error(f"FX warm-up failed: {e}")
+
+    # 3. News: refresh the store for all held and macro symbols, then prune
+    news_symbols = set(market.macro_news_symbols)
+    for assets in holdings.values():
+        news_symbols.update(to_news_symbol(asset.get('Symbol')) for asset in assets)
+    news_symbols.discard("")
+    try:
+        added = market.refresh_news(sorted(news_symbols))
+        removed = market.news_store.prune()
+        logging.info(f"Warmed news for {len(news_symbols)} symbols ({added} new, {removed} pruned).")
+    except Exception as e:
+        logging.error(f"News warm-up failed: {e}")
+
+    # 4. Gemini model catalog for every distinct key in use
+    try:
+        warm_model_catalogs(users)
+    except Exception as e:
+        logging.error(f"Model catalog warm-up failed: {e}")
+
+def warm_model_catalogs(users):
+    auth = AuthManager()
+    api_keys = {get_settings().GEMINI_API_KEY}
+    for user_id in users:
+        api_keys.add(auth.get_user_keys(user_id).get("gemini"))
+    api_keys.discard(None)
+    api_keys.discard("")
+    refreshed = sum(1 for key in api_keys if AIAnalyst(key).refresh_model_catalog() is not None)
+    logging.info(f"Warmed Gemini model catalog for {refreshed}/{len(api_keys)} key(s).")
@@ -1,8 +1,15 @@
 import os
 import sys
+import time
+import socket
 import logging
-from .iol_client import IOLClient
+import requests
+from concurrent.futures import ThreadPoolExecutor, wait
+from .iol_client import IOLClient, parse_portfolio
+from .metrics import REFRESH_PHASE, REFRESH_USERS, ROWS_WRITTEN, LAST_SNAPSHOT
 from ..data.portfolio_manager import PortfolioManager
+from ..data.auth_manager import AuthManager
+from ..data.lease_store import LeaseStore, LEADER_LEASE
 from ..settings import get_settings, SettingsError
 
 # Setup basic logging
@@ -15,7 +22,149 @@ logging.basicConfig(
     ]
 )
 
-def run_update():
+# Same mock data as app.py, used when no account has IOL credentials
+MOCK_PORTFOLIO = [
+    {"Symbol": "SPY.BA", "Description": "S&P 500 ETF CEDEAR", "Quantity": 10, "Last Price": 52250.0, "Total Value": 522500.0, "Daily Var %": 0.5},
+    {"Symbol": "GGAL.BA", "Description": "Grupo Financiero Galicia", "Quantity": 100, "Last Price": 8125.0, "Total Value": 812500.0, "Daily Var %": -1.2},
+    {"Symbol": "MELI.BA", "Description": "MercadoLibre CEDEAR", "Quantity": 5, "Last Price": 26700.0, "Total Value": 133500.0, "Daily Var %": 2.1},
+]
+
+# Pause while other replicas still hold claims we may have to take over
+CLAIM_WAIT_SECONDS = 10
+
+def replica_id():
+    """Identifies this process among scheduler replicas (container hostname + pid)."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+def get_accounts(settings, auth):
+    """
+    [(user_id, iol_user, iol_pass)] to refresh: every user with stored IOL
+    credentials, plus the .env account for admin if admin has none stored.
+    """
+    accounts = auth.get_iol_accounts()
+    if settings.IOL_USERNAME and settings.IOL_PASSWORD:
+        if not any(user_id.lower() == "admin" for user_id, _, _ in accounts):
+            accounts.append(("admin", settings.IOL_USERNAME, settings.IOL_PASSWORD))
+    return accounts
+
+def fetch_snapshot(user_id, iol_user, iol_pass, base_url, timeout):
+    """
+    Fetches one user's portfolio. `timeout` bounds each HTTP request and the
+    whole fetch; a slow account raises instead of holding its worker.
+    """
+    started = time.monotonic()
+    with REFRESH_PHASE.time(phase="fetch"):
+        iol = IOLClient(iol_user, iol_pass, base_url=base_url, timeout=timeout)
+        iol.authenticate()
+        if time.monotonic() - started > timeout:
+            raise TimeoutError(f"authentication took longer than {timeout}s")
+        raw_portfolio = iol.get_portfolio()
+    with REFRESH_PHASE.time(phase="parse"):
+        portfolio_data = parse_portfolio(raw_portfolio)
+    if not portfolio_data:
+        return None
+    return {
+        "user_id": user_id,
+        "total_value": sum(item["Total Value"] or 0 for item in portfolio_data),
+        "assets": portfolio_data,
+    }
+
+def refresh_accounts(accounts, settings, cycle_timeout=None):
+    """
+    Fetches every account on a bounded thread pool. Failures and timeouts are
+    logged per user and never affect the others. Returns (snapshots, failed).
+    """
+    workers = max(1, min(settings.IOL_REFRESH_WORKERS, len(accounts)))
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="iol-refresh")
+    futures = {
+        executor.submit(fetch_snapshot, user_id, iol_user, iol_pass,
+                        settings.IOL_API_URL, settings.IOL_REFRESH_TIMEOUT): user_id
+        for user_id, iol_user, iol_pass in accounts
+    }
+    done, not_done = wait(futures, timeout=cycle_timeout or settings.IOL_REFRESH_CYCLE_TIMEOUT)
+    # Don't block the scheduler on stragglers; queued accounts are dropped
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    snapshots, failed = [], []
+    for future in done:
+        user_id = futures[future]
+        try:
+            snapshot = future.result()
+        except Exception as e:
+            logging.error(f"IOL refresh failed for {user_id}: {e}")
+            REFRESH_USERS.inc(outcome="timeout" if isinstance(e, (TimeoutError, requests.Timeout)) else "failed")
+            failed.append(user_id)
+            continue
+        if snapshot is None:
+            logging.warning(f"No portfolio data found for {user_id}.")
+            REFRESH_USERS.inc(outcome="empty")
+        else:
+            REFRESH_USERS.inc(outcome="ok")
+            snapshots.append(snapshot)
+    for future in not_done:
+        logging.error(f"IOL refresh for {futures[future]} did not finish within the cycle timeout.")
+        REFRESH_USERS.inc(outcome="timeout")
+        failed.append(futures[future])
+    return snapshots, failed
+
+def save_snapshots(pm, snapshots):
+    """Bulk-writes snapshots and updates the write metrics. Returns portfolios saved."""
+    with REFRESH_PHASE.time(phase="write"):
+        saved = pm.save_daily_snapshots(snapshots)
+    now = time.time()
+    ROWS_WRITTEN.inc(saved, table="portfolio_snapshots")
+    ROWS_WRITTEN.inc(sum(len(snap["assets"]) for snap in snapshots), table="asset_snapshots")
+    for snap in snapshots:
+        LAST_SNAPSHOT.set(now, user_id=snap["user_id"])
+    return saved
+
+def refresh_claimed(accounts, settings, pm, leases, holder, started):
+    """
+    Claims accounts in chunks and refreshes them until none is left, so
+    several scheduler replicas split the users. Claims held by a replica that
+    stops responding expire after SCHEDULER_LEASE_SECONDS and are taken over.
+    Returns (saved, failed).
+    """
+    by_user = {account[0]: account for account in accounts}
+    user_ids = list(by_user)
+    ttl = settings.SCHEDULER_LEASE_SECONDS
+    # Users refreshed by any replica within half a polling interval are skipped
+    fresh_for = settings.MARKET_POLL_MINUTES * 30
+    deadline = started + settings.IOL_REFRESH_CYCLE_TIMEOUT
+
+    saved, failed = 0, []
+    while time.monotonic() < deadline:
+        # Users that failed here are left to the other replicas for this cycle
+        pending = [user_id for user_id in user_ids if user_id not in failed]
+        claimed = leases.claim_users(pending, holder, settings.IOL_REFRESH_CLAIM_BATCH, ttl, fresh_for)
+        if not claimed:
+            if not leases.claimed_elsewhere(pending, holder):
+                break
+            time.sleep(CLAIM_WAIT_SECONDS)
+            continue
+
+        remaining = deadline - time.monotonic()
+        snapshots, chunk_failed = refresh_accounts(
+            [by_user[user_id] for user_id in claimed], settings, cycle_timeout=max(1, min(ttl, remaining))
+        )
+        failed.extend(chunk_failed)
+        # Failed fetches are not marked refreshed, so another replica can retry them
+        leases.release_users(chunk_failed, holder)
+        try:
+            saved += save_snapshots(pm, snapshots)
+        except Exception as e:
+            # Claims are left to expire so another pass retries these users
+            logging.error(f"Failed to save snapshots to DB: {e}")
+            failed.extend(snap["user_id"] for snap in snapshots)
+            continue
+        leases.complete_users([user_id for user_id in claimed if user_id not in chunk_failed], holder)
+    return saved, failed
+
+def run_update(holder=None):
+    """
+    One refresh cycle. Returns False if it failed as a whole (settings, DB
+    or every fetched account failing), True otherwise, so callers can report it.
+    """
     script_dir = os.path.dirname(os.path.abspath(__file__))
     project_root = os.path.dirname(os.path.dirname(script_dir))
 
@@ -23,65 +172,46 @@ def run_update():
         settings = get_settings()
     except SettingsError as exc:
         logging.error(str(exc))
-        return
-
-    iol_username = settings.IOL_USERNAME
-    iol_password = settings.IOL_PASSWORD
-    iol_base_url = settings.IOL_API_URL
-    
-    pm = PortfolioManager(db_path=os.path.join(project_root, "data", "inver.db"))
-    
-    logging.info("Starting portfolio update...")
-    
-    portfolio_data = []
-    
-    if not iol_username or not iol_password:
-        logging.warning("No IOL credentials found. Using Simulation Mode logic (Mock Data).")
-        # Same mock data as app.py
-        portfolio_data = [
-            {"Symbol": "SPY.BA", "Description": "S&P 500 ETF CEDEAR", "Quantity": 10, "Last Price": 52250.0, "Total Value": 522500.0, "Daily Var %": 0.5},
-            {"Symbol": "GGAL.BA", "Description": "Grupo Financiero Galicia", "Quantity": 100, "Last Price": 8125.0, "Total Value": 812500.0, "Daily Var %": -1.2},
-            {"Symbol": "MELI.BA", "Description": "MercadoLibre CEDEAR", "Quantity": 5, "Last Price": 26700.0, "Total Value": 133500.0, "Daily Var %": 2.1},
-        ]
-    else:
-        try:
-            iol = IOLClient(iol_username, iol_password, base_url=iol_base_url)
-            iol.authenticate()
-            raw_portfolio = iol.get_portfolio()
-            
-            if raw_portfolio and 'activos' in raw_portfolio:
-                for asset in raw_portfolio['activos']:
-                    symbol = asset.get('titulo', {}).get('simbolo', 'N/A')
-                    desc = asset.get('titulo', {}).get('descripcion', '')
-                    qty = asset.get('cantidad', 0)
-                    last_price = asset.get('ultimoPrecio', 0.0)
-                    total_val = asset.get('valorizado', 0.0)
-                    daily_var = asset.get('variacionDiaria', 0.0)
-                    
-                    portfolio_data.append({
-                        "Symbol": symbol,
-                        "Description": desc,
-                        "Quantity": qty,
-                        "Last Price": last_price,
-                        "Total Value": total_val,
-                        "Daily Var %": daily_var
-                    })
-            logging.info("Successfully fetched data from IOL.")
-            
-        except Exception as e:
-            logging.error(f"Failed to connect/fetch from IOL: {e}")
-            return
+        return False
+
+    db_path = os.path.join(project_root, "data", "inver.db")
+    pm = PortfolioManager(db_path=db_path)
+    accounts = get_accounts(settings, AuthManager(db_path=db_path))
+    holder = holder or replica_id()
+
+    logging.info(f"Starting portfolio update for {len(accounts)} account(s) on {holder}...")
+    started = time.monotonic()
 
-    if portfolio_data:
-        total_value = sum(item["Total Value"] for item in portfolio_data)
+    leases = LeaseStore(db_path=db_path)
+    if not accounts:
+        # Not split by claims: only the leader writes the mock snapshot
+        if not leases.try_acquire(LEADER_LEASE, holder, settings.SCHEDULER_LEASE_SECONDS):
+            logging.info("No IOL credentials found; mock snapshot left to the leader replica.")
+            return True
+        logging.warning("No IOL credentials found. Using Simulation Mode logic (Mock Data).")
         try:
-            pm.save_daily_snapshot(total_value, portfolio_data)
-            logging.info(f"Snapshot saved. Total Value: ${total_value:,.2f}")
-            print(f"Success. Total Value: ${total_value:,.2f}")
+            saved = save_snapshots(pm, [{
+                "user_id": "admin",
+                "total_value": sum(item["Total Value"] for item in MOCK_PORTFOLIO),
+                "assets": MOCK_PORTFOLIO,
+            }])
         except Exception as e:
-            logging.error(f"Failed to save snapshot to DB: {e}")
+            logging.error(f"Failed to save snapshots to DB: {e}")
+            return False
+        failed = []
     else:
-        logging.warning("No portfolio data found to save.")
+        saved, failed = refresh_claimed(accounts, settings, pm, leases, holder, started)
+
+    if not saved and not failed:
+        logging.info("No portfolios left to refresh (already refreshed by another replica).")
+        return True
+
+    elapsed = time.monotonic() - started
+    logging.info(f"Snapshots saved for {saved} user(s), {len(failed)} failed, in {elapsed:.1f}s.")
+    if failed and not saved:
+        return False
+    print(f"Success. {saved} portfolio(s) updated in {elapsed:.1f}s.")
+    return True
 
 if __name__ == "__main__":
-    run_update()
+    sys.exit(0 if run_update() else 1)
@@ -0,0 +1,159 @@
+import requests
+from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .market_data import MarketData, to_yahoo_symbol, to_news_symbol
+from ..data.fx_store import FXStore, FX_OFFICIAL, FX_MEP, FX_CCL
+from ..data.cache_store import get_cache_store
+
+FX_KINDS = (FX_OFFICIAL, FX_MEP, FX_CCL)
+FX_LABELS = {FX_OFFICIAL: "Dólar Oficial", FX_MEP: "Dólar MEP", FX_CCL: "Dólar CCL"}
+# Wait before another process retries a failed rates download
+FX_RETRY_SECONDS = 300
+
+# CEDEAR conversion ratios (CEDEARs per underlying share/unit), per BYMA.
+# Ratios change after splits; override via FXRates(ratios=...) when needed.
+CEDEAR_RATIOS = {
+    "AAPL": 20, "AMZN": 144, "GOOGL": 58, "MSFT": 30, "META": 24, "NVDA": 24,
+    "TSLA": 15, "MELI": 120, "KO": 5, "DIA": 20, "SPY": 20, "QQQ": 20,
+    "IWM": 10, "EEM": 5, "XLE": 2, "GLD": 50, "BABA": 9, "NFLX": 48,
+}
+
+class FXRates:
+    def __init__(self, ratios=None, base_url="https://api.argentinadatos.com/v1", timeout=10):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.ratios = dict(CEDEAR_RATIOS, **(ratios or {}))
+        self.store = FXStore()
+        self.session = self._create_session()
+
+    def _create_session(self):
+        session = requests.Session()
+        try:
+            retry = Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset(["GET"])
+            )
+        except TypeError:
+            retry = Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504),
+                method_whitelist=["GET"]
+            )
+        adapter = HTTPAdapter(max_retries=retry)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def refresh_rates(self, kinds=FX_KINDS):
+        """Downloads the full daily series for each kind and stores it. Returns rows written."""
+        written = 0
+        for kind in kinds:
+            url = f"{self.base_url}/cotizaciones/dolares/{kind}"
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+                if response.status_code != 200:
+                    print(f"Error fetching {kind} rates: {response.status_code}")
+                    continue
+                # Use the selling rate: what it costs to buy USD
+                rates = [(row.get('fecha'), row.get('venta')) for row in response.json()]
+                written += self.store.save_rates(kind, [r for r in rates if r[0]])
+            except Exception as e:
+                print(f"Error fetching {kind} rates: {e}")
+        return written
+
+    def ensure_rates(self, max_attempt_age=3600, retry_after=FX_RETRY_SECONDS):
+        """
+        Refreshes the stored series if they don't include today yet.
+        Attempts are throttled through the shared cache so web and scheduler
+        processes don't refetch the same day's data: for max_attempt_age
+        after a successful fetch, for retry_after after a failed one.
+        """
+        today = datetime.now().strftime("%Y-%m-%d")
+        stale = [k for k in FX_KINDS if self.store.latest_date(k) != today]
+        if not stale:
+            return 0
+        cache = get_cache_store()
+        key = f"fx_rates:refresh:{today}"
+        if cache.get(key):
+            return 0
+        # Short claim while fetching, extended only once the fetch succeeded
+        cache.set(key, True, min(retry_after, max_attempt_age))
+        written = self.refresh_rates(stale)
+        if written:
+            cache.set(key, True, max_attempt_age)
+        return written
+
+    def get_rates(self):
+        """Latest stored rate per kind: {kind: rate or None}."""
+        return {kind: self.store.latest_rate(kind) for kind in FX_KINDS}
+
+    def implied_ccl(self, holdings):
+        """
+        Computes the implied CCL for every CEDEAR in one vectorized pass:
+        local ARS price * conversion ratio / underlying USD price.
+        `holdings` needs Symbol, local_price and us_price columns.
+        """
+        df = holdings.copy()
+        df['ratio'] = df['Symbol'].map(to_news_symbol).map(self.ratios)
+        valid = df['ratio'].notna() & (df['us_price'] > 0) & (df['local_price'] > 0)
+        df['implied_ccl'] = (df['local_price'] * df['ratio'] / df['us_price']).where(valid)
+        return df
+
+    def price_symbols(self, symbols):
+        """
+        Yahoo tickers needed to price holdings and their implied CCL: every held
+        symbol on BYMA plus the US underlying of each CEDEAR. Passing this same
+        list to MarketData keeps prices and CCL on a single cached download.
+        """
+        result = [to_yahoo_symbol(s) for s in symbols if s]
+        result += [to_news_symbol(s) for s in symbols if to_news_symbol(s) in self.ratios]
+        return list(dict.fromkeys(result))
+
+    def get_cedear_ccl(self, symbols, market=None):
+        """
+        Implied CCL per held CEDEAR. Local (.BA) and US prices are fetched in one
+        batched download. Returns a DataFrame with Symbol, prices, ratio and implied_ccl.
+        """
+        import pandas as pd
+
+        market = market or MarketData()
+        symbols = [s for s in symbols if s]
+        cedears = [s for s in dict.fromkeys(symbols) if to_news_symbol(s) in self.ratios]
+        if not cedears:
+            return pd.DataFrame(columns=['Symbol', 'local_price', 'us_price', 'ratio', 'implied_ccl'])
+        local = [to_yahoo_symbol(s) for s in cedears]
+        us = [to_news_symbol(s) for s in cedears]
+        closes = market.get_closes(self.price_symbols(symbols))
+        df = pd.DataFrame({
+            'Symbol': cedears,
+            'local_price': [closes.get(s) for s in local],
+            'us_price': [closes.get(s) for s in us],
+        })
+        df[['local_price', 'us_price']] = df[['local_price', 'us_price']].astype(float)
+        return self.implied_ccl(df)
+
+    def get_context(self, symbols=None, market=None):
+        """
+        Rates and per-CEDEAR implied CCL formatted as market context entries
+        ({label: value}) for the AI prompt.
+        """
+        context = {}
+        for kind, rate in self.get_rates().items():
+            if rate:
+                context[FX_LABELS[kind]] = rate
+        if symbols:
+            context.update(self.get_ccl_context(symbols, market=market))
+        return context
+
+    def get_ccl_context(self, symbols, market=None):
+        """Implied CCL of each held CEDEAR as market context entries."""
+        ccl = self.get_cedear_ccl(symbols, market=market)
+        return {
+            f"CCL implícito {to_news_symbol(row.Symbol)}": row.implied_ccl
+            for row in ccl.dropna(subset=['implied_ccl']).itertuples()
+        }
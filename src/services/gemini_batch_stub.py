@@ -0,0 +1,160 @@
+"""
+Local stand-in for the Gemini endpoints used by the nightly batch, so the
+pipeline can be exercised offline:
+
+    python -m src.services.gemini_batch_stub --port 8089 --delay 5
+    GEMINI_API_BASE=http://localhost:8089 python -m src.services.batch_analysis run
+
+Implements the model list, countTokens, the resumable Files upload,
+batchGenerateContent, batch status and result download. Batches succeed
+`delay` seconds after creation with a canned answer per request.
+"""
+import re
+import json
+import time
+import argparse
+import itertools
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+MODEL = "models/gemini-2.5-flash"
+
+class StubState:
+    def __init__(self, delay):
+        self.delay = delay
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.uploads = {}   # upload id -> display name
+        self.files = {}     # files/N -> bytes
+        self.batches = {}   # batches/N -> dict
+
+    def next_id(self):
+        with self.lock:
+            return next(self.ids)
+
+def _answer(key, request):
+    text = request["contents"][0]["parts"][0]["text"]
+    holdings = [line for line in text.splitlines() if line.startswith("| ") and not line.startswith("| Símbolo")]
+    return (
+        f"### Informe nocturno (stub)\n\n"
+        f"Solicitud `{key}` procesada offline con {len(holdings)} posiciones.\n\n"
+        f"| Ticker | Acción (Compra/Venta) | Cantidad | Precio Límite (ARS) | Monto Total (ARS) | Fundamento Corto |\n"
+        f"|---|---|---|---|---|---|\n"
+        f"| SPY | Compra | 1 | $1.00 | $1.00 | Respuesta de prueba |\n"
+    )
+
+class StubHandler(BaseHTTPRequestHandler):
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _json(self, body, status=200, headers=None):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/v1beta/models":
+            return self._json({"models": [{
+                "name": MODEL,
+                "supportedGenerationMethods": ["generateContent", "countTokens", "batchGenerateContent"],
+            }]})
+        match = re.fullmatch(r"/v1beta/(batches/\d+)", path)
+        if match and match.group(1) in self.state.batches:
+            batch = self.state.batches[match.group(1)]
+            done = time.time() - batch["created_at"] >= self.state.delay
+            body = {
+                "name": batch["name"],
+                "metadata": {"state": "BATCH_STATE_SUCCEEDED" if done else "BATCH_STATE_RUNNING"},
+                "done": done,
+            }
+            if done:
+                body["response"] = {"responsesFile": batch["output"]}
+            return self._json(body)
+        match = re.fullmatch(r"/download/v1beta/(files/[\w-]+):download", path)
+        if match and match.group(1) in self.state.files:
+            payload = self.state.files[match.group(1)]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/jsonl")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        self._json({"error": {"code": 404, "message": f"Not found: {path}"}}, 404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        path = url.path
+        body = self._body()
+
+        if path == "/upload/v1beta/files" and self.headers.get("X-Goog-Upload-Command") == "start":
+            upload_id = self.state.next_id()
+            self.state.uploads[upload_id] = json.loads(body or b"{}")
+            host = self.headers.get("Host")
+            return self._json({}, headers={
+                "X-Goog-Upload-URL": f"http://{host}/upload/v1beta/files?upload_id={upload_id}"
+            })
+        if path == "/upload/v1beta/files" and "upload_id=" in url.query:
+            name = f"files/{self.state.next_id()}"
+            self.state.files[name] = body
+            return self._json({"file": {"name": name, "mimeType": "application/jsonl"}})
+
+        if path.endswith(":countTokens"):
+            request = json.loads(body or b"{}")
+            text = "".join(
+                part.get("text", "")
+                for content in request.get("contents", [])
+                for part in content.get("parts", [])
+            )
+            return self._json({"totalTokens": len(text) // 4})
+
+        if path.endswith(":batchGenerateContent"):
+            request = json.loads(body or b"{}")
+            file_name = request["batch"]["input_config"]["file_name"]
+            if file_name not in self.state.files:
+                return self._json({"error": {"code": 400, "message": "Unknown input file"}}, 400)
+            lines = []
+            for line in self.state.files[file_name].decode("utf-8").splitlines():
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                lines.append(json.dumps({
+                    "key": item["key"],
+                    "response": {"candidates": [{"content": {"parts": [{"text": _answer(item["key"], item["request"])}]}}]},
+                }))
+            output = f"files/{self.state.next_id()}-out"
+            self.state.files[output] = "\n".join(lines).encode("utf-8")
+            name = f"batches/{self.state.next_id()}"
+            self.state.batches[name] = {"name": name, "created_at": time.time(), "output": output}
+            return self._json({"name": name, "metadata": {"state": "BATCH_STATE_PENDING"}})
+
+        self._json({"error": {"code": 404, "message": f"Not found: {path}"}}, 404)
+
+def serve(port=8089, delay=5.0):
+    """Starts the stand-in server (blocking)."""
+    StubHandler.state = StubState(delay)
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubHandler)
+    print(f"Gemini batch stub listening on http://127.0.0.1:{port} (delay {delay}s)")
+    server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline stand-in for the Gemini batch API.")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--delay", type=float, default=5.0, help="seconds until a batch succeeds")
+    args = parser.parse_args()
+    serve(args.port, args.delay)
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,23 @@ from datetime import datetime
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
+def parse_portfolio(raw_portfolio):
+    """Flattens a /portafolio response into the dashboard's asset rows."""
+    portfolio_data = []
+    if not isinstance(raw_portfolio, dict):
+        return portfolio_data
+    for asset in raw_portfolio.get('activos') or []:
+        titulo = asset.get('titulo', {})
+        portfolio_data.append({
+            "Symbol": titulo.get('simbolo', 'N/A'),
+            "Description": titulo.get('descripcion', ''),
+            "Quantity": asset.get('cantidad', 0),
+            "Last Price": asset.get('ultimoPrecio', 0.0),
+            "Total Value": asset.get('valorizado', 0.0),
+            "Daily Var %": asset.get('variacionDiaria', 0.0)
+        })
+    return portfolio_data
+
 class IOLClient:
     def __init__(self, username, password, base_url="https://api.invertironline.com", timeout=10):
         self.username = username
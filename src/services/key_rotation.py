@@ -0,0 +1,141 @@
+import sys
+import time
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptography.fernet import InvalidToken
+
+from ..data.auth_manager import AuthManager
+from ..data.batch_store import BatchStore
+from ..settings import get_settings
+
+def key_id(key):
+    """Short fingerprint of a Fernet key (progress is tracked per primary key)."""
+    return hashlib.sha256(key.encode()).hexdigest()[:12]
+
+def rotate_token(auth, token):
+    """
+    Token re-encrypted with the primary key, or None if it already uses it.
+    Raises InvalidToken if no configured key can read it.
+    """
+    try:
+        auth.primary.decrypt(token.encode())
+        return None
+    except InvalidToken:
+        return auth.cipher.rotate(token.encode()).decode()
+
+def rotate_row(auth, row):
+    """
+    Re-encrypts one user's tokens with the primary key. Returns
+    (updates, skipped, failed): tokens already under the primary key are
+    skipped, tokens no configured key can read are reported as failed.
+    """
+    rowid, username, tokens = row
+    updates, skipped, failed = [], 0, 0
+    for column, token in tokens.items():
+        if not token:
+            continue
+        try:
+            new = rotate_token(auth, token)
+        except InvalidToken:
+            logging.warning(f"Key rotation: {username}.{column} can't be decrypted with any configured key.")
+            failed += 1
+            continue
+        if new is None:
+            skipped += 1
+        else:
+            updates.append((column, new, rowid, token))
+    return updates, skipped, failed
+
+def rotate_batch_keys(auth, store):
+    """
+    Re-encrypts the Gemini keys stored with nightly batches (ai_batches), so
+    pending batches can still be imported once the old key is removed.
+    Returns (rotated, failed).
+    """
+    updates, failed = [], 0
+    for name, token in store.get_api_keys():
+        try:
+            new = rotate_token(auth, token)
+        except InvalidToken:
+            logging.warning(f"Key rotation: API key of batch {name} can't be decrypted with any configured key.")
+            failed += 1
+            continue
+        if new is not None:
+            updates.append((name, new, token))
+    return store.replace_api_keys(updates), failed
+
+def rotate_keys(batch_size=None, workers=None, auth=None, store=None):
+    """
+    Online rotation to the primary ENCRYPTION_KEY: users are read in rowid
+    order in batches of `batch_size`, re-encrypted on a pool of `workers`
+    threads and written back in one short transaction per batch together
+    with the progress, so the app keeps running and an interrupted run
+    resumes after the last written batch. The API keys of nightly batches
+    are re-encrypted at the end of the pass. Returns the progress row.
+    """
+    settings = get_settings()
+    batch_size = batch_size or settings.KEY_ROTATION_BATCH
+    workers = workers or settings.KEY_ROTATION_WORKERS
+    auth = auth or AuthManager()
+    store = store or BatchStore(db_path=auth.db_path)
+
+    if len(auth.keys) < 2:
+        logging.info("Key rotation: only one key in ENCRYPTION_KEY, nothing to rotate.")
+        return None
+
+    current = key_id(auth.keys[0])
+    progress = auth.get_rotation_progress(current) or {"last_rowid": 0, "finished_at": None}
+    if progress["finished_at"]:
+        if progress["failed"]:
+            logging.warning(f"Key rotation to {current} already finished with {progress['failed']} failed token(s).")
+        else:
+            logging.info(f"Key rotation to {current} already finished; the old keys can be removed.")
+        return progress
+    if progress["last_rowid"]:
+        logging.info(f"Key rotation to {current}: resuming after rowid {progress['last_rowid']}.")
+
+    last_rowid = progress["last_rowid"]
+    started = time.monotonic()
+    values = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rotate") as executor:
+        while True:
+            rows = auth.get_encrypted_batch(last_rowid, batch_size)
+            if not rows:
+                # Users done: the batch keys are few, one transaction is enough
+                rotated, failed = rotate_batch_keys(auth, store)
+                logging.info(f"Key rotation: {rotated} batch API key(s) rotated.")
+                auth.save_rotated_batch(current, last_rowid, [], failed=failed, finished=True)
+                break
+            updates, skipped, failed = [], 0, 0
+            for row_updates, row_skipped, row_failed in executor.map(lambda row: rotate_row(auth, row), rows):
+                updates.extend(row_updates)
+                skipped += row_skipped
+                failed += row_failed
+            last_rowid = rows[-1][0]
+            rotated = auth.save_rotated_batch(current, last_rowid, updates, skipped=skipped, failed=failed)
+            values += len(updates) + skipped + failed
+            elapsed = time.monotonic() - started
+            logging.info(
+                f"Key rotation: {len(rows)} user(s) up to rowid {last_rowid}, {rotated} token(s) rotated "
+                f"({values / elapsed if elapsed else 0:.0f} tokens/s)."
+            )
+
+    progress = auth.get_rotation_progress(current)
+    elapsed = time.monotonic() - started
+    logging.info(
+        f"Key rotation to {current} finished in {elapsed:.1f}s: {progress['rotated']} rotated, "
+        f"{progress['skipped']} already current, {progress['failed']} failed."
+    )
+    if progress["failed"]:
+        logging.warning("Some tokens could not be decrypted; keep the old keys until they are fixed.")
+    return progress
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[logging.StreamHandler(sys.stdout)]
+    )
+    rotate_keys()
@@ -0,0 +1,154 @@
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+MARKET_TZ = ZoneInfo("America/Argentina/Buenos_Aires")
+
+# National holidays with a fixed date (month, day)
+FIXED_HOLIDAYS = [
+    (1, 1),    # Año Nuevo
+    (3, 24),   # Día de la Memoria
+    (4, 2),    # Malvinas
+    (5, 1),    # Día del Trabajador
+    (5, 25),   # Revolución de Mayo
+    (6, 20),   # Belgrano
+    (7, 9),    # Independencia
+    (12, 8),   # Inmaculada Concepción
+    (12, 25),  # Navidad
+]
+
+# Movable holidays (Ley 27.399): Tuesday/Wednesday move to the previous
+# Monday, Thursday/Friday to the following Monday. A move that would land
+# on a fixed holiday is dropped (Güemes on a Friday stays, as the next
+# Monday is already Belgrano's 20 June)
+MOVABLE_HOLIDAYS = [
+    (6, 17),   # Güemes
+    (8, 17),   # San Martín
+    (10, 12),  # Diversidad Cultural
+    (11, 20),  # Soberanía Nacional
+]
+
+# Days relative to Easter Sunday: Carnival Monday/Tuesday, Holy Thursday, Good Friday
+EASTER_OFFSETS = [-48, -47, -3, -2]
+
+def easter_sunday(year):
+    """Gregorian Easter Sunday (anonymous algorithm)."""
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return date(year, month, day + 1)
+
+def _moved(day):
+    weekday = day.weekday()
+    if weekday in (1, 2):
+        return day - timedelta(days=weekday)
+    if weekday in (3, 4):
+        return day + timedelta(days=7 - weekday)
+    return day
+
+@lru_cache(maxsize=16)
+def national_holidays(year):
+    """Argentine national holidays of `year` on which BYMA does not trade."""
+    fixed = {date(year, month, day) for month, day in FIXED_HOLIDAYS}
+    days = set(fixed)
+    for month, day in MOVABLE_HOLIDAYS:
+        moved = _moved(date(year, month, day))
+        days.add(moved if moved not in fixed else date(year, month, day))
+    easter = easter_sunday(year)
+    days.update(easter + timedelta(days=offset) for offset in EASTER_OFFSETS)
+    return frozenset(days)
+
+def _parse_time(value):
+    hours, minutes = value.split(":")
+    return time(int(hours), int(minutes))
+
+def parse_dates(value):
+    """Comma-separated YYYY-MM-DD list (e.g. from settings) as a set of dates."""
+    return {date.fromisoformat(item.strip()) for item in (value or "").split(",") if item.strip()}
+
+class MarketCalendar:
+    """
+    BYMA trading calendar: weekdays that are not national holidays, with a
+    continuous session between open_time and close_time (Buenos Aires time).
+    Bridge days and other decreed closures go in extra_holidays.
+    """
+
+    def __init__(self, open_time="11:00", close_time="17:00", extra_holidays=(), tz=MARKET_TZ):
+        self.open_time = _parse_time(open_time)
+        self.close_time = _parse_time(close_time)
+        self.extra_holidays = set(extra_holidays)
+        self.tz = tz
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            open_time=settings.MARKET_OPEN,
+            close_time=settings.MARKET_CLOSE,
+            extra_holidays=parse_dates(settings.MARKET_EXTRA_HOLIDAYS),
+        )
+
+    def now(self):
+        return datetime.now(self.tz)
+
+    def is_trading_day(self, day):
+        return (
+            day.weekday() < 5
+            and day not in national_holidays(day.year)
+            and day not in self.extra_holidays
+        )
+
+    def session(self, day):
+        """(open, close) of `day` as aware datetimes."""
+        return (
+            datetime.combine(day, self.open_time, tzinfo=self.tz),
+            datetime.combine(day, self.close_time, tzinfo=self.tz),
+        )
+
+    def is_open(self, when=None):
+        when = (when or self.now()).astimezone(self.tz)
+        if not self.is_trading_day(when.date()):
+            return False
+        open_at, close_at = self.session(when.date())
+        return open_at <= when < close_at
+
+    def next_trading_day(self, day):
+        """First trading day strictly after `day`."""
+        day += timedelta(days=1)
+        while not self.is_trading_day(day):
+            day += timedelta(days=1)
+        return day
+
+    def next_open(self, when=None):
+        """Start of the next session that has not opened yet."""
+        when = (when or self.now()).astimezone(self.tz)
+        day = when.date()
+        if self.is_trading_day(day) and when < self.session(day)[0]:
+            return self.session(day)[0]
+        return self.session(self.next_trading_day(day))[0]
+
+    def next_update(self, when=None, interval_minutes=15, settlement_delay_minutes=30):
+        """
+        When the next portfolio refresh is due after `when`: every
+        interval_minutes during the session, once at close +
+        settlement_delay_minutes, then at the next open.
+        """
+        when = (when or self.now()).astimezone(self.tz)
+        day = when.date()
+        if self.is_trading_day(day):
+            open_at, close_at = self.session(day)
+            settlement = close_at + timedelta(minutes=settlement_delay_minutes)
+            if when < open_at:
+                return open_at
+            if when < close_at:
+                following = when + timedelta(minutes=interval_minutes)
+                return following if following < close_at else settlement
+            if when < settlement:
+                return settlement
+        return self.next_open(when)
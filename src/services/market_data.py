@@ -1,25 +1,139 @@
-import yfinance as yf
-import pandas as pd
-import streamlit as st
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import time
+
+from ..data.cache_store import disk_cache
+from ..data.news_store import NewsStore, normalize_title
+
+def _download_closes(tickers, start=None, end=None):
+    """
+    Downloads daily closes for all tickers in a single batched request (the
+    last 5 days, or start..end). Returns a frame indexed by date with one
+    column per ticker.
+    """
+    import pandas as pd
+    import yfinance as yf
+
+    window = {"start": start, "end": end} if start else {"period": "5d"}
+    frame = yf.download(
+        list(tickers),
+        **window,
+        interval="1d",
+        group_by="column",
+        auto_adjust=False,
+        threads=True,
+        progress=False,
+    )
+    if frame is None or frame.empty:
+        return pd.DataFrame(columns=list(tickers))
+    closes = frame["Close"]
+    if isinstance(closes, pd.Series):
+        closes = closes.to_frame(name=tickers[0])
+    return closes.reindex(columns=list(tickers))
+
+@disk_cache(ttl=300)
+def _fetch_closes(tickers):
+    return _download_closes(tickers)
+
+def _last_closes(closes):
+    """Maps each ticker column to its last non-null close (or None)."""
+    result = {}
+    for ticker in closes.columns:
+        series = closes[ticker].dropna()
+        result[ticker] = float(series.iloc[-1]) if not series.empty else None
+    return result
+
+def to_yahoo_symbol(symbol):
+    """Maps an IOL/BYMA ticker (e.g. GGAL) to its Yahoo Finance symbol (GGAL.BA)."""
+    symbol = (symbol or "").strip().upper()
+    if not symbol or "." in symbol or "-" in symbol:
+        return symbol
+    return f"{symbol}.BA"
 
-@st.cache_data(ttl=300, show_spinner=False)
 def _fetch_last_close(ticker):
-    t = yf.Ticker(ticker)
-    hist = t.history(period="1d")
-    if not hist.empty:
-        return float(hist['Close'].iloc[-1])
-    return None
+    return _last_closes(_fetch_closes((ticker,))).get(ticker)
+
+def _parse_timestamp(value):
+    """Converts epoch seconds or ISO-8601 strings to epoch seconds (0 if unknown)."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str) and value:
+        try:
+            return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+        except ValueError:
+            return 0.0
+    return 0.0
 
-@st.cache_data(ttl=600, show_spinner=False)
+def _normalize_news_item(item):
+    """Flattens both the legacy and the current ('content') yfinance news formats."""
+    content = item.get('content') or item
+    link = item.get('link') or ''
+    if not link:
+        for key in ('canonicalUrl', 'clickThroughUrl'):
+            url = (content.get(key) or {}).get('url')
+            if url:
+                link = url
+                break
+    provider = content.get('provider') or {}
+    related = item.get('relatedTickers') or [
+        t.get('symbol') for t in (content.get('finance') or {}).get('stockTickers') or []
+    ]
+    return {
+        "title": content.get('title') or 'No Title',
+        "link": link,
+        "publisher": item.get('publisher') or provider.get('displayName', ''),
+        "published": _parse_timestamp(item.get('providerPublishTime') or content.get('pubDate')),
+        "related": [t for t in related if t],
+    }
+
+@disk_cache(ttl=600)
 def _fetch_news(symbol):
+    import yfinance as yf
+
     t = yf.Ticker(symbol)
     news = t.news or []
-    result = []
-    for item in news[:2]:
-        title = item.get('title', 'No Title')
-        link = item.get('link', '')
-        result.append({"title": title, "link": link})
-    return result
+    return [_normalize_news_item(item) for item in news]
+
+def to_news_symbol(symbol):
+    """Maps a held symbol to the ticker Yahoo publishes news under (SPY.BA -> SPY)."""
+    symbol = (symbol or "").strip().upper()
+    if symbol.endswith(".BA"):
+        symbol = symbol[:-3]
+    return symbol
+
+def rank_news(fetched, weights, macro_symbols=(), macro_weight=0.05):
+    """
+    Merges per-symbol news into unique stories (by URL or normalized title) and
+    sorts them by the summed portfolio weight of the symbols they mention,
+    newest first on ties. Macro-only stories get a small baseline weight.
+    """
+    stories = []
+    by_key = {}
+    for symbol, items in fetched.items():
+        for item in items:
+            keys = [k for k in (item.get('link'), normalize_title(item.get('title'))) if k]
+            story = next((by_key[k] for k in keys if k in by_key), None)
+            if story is None:
+                story = dict(item, symbols=[])
+                stories.append(story)
+            for k in keys:
+                by_key[k] = story
+            mentioned = [symbol] + [to_news_symbol(t) for t in item.get('related', [])]
+            for s in mentioned:
+                if s not in story['symbols']:
+                    story['symbols'].append(s)
+
+    for story in stories:
+        score = sum(weights.get(s, 0.0) for s in story['symbols'])
+        if any(s in macro_symbols for s in story['symbols']):
+            score += macro_weight
+        story['score'] = score
+    stories.sort(key=lambda story: (story['score'], story.get('published', 0)), reverse=True)
+    return stories
+
+def format_news_item(story):
+    symbols = ", ".join(story['symbols'])
+    return f"- [{symbols}] {story['title']} ({story['link']})"
 
 class MarketData:
     def __init__(self):
@@ -29,24 +143,83 @@ class MarketData:
             "MELI.BA": "MercadoLibre CEDEAR",
             "GGAL.BA": "Grupo Galicia"
         }
+        # Macro tickers always included in the news feed (US market, Argentina, crypto)
+        self.macro_news_symbols = ["SPY", "ARGT", "BTC-USD"]
+        # Stored headlines younger than this (seconds) are served without refetching
+        self.news_max_age = 1800
+        self._closes = {}
+        self.news_store = NewsStore()
+
+    def _closes_key(self, symbols=None):
+        tickers = set(self.tickers)
+        tickers.update(symbol for symbol in symbols or [] if symbol)
+        # Sorted tuple so the same set of tickers always hits the same cache entry
+        return tuple(sorted(tickers))
+
+    def get_closes(self, symbols=None):
+        """
+        Fetches the context tickers plus any extra symbols (e.g. held assets)
+        in one batched download. Returns a {ticker: last_close} dict.
+        """
+        key = self._closes_key(symbols)
+        try:
+            closes = _last_closes(_fetch_closes(key))
+        except Exception as e:
+            print(f"Error fetching prices for {', '.join(key)}: {e}")
+            return {ticker: None for ticker in key}
+        self._closes.update(closes)
+        return closes
 
-    def get_global_context(self):
+    def warm_closes(self, symbol_sets):
+        """
+        Downloads the union of several symbol sets in one request and primes the
+        cache entry each set would use, so later get_closes calls are warm.
+        """
+        keys = {self._closes_key(None)}
+        keys.update(self._closes_key(symbols) for symbols in symbol_sets)
+        union = tuple(sorted(set().union(*keys)))
+        frame = _download_closes(union)
+        for key in keys:
+            _fetch_closes.prime(frame.reindex(columns=list(key)), key)
+        return len(union)
+
+    def get_historical_closes(self, symbols, start, end=None):
+        """
+        Daily closes of IOL symbols between start and end (dates), fetched in
+        one batched download. Returns a frame indexed by 'YYYY-MM-DD' with one
+        column per IOL symbol (empty frame on failure).
+        """
+        import pandas as pd
+
+        symbols = sorted({symbol for symbol in symbols if symbol})
+        if not symbols:
+            return pd.DataFrame()
+        tickers = {symbol: to_yahoo_symbol(symbol) for symbol in symbols}
+        # yfinance treats `end` as exclusive
+        end = (end or datetime.now().date()) + timedelta(days=1)
+        try:
+            closes = _download_closes(tuple(sorted(set(tickers.values()))), start=start, end=end)
+        except Exception as e:
+            print(f"Error fetching historical prices for {', '.join(symbols)}: {e}")
+            return pd.DataFrame()
+        frame = pd.DataFrame({symbol: closes[ticker] for symbol, ticker in tickers.items()})
+        frame.index = pd.to_datetime(frame.index).strftime("%Y-%m-%d")
+        return frame
+
+    def get_global_context(self, symbols=None):
         """
         Fetches prices for key global assets to give context.
+        Extra symbols are fetched in the same request and shared via the cache.
         """
-        data = {}
-        for ticker in self.tickers:
-            try:
-                data[ticker] = _fetch_last_close(ticker)
-            except Exception as e:
-                print(f"Error fetching {ticker}: {e}")
-                data[ticker] = None
-        return data
+        closes = self.get_closes(symbols)
+        return {ticker: closes.get(ticker) for ticker in self.tickers}
 
     def get_asset_price(self, symbol):
         """
         Fetches current price for a specific asset.
         """
+        if self._closes.get(symbol) is not None:
+            return self._closes[symbol]
         try:
             price = _fetch_last_close(symbol)
             if price is not None:
@@ -55,22 +228,65 @@ class MarketData:
             print(f"Error fetching price for {symbol}: {e}")
         return 0.0
 
-    def get_market_news(self):
-        """
-        Fetches recent news for key tickers to provide context.
-        """
-        news_summary = []
-        # Key symbols to check for news (US and Argentina context)
-        key_symbols = ["SPY", "MELI", "GGAL", "BTC-USD"]
-        
-        for symbol in key_symbols:
-            try:
-                items = _fetch_news(symbol)
-                for item in items:
-                    title = item.get('title', 'No Title')
-                    link = item.get('link', '')
-                    news_summary.append(f"- [{symbol}] {title} ({link})")
-            except Exception as e:
-                print(f"Error fetching news for {symbol}: {e}")
-                
-        return news_summary
+    def _news_weights(self, portfolio_data):
+        """Maps news symbols (underlying tickers) to their portfolio weight."""
+        total = sum(item.get('Total Value', 0) or 0 for item in portfolio_data or [])
+        weights = {}
+        for item in portfolio_data or []:
+            symbol = to_news_symbol(item.get('Symbol'))
+            if not symbol:
+                continue
+            weight = (item.get('Total Value', 0) or 0) / total if total > 0 else 0.0
+            weights[symbol] = weights.get(symbol, 0.0) + weight
+        return weights
+
+    def get_recent_news(self, symbols, hours=24, weights=None):
+        """
+        Serves stories for these symbols from the local news store, merged
+        across symbols and ranked (by portfolio weight when given, else recency).
+        """
+        fetched = self.news_store.get_news_by_symbol(symbols, hours=hours)
+        return rank_news(fetched, weights or {}, self.macro_news_symbols)
+
+    def refresh_news(self, symbols, max_age=None):
+        """
+        Fetches the latest headlines for symbols in parallel and stores the ones
+        newer than what was already seen. Symbols fetched less than max_age
+        seconds ago are skipped. Returns the number of new stories.
+        """
+        symbols = list(symbols)
+        if max_age is not None:
+            fetched_at = self.news_store.get_fetch_times(symbols)
+            cutoff = time.time() - max_age
+            symbols = [s for s in symbols if fetched_at.get(s, 0) < cutoff]
+        if not symbols:
+            return 0
+        added = 0
+        with ThreadPoolExecutor(max_workers=min(8, len(symbols))) as pool:
+            futures = {symbol: pool.submit(_fetch_news, symbol) for symbol in symbols}
+            for symbol, future in futures.items():
+                try:
+                    added += self.news_store.add_items(symbol, future.result() or [])
+                except Exception as e:
+                    print(f"Error fetching news for {symbol}: {e}")
+        return added
+
+    def get_market_news(self, portfolio_data=None, top_k=10, hours=48):
+        """
+        Fetches recent news for the user's holdings plus macro tickers in parallel,
+        deduplicates stories across symbols and returns the top_k ranked by the
+        portfolio weight of the symbols each story mentions.
+        """
+        weights = self._news_weights(portfolio_data)
+        symbols = list(weights)
+        for symbol in self.macro_news_symbols:
+            if symbol not in symbols:
+                symbols.append(symbol)
+
+        self.refresh_news(symbols, max_age=self.news_max_age)
+        try:
+            stories = self.get_recent_news(symbols, hours=hours, weights=weights)
+        except Exception as e:
+            print(f"Error reading stored news: {e}")
+            stories = []
+        return [format_news_item(story) for story in stories[:top_k]]
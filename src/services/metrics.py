@@ -0,0 +1,202 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 900)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels, lock):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._lock = lock
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self):
+        lines = self._header()
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels, lock):
+        super().__init__(name, help_text, labels, lock)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def set_function(self, function):
+        """Computes the (unlabelled) value at scrape time; None hides the sample."""
+        self._function = function
+
+    def render(self):
+        lines = self._header()
+        if self._function is not None:
+            value = self._function()
+            if value is not None:
+                lines.append(f"{self.name} {_format_value(value)}")
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels, lock, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels, lock)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = self._header()
+        for key, (counts, total) in sorted(self._values.items()):
+            for bound, count in zip(self.buckets, counts):
+                le = (("le", _format_value(bound)),)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {counts[-1]}")
+        return lines
+
+class Registry:
+    """Process-wide metrics rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self._add(Counter(name, help_text, labels, self._lock))
+
+    def gauge(self, name, help_text, labels=()):
+        return self._add(Gauge(name, help_text, labels, self._lock))
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help_text, labels, self._lock, buckets))
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for metric in self._metrics:
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+JOB_DURATION = REGISTRY.histogram(
+    "inver_job_duration_seconds", "Duration of scheduler jobs.", ["job"])
+JOB_RUNS = REGISTRY.counter(
+    "inver_job_runs_total", "Scheduler job runs by outcome.", ["job", "outcome"])
+REFRESH_PHASE = REGISTRY.histogram(
+    "inver_refresh_phase_seconds", "Portfolio refresh time per phase (fetch and parse per user, write per chunk).",
+    ["phase"], buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60))
+REFRESH_USERS = REGISTRY.counter(
+    "inver_refresh_users_total", "Per-user portfolio refreshes by outcome.", ["outcome"])
+ROWS_WRITTEN = REGISTRY.counter(
+    "inver_rows_written_total", "Snapshot rows written.", ["table"])
+LAST_SNAPSHOT = REGISTRY.gauge(
+    "inver_last_snapshot_timestamp_seconds", "Unix time of the last successful snapshot per user.", ["user_id"])
+LAST_SNAPSHOT_AGE = REGISTRY.gauge(
+    "inver_last_snapshot_age_seconds", "Seconds since the most recent successful snapshot written by this process.")
+UPDATE_INTERVAL = REGISTRY.gauge(
+    "inver_update_interval_seconds", "Configured in-session refresh interval.")
+NEXT_UPDATE = REGISTRY.gauge(
+    "inver_next_update_timestamp_seconds", "Unix time of the next scheduled portfolio refresh.")
+
+def _last_snapshot_age():
+    latest = max(LAST_SNAPSHOT._values.values(), default=None)
+    return None if latest is None else time.time() - latest
+
+LAST_SNAPSHOT_AGE.set_function(_last_snapshot_age)
+
+@contextmanager
+def track_job(job):
+    """Times a job and counts it as ok or failed (exceptions propagate)."""
+    with JOB_DURATION.time(job=job):
+        try:
+            yield
+        except Exception:
+            JOB_RUNS.inc(job=job, outcome="failed")
+            raise
+    JOB_RUNS.inc(job=job, outcome="ok")
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port, host="0.0.0.0"):
+    """Serves /metrics on a daemon thread. Returns the server."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"Metrics available on http://{host}:{port}/metrics")
+    return server
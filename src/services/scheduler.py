@@ -1,8 +1,16 @@
 import time
 import schedule
+from datetime import datetime, timedelta
 import logging
 import sys
-from .cron_update import run_update
+from .cron_update import run_update, replica_id
+from .cache_warmer import warm_caches
+from .batch_analysis import submit_nightly_batches, poll_batches
+from .market_calendar import MarketCalendar
+from .backfill import backfill_gaps
+from .metrics import track_job, start_metrics_server, UPDATE_INTERVAL, NEXT_UPDATE
+from ..data.lease_store import LeaseStore, LEADER_LEASE
+from ..settings import get_settings
 
 # Setup logging
 logging.basicConfig(
@@ -14,33 +22,165 @@ logging.basicConfig(
     ]
 )
 
+BATCH_POLL_MINUTES = 15
+WARM_INTERVAL_MINUTES = 60
+# Upper bound on a single sleep, so clock changes are picked up
+MAX_SLEEP_SECONDS = 3600
+
+_last_warm = 0.0
+_leases = None
+HOLDER = replica_id()
+
+def is_leader():
+    """
+    Takes or renews the leader lease. Portfolio refreshes are split between
+    replicas; warm-ups and batch jobs run only on the leader.
+    """
+    global _leases
+    try:
+        if _leases is None:
+            _leases = LeaseStore()
+        return _leases.try_acquire(LEADER_LEASE, HOLDER, get_settings().SCHEDULER_LEASE_SECONDS)
+    except Exception as e:
+        logging.error(f"Leader lease check failed: {e}")
+        return False
+
 def job():
     logging.info("Starting scheduled update job...")
     try:
-        run_update()
+        with track_job("update"):
+            # run_update logs its own errors; a failed cycle still counts as failed
+            if not run_update(holder=HOLDER):
+                raise RuntimeError("portfolio update failed")
         logging.info("Scheduled update job completed.")
     except Exception as e:
         logging.error(f"Job failed: {e}")
+    # Session refreshes are more frequent than the caches need
+    if time.time() - _last_warm >= WARM_INTERVAL_MINUTES * 60 and is_leader():
+        warm_job()
+
+def warm_job():
+    global _last_warm
+    try:
+        with track_job("warm"):
+            warm_caches()
+        _last_warm = time.time()
+        logging.info("Cache warm-up completed.")
+    except Exception as e:
+        logging.error(f"Cache warm-up failed: {e}")
+
+def backfill_job(calendar):
+    try:
+        with track_job("backfill"):
+            written = backfill_gaps(calendar=calendar)
+        logging.info(f"Backfill completed ({written} day(s) reconstructed).")
+    except Exception as e:
+        logging.error(f"Backfill failed: {e}")
+
+def pre_market_job(calendar):
+    # Only on BYMA trading days (weekends and holidays are skipped)
+    if not calendar.is_trading_day(calendar.now().date()) or not is_leader():
+        return
+    # Fill any day the refresh missed (e.g. the scheduler was down)
+    backfill_job(calendar)
+    logging.info("Running pre-market cache warm-up...")
+    warm_job()
+
+def batch_submit_job():
+    if not is_leader():
+        return
+    logging.info("Submitting nightly batch analyses...")
+    try:
+        with track_job("batch_submit"):
+            created = submit_nightly_batches()
+        logging.info(f"Nightly batch: {len(created)} batch(es) submitted.")
+    except Exception as e:
+        logging.error(f"Nightly batch submission failed: {e}")
+
+def batch_poll_job():
+    if not is_leader():
+        return
+    try:
+        with track_job("batch_poll"):
+            poll_batches()
+    except Exception as e:
+        logging.error(f"Batch polling failed: {e}")
+
+def pre_market_time(settings):
+    """HH:MM of the pre-market warm-up: MARKET_OPEN minus PRE_MARKET_WARMUP_MINUTES."""
+    open_at = datetime.strptime(settings.MARKET_OPEN, "%H:%M")
+    return (open_at - timedelta(minutes=settings.PRE_MARKET_WARMUP_MINUTES)).strftime("%H:%M")
+
+def next_update(calendar, settings):
+    return calendar.next_update(
+        calendar.now(),
+        interval_minutes=settings.MARKET_POLL_MINUTES,
+        settlement_delay_minutes=settings.MARKET_SETTLEMENT_DELAY_MINUTES,
+    )
 
 def main():
+    settings = get_settings()
+    calendar = MarketCalendar.from_settings(settings)
+
+    if settings.METRICS_PORT:
+        try:
+            start_metrics_server(settings.METRICS_PORT)
+        except OSError as e:
+            logging.error(f"Could not start the metrics endpoint: {e}")
+    UPDATE_INTERVAL.set(settings.MARKET_POLL_MINUTES * 60)
+
     # Run once on startup to ensure we have data even if machine shuts down soon
-    logging.info("Scheduler started. Running initial update...")
+    logging.info(f"Scheduler {HOLDER} started. Running initial update...")
     job()
-    
-    # Schedule the job every 60 minutes
-    # This ensures we capture the latest state throughout the day.
-    # Since save_daily_snapshot assumes one entry per day (UPSERT), 
-    # it will just update today's record with the latest value.
-    schedule.every(60).minutes.do(job)
-    
-    logging.info("Scheduler configured: Running every 60 minutes.")
-    
-    # Also print next run for verification
-    logging.info(f"Next run: {schedule.next_run()}")
-    
+    # Gaps usually follow downtime, so check right after (re)starting
+    if is_leader():
+        backfill_job(calendar)
+
+    # Portfolio refreshes follow the BYMA calendar: every MARKET_POLL_MINUTES
+    # during the session, one settlement run after the close, nothing on
+    # nights, weekends or holidays. The other jobs stay on `schedule`.
+    update_at = next_update(calendar, settings)
+
+    # Warm caches shortly before BYMA opens (container runs on Buenos Aires time)
+    warmup_time = pre_market_time(settings)
+    schedule.every().day.at(warmup_time).do(pre_market_job, calendar)
+
+    # Nightly Gemini batch for opted-in users; results are imported as they finish
+    batch_time = settings.BATCH_ANALYSIS_TIME
+    schedule.every().day.at(batch_time).do(batch_submit_job)
+    schedule.every(BATCH_POLL_MINUTES).minutes.do(batch_poll_job)
+
+    logging.info(
+        f"Scheduler configured: updates every {settings.MARKET_POLL_MINUTES} min during the "
+        f"{settings.MARKET_OPEN}-{settings.MARKET_CLOSE} session, warm-up at {warmup_time}, "
+        f"nightly batch at {batch_time}."
+    )
+    logging.info(f"Next update: {update_at:%Y-%m-%d %H:%M %Z}")
+    NEXT_UPDATE.set(update_at.timestamp())
+
+    # While a cycle is active, wake often enough to renew the leader lease
+    lease_seconds = settings.SCHEDULER_LEASE_SECONDS
+    renew_every = min(MAX_SLEEP_SECONDS, lease_seconds / 3)
+
     while True:
+        # Outside the session the lease is left to lapse: leader-only jobs
+        # take it again when they run, and the loop sleeps until the next event
+        active = calendar.is_open() or (update_at - calendar.now()).total_seconds() <= lease_seconds
+        if active:
+            is_leader()
+        if calendar.now() >= update_at:
+            job()
+            update_at = next_update(calendar, settings)
+            logging.info(f"Next update: {update_at:%Y-%m-%d %H:%M %Z}")
+            NEXT_UPDATE.set(update_at.timestamp())
         schedule.run_pending()
-        time.sleep(60)
+
+        # Sleep until whichever is due first instead of polling every minute
+        sleep_for = (update_at - calendar.now()).total_seconds()
+        idle = schedule.idle_seconds()
+        if idle is not None:
+            sleep_for = min(sleep_for, idle)
+        time.sleep(min(max(sleep_for, 1), renew_every if active else MAX_SLEEP_SECONDS))
 
 if __name__ == "__main__":
     # We need to install 'schedule' lib if not present, but better to add to requirements.txt
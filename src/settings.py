@@ -11,6 +11,8 @@ _ENV_PATH = Path(__file__).resolve().parents[1] / ".env"
 class Settings(BaseSettings):
     model_config = SettingsConfigDict(env_file=str(_ENV_PATH), env_file_encoding="utf-8")
 
+    # Comma-separated Fernet keys: the first encrypts, all of them decrypt.
+    # Rotate by prepending a new key and running python -m src.services.key_rotation
     ENCRYPTION_KEY: str = Field(..., min_length=1)
     COOKIE_KEY: str = Field(..., min_length=1)
 
@@ -20,6 +22,50 @@ class Settings(BaseSettings):
     IOL_API_URL: str = "https://api.invertironline.com"
     ADMIN_PASSWORD: Optional[str] = None
 
+    # Hourly portfolio refresh for every user with stored IOL credentials
+    IOL_REFRESH_WORKERS: int = 16
+    IOL_REFRESH_TIMEOUT: int = 20
+    IOL_REFRESH_CYCLE_TIMEOUT: int = 900
+    # Scheduler replicas: users are claimed in chunks of IOL_REFRESH_CLAIM_BATCH;
+    # leader lease and claims held by a dead replica expire after this many seconds
+    IOL_REFRESH_CLAIM_BATCH: int = 50
+    SCHEDULER_LEASE_SECONDS: int = 300
+    # Prometheus /metrics endpoint of the scheduler (0 disables)
+    METRICS_PORT: int = 9108
+
+    # BYMA trading calendar (Buenos Aires time). Refreshes run every
+    # MARKET_POLL_MINUTES during the session plus one settlement run after the
+    # close. MARKET_EXTRA_HOLIDAYS: comma-separated YYYY-MM-DD (bridge days).
+    MARKET_OPEN: str = "11:00"
+    MARKET_CLOSE: str = "17:00"
+    MARKET_POLL_MINUTES: int = 15
+    MARKET_SETTLEMENT_DELAY_MINUTES: int = 30
+    MARKET_EXTRA_HOLIDAYS: str = ""
+    # Caches are warmed (and gaps backfilled) this many minutes before MARKET_OPEN
+    PRE_MARKET_WARMUP_MINUTES: int = 15
+
+    # Online key rotation: users per write transaction and re-encryption threads
+    KEY_ROTATION_BATCH: int = 200
+    KEY_ROTATION_WORKERS: int = 4
+
+    # Background AI analysis workers
+    ANALYSIS_WORKERS: int = 2
+    ANALYSIS_PER_USER_LIMIT: int = 1
+    # A running job whose worker sent no heartbeat for this long, or whose
+    # model call failed, is retried up to ANALYSIS_MAX_ATTEMPTS runs in total
+    ANALYSIS_HEARTBEAT_TIMEOUT: int = 120
+    ANALYSIS_MAX_ATTEMPTS: int = 3
+
+    # Nightly batch analyses (Gemini batch mode). GEMINI_API_BASE can point to
+    # the local stand-in (python -m src.services.gemini_batch_stub) for testing.
+    GEMINI_API_BASE: str = "https://generativelanguage.googleapis.com"
+    BATCH_ANALYSIS_TIME: str = "03:00"
+    BATCH_MODEL: Optional[str] = None
+
+    # Per-user token bucket for calls paid with the shared GEMINI_API_KEY (0 disables)
+    AI_TOKEN_QUOTA: int = 300000
+    AI_TOKEN_REFILL_PER_HOUR: int = 100000
+
 
 class SettingsError(RuntimeError):
     pass
@@ -1,12 +1,18 @@
+import hashlib
+
 import streamlit as st
-import pandas as pd
-import plotly.express as px
-import re
 
-from ..services.iol_client import IOLClient
+from ..services.iol_client import IOLClient, parse_portfolio
 from ..services.market_data import MarketData
+from ..services.fx_rates import FXRates, FX_CCL
+from ..services.ai_analyst import clean_ai_response
+from ..services.ai_usage import quota_for, usage_report
+from ..services.analysis_context import gather_analysis_context
 from ..data.portfolio_manager import PortfolioManager
 from ..data.auth_manager import AuthManager
+from ..data.job_queue import JobQueue
+from .session_cache import SessionStages
+from .warmup import Warmup, chained
 from ..settings import get_settings, SettingsError
 
 # Page Config MUST be the first Streamlit command
@@ -124,13 +130,6 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-def clean_ai_response(text):
-    """Cleans AI response for better display in Streamlit."""
-    text = re.sub(r'\$(\d[\d,\.]*[kKmM]?)\$', r'$\1', text) 
-    text = re.sub(r'\$([A-Z]{2,})\$', r'\1', text) 
-    text = re.sub(r'\n{3,}', '\n\n', text)
-    return text.strip()
-
 def iol_credentials_status(iol_user, iol_pass):
     if iol_user and iol_pass:
         return "✅ IOL: Credenciales guardadas"
@@ -155,259 +154,533 @@ def render_history_card(text):
     st.markdown(text)
     st.markdown('</div>', unsafe_allow_html=True)
 
-def run_app(username, full_name, gemini_key, iol_user, iol_pass, iol_base_url):
-    st.title(f"💰 Personal Investment Assistant")
-    st.caption(f"Logged in as: {full_name}")
+JOBS_POLL_SECONDS = 3
+
+def render_background_jobs(username):
+    """Shows background analyses, polling only while the user has queued or running jobs."""
+    if "analysis_jobs_polling" not in st.session_state:
+        # New session (or browser refresh): jobs may still be active for the user
+        st.session_state["analysis_jobs_polling"] = bool(JobQueue().get_active_jobs(username))
+    run_every = JOBS_POLL_SECONDS if st.session_state["analysis_jobs_polling"] else None
+    st.fragment(_background_jobs, run_every=run_every)(username)
+
+def _background_jobs(username):
+    queue = JobQueue()
+    # Jobs from this session plus any still active for the user (survives a browser refresh)
+    job_ids = list(st.session_state.get("analysis_job_ids", []))
+    if st.session_state["analysis_jobs_polling"]:
+        job_ids += [job["id"] for job in queue.get_active_jobs(username) if job["id"] not in job_ids]
+
+    pending = []
+    for job_id in job_ids:
+        job = queue.get(job_id)
+        if job is None or job["user_id"] != username:
+            continue
+        if job["status"] in ("queued", "running"):
+            label = "⏳ En cola" if job["status"] == "queued" else "⚙️ Generando"
+            st.caption(f"{label}: análisis #{job_id}")
+            pending.append(job_id)
+        elif job["status"] == "done":
+            analysis = PortfolioManager().get_analysis(job["analysis_id"])
+            if analysis:
+                st.success(f"Análisis #{job_id} listo ({analysis['model']})")
+                render_ai_response(analysis["response"])
+        else:
+            st.error(f"Análisis #{job_id} falló: {job['error']}")
+    st.session_state["analysis_job_ids"] = job_ids
+    if len(pending) < len(job_ids) and st.button("Clear finished analyses", key="clear_finished_jobs"):
+        st.session_state["analysis_job_ids"] = pending
+        st.rerun(scope="fragment")
+
+    # Last job finished: rerun once so the fragment is rebuilt without the timer
+    if st.session_state["analysis_jobs_polling"] and not pending:
+        st.session_state["analysis_jobs_polling"] = False
+        st.rerun()
+
+@st.fragment
+def render_usage_admin():
+    """Admin view: Gemini token usage and estimated spend by user and model."""
+    st.subheader("💸 AI Usage")
+    days = st.radio("Período", [1, 7, 30], index=1, horizontal=True, format_func=lambda d: f"{d} días")
+    report = usage_report(days=days)
+    if report.empty:
+        st.info("Todavía no hay uso registrado.")
+        return
+
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Llamadas", f"{int(report['calls'].sum()):,}")
+    col2.metric("Tokens", f"{int(report[['prompt_tokens', 'thought_tokens', 'output_tokens']].sum().sum()):,}")
+    col3.metric("Costo estimado", f"US$ {report['estimated_cost_usd'].sum():,.2f}")
+
+    by_user = report.groupby("user_id")["estimated_cost_usd"].sum().sort_values(ascending=False)
+    st.bar_chart(by_user, horizontal=True)
+    st.dataframe(
+        report,
+        column_config={
+            "estimated_cost_usd": st.column_config.NumberColumn("Costo est. (US$)", format="$%.4f"),
+            "avg_latency_s": st.column_config.NumberColumn("Latencia prom. (s)", format="%.1f"),
+        },
+        hide_index=True, use_container_width=True
+    )
+    st.caption("Costos estimados con precios de lista (src/services/ai_usage.py); no reemplazan la facturación de Google.")
+
+DASHBOARD_TTL = 300
+# Decrypted API keys are kept in the session this long (a save refreshes them)
+USER_KEYS_TTL = 300
+
+def fetch_portfolio(username, use_simulation, iol_user, iol_pass, iol_base_url):
+    """
+    Fetch stage: portfolio rows from IOL (or mock data) plus the messages to
+    show. Today's snapshot is written here, once per fetch.
+    """
+    notices = []
+    portfolio_data = []
+    if use_simulation:
+        portfolio_data = get_mock_portfolio()
+    else:
+        try:
+            # Use passed credentials
+            iol = IOLClient(iol_user, iol_pass, base_url=iol_base_url)
+            iol.authenticate()
+            raw_portfolio = iol.get_portfolio()
+
+            if raw_portfolio and 'activos' in raw_portfolio:
+                portfolio_data = parse_portfolio(raw_portfolio)
+            elif raw_portfolio:
+                if isinstance(raw_portfolio, dict):
+                    keys = ", ".join(raw_portfolio.keys())
+                    notices.append(("warning", f"IOL respondió, pero no se encontraron activos. Claves: {keys}"))
+                else:
+                    notices.append(("warning", "IOL respondió, pero el formato no es el esperado."))
+        except Exception as e:
+            notices.append(("warning", "No se pudo conectar a IOL. Se muestran datos simulados."))
+            notices.append(("error", f"Detalle del error IOL: {e}"))
+            portfolio_data = get_mock_portfolio()
+
+    if portfolio_data:
+        # Save Snapshot (Multi-tenancy: Pass user_id)
+        total_value = sum(item["Total Value"] for item in portfolio_data)
+        PortfolioManager().save_daily_snapshot(total_value, portfolio_data, user_id=username)
+    return {"portfolio_data": portfolio_data, "notices": notices}
+
+def enrich_portfolio(username, portfolio_data, currency):
+    """Enrich stage: totals, gains and history from the stored snapshots."""
+    import pandas as pd
 
-    # Initialize Classes
-    market = MarketData()
     pm = PortfolioManager()
-    
-    st.sidebar.header("Settings")
-    use_simulation = st.sidebar.toggle("🧪 Simulation Mode", value=(not iol_user))
-    
-    # --- TABS LAYOUT ---
-    tab_dashboard, tab_analyst = st.tabs(["📊 Dashboard", "🤖 AI Strategist"])
+    total_value = sum(item["Total Value"] for item in portfolio_data)
+    return {
+        "total_value": total_value,
+        # Historical Gains (Multi-tenancy: Pass user_id)
+        "gains": pm.calculate_gains(total_value, user_id=username, currency=currency),
+        "df_portfolio": pd.DataFrame(pm.calculate_asset_gains(portfolio_data, user_id=username)),
+        "history_df": pm.get_history(days=90, user_id=username, currency=currency),
+    }
 
-    # ============================
-    # TAB 1: DASHBOARD
-    # ============================
-    with tab_dashboard:
-        portfolio_data = [] 
+def build_charts(enriched):
+    """Charts stage: Plotly figures for the history and allocation charts."""
+    # Plotly is only needed once there is something to chart
+    import plotly.express as px
+
+    history_df = enriched["history_df"]
+    fig_hist = None
+    if not history_df.empty:
+        fig_hist = px.area(history_df, x='date', y='total_value', color_discrete_sequence=["#667eea"])
+        fig_hist.update_layout(xaxis_title="", yaxis_title="", margin=dict(l=0, r=0, t=10, b=0), height=250)
+
+    fig_alloc = px.pie(enriched["df_portfolio"], values='Total Value', names='Symbol', hole=0.5, color_discrete_sequence=px.colors.qualitative.Pastel)
+    fig_alloc.update_layout(showlegend=True, margin=dict(l=0, r=0, t=10, b=0), height=250)
+    fig_alloc.update_traces(textposition='inside', textinfo='percent')
+    return {"history": fig_hist, "allocation": fig_alloc}
+
+def credentials_key(iol_user, iol_pass):
+    """Digest of the IOL credentials, so cached fetches follow credential changes."""
+    return hashlib.sha256(f"{iol_user}\n{iol_pass}".encode()).hexdigest()[:16]
+
+def start_warmup(username, use_simulation, iol_user, iol_pass, iol_base_url, gemini_key):
+    """
+    Starts the independent first-paint fetches concurrently right after
+    login: IOL portfolio, FX rates, the Gemini model list and the market
+    context/news for the analyst (which waits on the portfolio). Skipped if
+    the dashboard is already cached for this session.
+    """
+    if SessionStages(username).peek("fetch") is not None:
+        return
+
+    def warm_models():
+        from ..services.ai_analyst import AIAnalyst
+        return AIAnalyst(gemini_key).list_models()
+
+    @chained
+    def warm_context(futures):
+        # Primes the price and news caches used when generating an analysis
+        fetched = futures["portfolio"].result()
+        return gather_analysis_context(fetched["portfolio_data"])
+
+    tasks = {
+        "portfolio": lambda: fetch_portfolio(username, use_simulation, iol_user, iol_pass, iol_base_url),
+        "fx": lambda: FXRates().ensure_rates(),
+        "context": warm_context,
+    }
+    if gemini_key:
+        tasks["models"] = warm_models
+    Warmup().start((username, use_simulation, credentials_key(iol_user, iol_pass)), tasks)
+
+@st.fragment
+def render_dashboard(username, use_simulation, currency, ccl_rate, iol_user, iol_pass, iol_base_url):
+    """
+    Dashboard tab. Each stage (fetch -> enrich -> charts) is cached in the
+    session, so reruns from other tabs don't touch IOL or the DB; the data
+    is refetched after DASHBOARD_TTL seconds or on demand.
+    """
+    stages = SessionStages(username)
+
+    if use_simulation:
+        st.caption("🧪 Running in Simulation Mode")
+        st.info("Desactiva Simulation Mode para traer datos reales de IOL.")
+    elif st.button("🔄 Actualizar", key="refresh_dashboard", help="Vuelve a traer el portafolio de IOL."):
+        stages.invalidate("fetch")
+
+    def fetch():
+        # Prefer the post-login warm-up result; fetch directly otherwise
+        with st.spinner("Cargando portafolio..."):
+            return (
+                Warmup().take("portfolio")
+                or fetch_portfolio(username, use_simulation, iol_user, iol_pass, iol_base_url)
+            )
 
-        if use_simulation:
-            st.caption("🧪 Running in Simulation Mode")
-            st.info("Desactiva Simulation Mode para traer datos reales de IOL.")
-            portfolio_data = get_mock_portfolio()
+    fetched = stages.get("fetch", (use_simulation, credentials_key(iol_user, iol_pass)), fetch, ttl=DASHBOARD_TTL)
+    for level, message in fetched["notices"]:
+        getattr(st, level)(message)
+    portfolio_data = fetched["portfolio_data"]
+
+    # --- Display ---
+    if not portfolio_data:
+        st.warning("No assets found.")
+        return
+
+    enriched = stages.get(
+        "enrich", (stages.version("fetch"), currency),
+        lambda: enrich_portfolio(username, portfolio_data, currency),
+    )
+    charts = stages.get("charts", stages.version("enrich"), lambda: build_charts(enriched))
+    total_value = enriched["total_value"]
+    gains = enriched["gains"]
+    df_portfolio = enriched["df_portfolio"]
+    history_df = enriched["history_df"]
+
+    # === HERO METRIC ===
+    if currency == "USD":
+        hero_value = f"US${total_value / ccl_rate:,.2f}"
+        hero_caption = f"Total Portfolio Value (CCL ${ccl_rate:,.2f})"
+    else:
+        hero_value = f"${total_value:,.2f}"
+        hero_caption = "Total Portfolio Value"
+    st.markdown(f"""
+    <div class="hero-metric">
+        <p>{hero_caption}</p>
+        <h1>{hero_value}</h1>
+    </div>
+    """, unsafe_allow_html=True)
+
+    # === RETURN METRICS ===
+    col_d, col_w, col_m = st.columns(3)
+
+    if 'daily' in gains:
+        col_d.metric("Daily", f"${gains['daily'][0]:,.0f}", f"{gains['daily'][1]:.2f}%")
+    else:
+        col_d.metric("Daily", "–", "0.0%")
+
+    if 'weekly' in gains:
+        col_w.metric("Weekly", f"${gains['weekly'][0]:,.0f}", f"{gains['weekly'][1]:.2f}%")
+    else:
+        col_w.metric("Weekly", "–", "0.0%")
+
+    if 'monthly' in gains:
+        col_m.metric("Monthly", f"${gains['monthly'][0]:,.0f}", f"{gains['monthly'][1]:.2f}%")
+    else:
+        col_m.metric("Monthly", "–", "0.0%")
+
+    st.divider()
+
+    # === CHARTS ===
+    col_chart1, col_chart2 = st.columns(2)
+
+    with col_chart1:
+        st.caption("📈 Performance History (90 days)")
+        if charts["history"] is not None:
+            st.plotly_chart(charts["history"], use_container_width=True)
+            reconstructed_days = int(history_df['reconstructed'].fillna(0).sum()) if 'reconstructed' in history_df else 0
+            if reconstructed_days:
+                st.caption(f"ℹ️ {reconstructed_days} día(s) reconstruidos con precios históricos (sin dato de IOL).")
         else:
-            try:
-                # Use passed credentials
-                iol = IOLClient(iol_user, iol_pass, base_url=iol_base_url)
-                iol.authenticate()
-                raw_portfolio = iol.get_portfolio()
-                
-                if raw_portfolio and 'activos' in raw_portfolio:
-                    for asset in raw_portfolio['activos']:
-                        symbol = asset.get('titulo', {}).get('simbolo', 'N/A')
-                        desc = asset.get('titulo', {}).get('descripcion', '')
-                        qty = asset.get('cantidad', 0)
-                        last_price = asset.get('ultimoPrecio', 0.0)
-                        total_val = asset.get('valorizado', 0.0)
-                        daily_var = asset.get('variacionDiaria', 0.0)
-                        
-                        portfolio_data.append({
-                            "Symbol": symbol,
-                            "Description": desc,
-                            "Quantity": qty,
-                            "Last Price": last_price,
-                            "Total Value": total_val,
-                            "Daily Var %": daily_var
-                        })
-                elif raw_portfolio:
-                    if isinstance(raw_portfolio, dict):
-                        keys = ", ".join(raw_portfolio.keys())
-                        st.warning(f"IOL respondió, pero no se encontraron activos. Claves: {keys}")
-                    else:
-                        st.warning("IOL respondió, pero el formato no es el esperado.")
-            except Exception as e:
-                st.warning("No se pudo conectar a IOL. Se muestran datos simulados.")
-                st.error(f"Detalle del error IOL: {e}")
-                portfolio_data = get_mock_portfolio()
-        
-        # --- Display ---
-        if portfolio_data:
-            df_portfolio = pd.DataFrame(portfolio_data)
-            total_value = df_portfolio["Total Value"].sum()
-            
-            # Save Snapshot (Multi-tenancy: Pass user_id)
-            pm.save_daily_snapshot(total_value, portfolio_data, user_id=username)
-            
-            # Historical Gains (Multi-tenancy: Pass user_id)
-            gains = pm.calculate_gains(total_value, user_id=username)
-            portfolio_data_enriched = pm.calculate_asset_gains(portfolio_data, user_id=username)
-            df_portfolio = pd.DataFrame(portfolio_data_enriched)
-            
-            # === HERO METRIC ===
-            st.markdown(f"""
-            <div class="hero-metric">
-                <p>Total Portfolio Value</p>
-                <h1>${total_value:,.2f}</h1>
-            </div>
-            """, unsafe_allow_html=True)
-            
-            # === RETURN METRICS ===
-            col_d, col_w, col_m = st.columns(3)
-            
-            if 'daily' in gains:
-                col_d.metric("Daily", f"${gains['daily'][0]:,.0f}", f"{gains['daily'][1]:.2f}%")
-            else:
-                col_d.metric("Daily", "–", "0.0%")
-                
-            if 'weekly' in gains:
-                col_w.metric("Weekly", f"${gains['weekly'][0]:,.0f}", f"{gains['weekly'][1]:.2f}%")
-            else:
-                col_w.metric("Weekly", "–", "0.0%")
-                
-            if 'monthly' in gains:
-                col_m.metric("Monthly", f"${gains['monthly'][0]:,.0f}", f"{gains['monthly'][1]:.2f}%")
-            else:
-                col_m.metric("Monthly", "–", "0.0%")
-
-            st.divider()
-            
-            # === CHARTS ===
-            col_chart1, col_chart2 = st.columns(2)
-            
-            with col_chart1:
-                st.caption("📈 Performance History (90 days)")
-                history_df = pm.get_history(days=90, user_id=username)
-                if not history_df.empty:
-                    fig_hist = px.area(history_df, x='date', y='total_value', color_discrete_sequence=["#667eea"])
-                    fig_hist.update_layout(xaxis_title="", yaxis_title="", margin=dict(l=0, r=0, t=10, b=0), height=250)
-                    st.plotly_chart(fig_hist, use_container_width=True)
-                else:
-                    st.info("No history yet.")
-            
-            with col_chart2:
-                st.caption("🥧 Asset Allocation")
-                fig_alloc = px.pie(df_portfolio, values='Total Value', names='Symbol', hole=0.5, color_discrete_sequence=px.colors.qualitative.Pastel)
-                fig_alloc.update_layout(showlegend=True, margin=dict(l=0, r=0, t=10, b=0), height=250)
-                fig_alloc.update_traces(textposition='inside', textinfo='percent')
-                st.plotly_chart(fig_alloc, use_container_width=True)
-
-            st.divider()
-            
-            # === HOLDINGS TABLE ===
-            st.subheader("📋 Current Holdings")
-            cols_holdings = ["Symbol", "Description", "Quantity", "Last Price", "Total Value", "Daily Var %"]
-            available_cols_h = [c for c in cols_holdings if c in df_portfolio.columns]
-            
+            st.info("No history yet.")
+
+    with col_chart2:
+        st.caption("🥧 Asset Allocation")
+        st.plotly_chart(charts["allocation"], use_container_width=True)
+
+    st.divider()
+
+    # === HOLDINGS TABLE ===
+    st.subheader("📋 Current Holdings")
+    cols_holdings = ["Symbol", "Description", "Quantity", "Last Price", "Total Value", "Daily Var %"]
+    available_cols_h = [c for c in cols_holdings if c in df_portfolio.columns]
+
+    st.dataframe(
+        df_portfolio[available_cols_h],
+        column_config={
+            "Last Price": st.column_config.NumberColumn(format="$%.2f"),
+            "Total Value": st.column_config.NumberColumn(format="$%.2f"),
+            "Daily Var %": st.column_config.NumberColumn(format="%.2f%%"),
+        },
+        hide_index=True,
+        use_container_width=True
+    )
+
+    # === GAINS TABLE ===
+    with st.expander("📊 Performance & Gains by Asset"):
+        cols_gains = ["Symbol", "Daily Gain", "Weekly Gain", "Monthly Gain"]
+        available_cols_g = [c for c in cols_gains if c in df_portfolio.columns]
+
+        if len(available_cols_g) > 1:
             st.dataframe(
-                df_portfolio[available_cols_h],
+                df_portfolio[available_cols_g],
                 column_config={
-                    "Last Price": st.column_config.NumberColumn(format="$%.2f"),
-                    "Total Value": st.column_config.NumberColumn(format="$%.2f"),
-                    "Daily Var %": st.column_config.NumberColumn(format="%.2f%%"),
+                    "Daily Gain": st.column_config.NumberColumn(format="$%.2f"),
+                    "Weekly Gain": st.column_config.NumberColumn(format="$%.2f"),
+                    "Monthly Gain": st.column_config.NumberColumn(format="$%.2f"),
                 },
                 hide_index=True,
                 use_container_width=True
             )
-            
-            # === GAINS TABLE ===
-            with st.expander("📊 Performance & Gains by Asset"):
-                cols_gains = ["Symbol", "Daily Gain", "Weekly Gain", "Monthly Gain"]
-                available_cols_g = [c for c in cols_gains if c in df_portfolio.columns]
-                
-                if len(available_cols_g) > 1:
-                    st.dataframe(
-                        df_portfolio[available_cols_g],
-                        column_config={
-                            "Daily Gain": st.column_config.NumberColumn(format="$%.2f"),
-                            "Weekly Gain": st.column_config.NumberColumn(format="$%.2f"),
-                            "Monthly Gain": st.column_config.NumberColumn(format="$%.2f"),
-                        },
-                        hide_index=True,
-                        use_container_width=True
-                    )
 
-        else:
-            st.warning("No assets found.")
+@st.fragment
+def render_analyst(username, gemini_key):
+    """
+    AI Strategist tab. Runs as a fragment: its widgets rerun only this tab,
+    and the portfolio comes from the dashboard's cached fetch stage.
+    """
+    market = MarketData()
+    pm = PortfolioManager()
+    fx = FXRates()
+    fetched = SessionStages(username).peek("fetch") or {}
+    portfolio_data = fetched.get("portfolio_data", [])
 
-    # ============================
-    # TAB 2: AI STRATEGIST
-    # ============================
-    with tab_analyst:
-        st.subheader("🤖 AI Financial Advisor")
-        
-        selected_model = None
-        reasoning_mode = True
-        
-        if gemini_key:
-            from ..services.ai_analyst import AIAnalyst
-            analyst = AIAnalyst(gemini_key)
-            
-            col_cfg1, col_cfg2 = st.columns([1, 1])
-            with col_cfg1:
-                reasoning_mode = st.toggle("🧠 Enable Reasoning", value=True)
-            with col_cfg2:
-                available_models = analyst.list_models()
-                # ... same model filtering logic ...
-                if reasoning_mode:
-                    filtered = [m for m in available_models if "thinking" in m or "gemini-3" in m]
-                    if not filtered: filtered = [m for m in available_models if "pro" in m]
-                else:
-                    filtered = [m for m in available_models if "flash" in m and "thinking" not in m]
-                    if not filtered: filtered = available_models
-                
-                if filtered:
-                    selected_model = st.selectbox("Model", filtered, index=0, label_visibility="collapsed")
-
-            st.divider()
-
-            # ... Risk Profile Logic ...
-            st.caption("📊 Selecciona tu perfil de riesgo:")
-            risk_profiles = {
-                "🛡️ Conservador": {"label": "Conservador", "prompt_modifier": "Conservador - Prioriza preservación..."},
-                "🔵 Moderado-Bajo": {"label": "Moderado-Bajo", "prompt_modifier": "Moderado-Bajo..."},
-                "⚖️ Moderado": {"label": "Moderado", "prompt_modifier": "Moderado..."},
-                "🔶 Moderado-Alto": {"label": "Moderado-Alto", "prompt_modifier": "Moderado-Alto..."},
-                "🔥 Agresivo": {"label": "Agresivo", "prompt_modifier": "Agresivo..."}
-            }
-            selected_profile = st.radio("Perfil", list(risk_profiles.keys()), index=2, horizontal=True, label_visibility="collapsed")
-            
-            st.divider()
-            investment_amount = st.number_input("💵 Amount to Invest (ARS)", min_value=0.0, value=100000.0, step=10000.0)
-            
-            default_prompt = analyst.default_prompt
-
-            with st.expander("⚙️ Customize Instructions", expanded=False):
-                custom_prompt = st.text_area("Instructions:", value=default_prompt, height=200)
-
-            use_grounding = st.toggle("🌐 Enable Internet Search", value=True)
-
-            if st.button("🚀 Generate Investment Analysis", type="primary", use_container_width=True):
-                 with st.spinner(f"Analyzing with {selected_model}..."):
-                    market_context = market.get_global_context()
-                    news = market.get_market_news()
-                    portfolio_val = sum(item.get('Total Value', 0) for item in portfolio_data)
-                    
-                    risk_modifier = risk_profiles[selected_profile].get('prompt_modifier', '')
-                    final_prompt = f"**PERFIL DE RIESGO:** {risk_modifier}\n\n{custom_prompt}"
-                    
-                    analysis_text, used_model = analyst.analyze_portfolio(
-                        portfolio_data, investment_amount, market_context, news_headlines=news,
-                        model_name=selected_model, reasoning_enabled=reasoning_mode,
-                        prompt_template=final_prompt, use_grounding=use_grounding
+    st.subheader("🤖 AI Financial Advisor")
+    
+    selected_model = None
+    reasoning_mode = True
+    
+    if gemini_key:
+        from ..services.ai_analyst import AIAnalyst
+        analyst = AIAnalyst(gemini_key, user_id=username, quota=quota_for(gemini_key, get_settings()))
+    
+        col_cfg1, col_cfg2 = st.columns([1, 1])
+        with col_cfg1:
+            reasoning_mode = st.toggle("🧠 Enable Reasoning", value=True)
+        with col_cfg2:
+            available_models = Warmup().take("models") or analyst.list_models()
+            # ... same model filtering logic ...
+            if reasoning_mode:
+                filtered = [m for m in available_models if "thinking" in m or "gemini-3" in m]
+                if not filtered: filtered = [m for m in available_models if "pro" in m]
+            else:
+                filtered = [m for m in available_models if "flash" in m and "thinking" not in m]
+                if not filtered: filtered = available_models
+    
+            if filtered:
+                auto_label = "⚡ Auto (fastest healthy)"
+                choice = st.selectbox("Model", [auto_label] + filtered, index=0, label_visibility="collapsed")
+                selected_model = None if choice == auto_label else choice
+    
+        st.divider()
+    
+        # ... Risk Profile Logic ...
+        st.caption("📊 Selecciona tu perfil de riesgo:")
+        risk_profiles = {
+            "🛡️ Conservador": {"label": "Conservador", "prompt_modifier": "Conservador - Prioriza preservación..."},
+            "🔵 Moderado-Bajo": {"label": "Moderado-Bajo", "prompt_modifier": "Moderado-Bajo..."},
+            "⚖️ Moderado": {"label": "Moderado", "prompt_modifier": "Moderado..."},
+            "🔶 Moderado-Alto": {"label": "Moderado-Alto", "prompt_modifier": "Moderado-Alto..."},
+            "🔥 Agresivo": {"label": "Agresivo", "prompt_modifier": "Agresivo..."}
+        }
+        selected_profile = st.radio("Perfil", list(risk_profiles.keys()), index=2, horizontal=True, label_visibility="collapsed")
+    
+        st.divider()
+        investment_amount = st.number_input("💵 Amount to Invest (ARS)", min_value=0.0, value=100000.0, step=10000.0)
+    
+        default_prompt = analyst.default_prompt
+    
+        with st.expander("⚙️ Customize Instructions", expanded=False):
+            custom_prompt = st.text_area("Instructions:", value=default_prompt, height=200)
+    
+        use_grounding = st.toggle("🌐 Enable Internet Search", value=True)
+        structured_output = st.toggle("📋 Structured Plan", value=False, help="Pide el plan de acción como datos (JSON) y guarda cada operación sugerida para consultarla después. No usa streaming.")
+        stream_response = st.toggle("⚡ Stream Response", value=True, help="Muestra la respuesta a medida que el modelo la genera.", disabled=structured_output)
+        force_refresh = st.toggle("🔄 Force Refresh", value=False, help="Ignora el análisis en caché para los mismos datos y genera uno nuevo.")
+        allow_fallback = st.toggle("🔁 Allow Fallback", value=False, disabled=selected_model is None, help="Si el modelo elegido no responde, prueba con otro modelo disponible. En Auto siempre se prueba el siguiente.")
+    
+        run_in_background = st.toggle("🕒 Run in Background", value=False, help="Encola el análisis: podés seguir usando la app (o recargarla) y el resultado aparece al terminar.")
+    
+        if st.button("🚀 Generate Investment Analysis", type="primary", use_container_width=True):
+            risk_modifier = risk_profiles[selected_profile].get('prompt_modifier', '')
+            final_prompt = f"**PERFIL DE RIESGO:** {risk_modifier}\n\n{custom_prompt}"
+    
+            if run_in_background:
+                job_id = JobQueue().enqueue(username, {
+                    "portfolio_data": portfolio_data,
+                    "investment_amount": investment_amount,
+                    "model_name": selected_model,
+                    "reasoning_enabled": reasoning_mode,
+                    "prompt_template": final_prompt,
+                    "use_grounding": use_grounding,
+                    "force_refresh": force_refresh,
+                    "allow_fallback": allow_fallback,
+                    "structured_output": structured_output,
+                })
+                st.session_state["analysis_job_ids"] = st.session_state.get("analysis_job_ids", []) + [job_id]
+                st.session_state["analysis_jobs_polling"] = True
+                st.toast(f"Análisis #{job_id} encolado.")
+            else:
+                with st.spinner("Gathering market context..."):
+                    market_context, news = gather_analysis_context(portfolio_data, market=market, fx=fx)
+                portfolio_val = sum(item.get('Total Value', 0) for item in portfolio_data)
+    
+                analysis_args = dict(
+                    news_headlines=news, model_name=selected_model, reasoning_enabled=reasoning_mode,
+                    prompt_template=final_prompt, use_grounding=use_grounding,
+                    force_refresh=force_refresh, allow_fallback=allow_fallback
+                )
+    
+                if stream_response and not structured_output:
+                    chunks, used_model = analyst.stream_portfolio_analysis(
+                        portfolio_data, investment_amount, market_context, **analysis_args
                     )
-                    
+                    if analyst.last_call.get("quota_exceeded"):
+                        analysis_text = next(chunks)
+                    else:
+                        st.caption(f"Streaming from {used_model.replace('models/', '')}...")
+                        analysis_text = st.write_stream(chunks)
+                        if not isinstance(analysis_text, str):
+                            analysis_text = "".join(str(part) for part in analysis_text)
+                        # The router may have fallen back to another model mid-call
+                        used_model = analyst.last_call.get("model", used_model)
+                else:
+                    with st.spinner(f"Analyzing with {selected_model or 'the fastest available model'}..."):
+                        analysis_text, used_model = analyst.analyze_portfolio(
+                            portfolio_data, investment_amount, market_context,
+                            structured_output=structured_output, **analysis_args
+                        )
+    
+                if analyst.last_call.get("quota_exceeded"):
+                    st.warning(analysis_text)
+                elif analyst.last_call.get("error"):
+                    st.error(analyst.last_call["error"])
+                else:
                     if "models/" in used_model: used_model = used_model.replace("models/", "")
+                    if selected_model and used_model != selected_model.replace("models/", ""):
+                        st.info(f"{selected_model} no respondió; la respuesta es de {used_model}.")
                     cleaned_text = clean_ai_response(analysis_text)
-                    
-                    # SAVE ANALYSIS with user_id!
-                    pm.save_analysis(used_model, investment_amount, portfolio_val, cleaned_text, user_id=username)
-                    
+    
+                    # SAVE ANALYSIS with user_id! (once the stream has finished); a cached
+                    # answer the user already has is not saved again
+                    analysis_id = pm.find_analysis(cleaned_text, user_id=username) if analyst.last_call.get("cached") else None
+                    plan = analyst.last_call.get("plan")
+                    if analysis_id is None:
+                        analysis_id = pm.save_analysis(used_model, investment_amount, portfolio_val, cleaned_text, user_id=username)
+                        # Trades are recorded once per analysis, not again on every cache hit
+                        if plan:
+                            pm.save_recommendations(analysis_id, plan["trades"], user_id=username)
+                    if structured_output and not plan:
+                        st.warning("La respuesta no vino en el formato estructurado; se guardó como texto.")
+    
+                    if analyst.last_call.get("cached"):
+                        stats = analyst.get_cache_stats()
+                        st.info(f"♻️ Served from cache (hit rate {stats['hit_rate']:.0%}). Activá Force Refresh para regenerar.")
                     st.success(f"Generated with {used_model}")
-                    render_ai_response(cleaned_text)
+                    if structured_output or not stream_response:
+                        render_ai_response(cleaned_text)
+    
+        remaining = analyst.get_quota_remaining()
+        if remaining is not None:
+            st.caption(f"🎟️ Cuota disponible: ~{max(0, remaining):,.0f} tokens")
+    
+        render_background_jobs(username)
+    else:
+        st.warning("Needs API Key")
+    
+    # --- HISTORY ---
+    st.divider()
+    with st.expander("📚 Previous Analyses"):
+        # Get history for user
+        history_df = pm.get_analyses(limit=5, user_id=username)
+        if history_df.empty:
+            st.info("No analyses yet.")
+        else:
+            for _, row in history_df.iterrows():
+                 with st.container():
+                    st.caption(f"📅 {row['timestamp']} | 🤖 {row['model']} | 💵 ${row['investment_amount']:,.0f}")
+                    preview = row['response'][:200] + "..."
+                    render_history_card(preview)
+                    if st.button("View Full", key=f"v_{row['id']}"):
+                        st.markdown(row['response'])
+                    st.divider()
+    
+    with st.expander("📋 Recommended Trades (30 days)"):
+        summary_df = pm.get_recommendation_summary(user_id=username, days=30)
+        if summary_df.empty:
+            st.info("Activá Structured Plan para registrar las operaciones sugeridas.")
         else:
-            st.warning("Needs API Key")
+            st.dataframe(
+                summary_df,
+                column_config={
+                    "total_amount": st.column_config.NumberColumn("Monto Total", format="$%.0f"),
+                    "avg_limit_price": st.column_config.NumberColumn("Precio Límite Prom.", format="$%.2f"),
+                },
+                hide_index=True, use_container_width=True
+            )
 
-        # --- HISTORY ---
-        st.divider()
-        with st.expander("📚 Previous Analyses"):
-            # Get history for user
-            history_df = pm.get_analyses(limit=5, user_id=username)
-            if history_df.empty:
-                st.info("No analyses yet.")
-            else:
-                for _, row in history_df.iterrows():
-                     with st.container():
-                        st.caption(f"📅 {row['timestamp']} | 🤖 {row['model']} | 💵 ${row['investment_amount']:,.0f}")
-                        preview = row['response'][:200] + "..."
-                        render_history_card(preview)
-                        if st.button("View Full", key=f"v_{row['id']}"):
-                            st.markdown(row['response'])
-                        st.divider()
+def run_app(username, full_name, gemini_key, iol_user, iol_pass, iol_base_url):
+    st.title(f"💰 Personal Investment Assistant")
+    st.caption(f"Logged in as: {full_name}")
+
+    fx = FXRates()
+    
+    st.sidebar.header("Settings")
+    use_simulation = st.sidebar.toggle("🧪 Simulation Mode", value=(not iol_user))
+    start_warmup(username, use_simulation, iol_user, iol_pass, iol_base_url, gemini_key)
+    currency = st.sidebar.radio("💱 Currency", ["ARS", "USD"], horizontal=True, help="USD usa el dólar CCL de cada fecha.")
+    ccl_rate = None
+    if currency == "USD":
+        # Rates are fetched by the login warm-up and the scheduler; only wait for the former here
+        warmup = Warmup()
+        if warmup.pending("fx"):
+            warmup.take("fx")
+        ccl_rate = fx.store.latest_rate(FX_CCL)
+        if not ccl_rate:
+            st.sidebar.warning("No hay cotización CCL disponible. Se muestran valores en ARS.")
+            currency = "ARS"
+    
+    # --- TABS LAYOUT ---
+    is_admin = username == "admin"
+    tab_names = ["📊 Dashboard", "🤖 AI Strategist"] + (["💸 AI Usage"] if is_admin else [])
+    tab_dashboard, tab_analyst, *admin_tabs = st.tabs(tab_names)
+    if admin_tabs:
+        with admin_tabs[0]:
+            render_usage_admin()
 
+    # ============================
+    # TAB 1: DASHBOARD
+    # ============================
+    with tab_dashboard:
+        render_dashboard(username, use_simulation, currency, ccl_rate, iol_user, iol_pass, iol_base_url)
+
+    # ============================
+    # TAB 2: AI STRATEGIST
+    # ============================
+    with tab_analyst:
+        render_analyst(username, gemini_key)
 
 def main():
     try:
@@ -438,8 +711,8 @@ def main():
             authenticator.logout('Logout', 'main')
             
             with st.expander("🔐 API Credentials"):
-                # Load current keys
-                keys = auth_manager.get_user_keys(user_key)
+                # Load current keys (decrypted once per session, refreshed on save)
+                keys = auth_manager.get_user_keys_cached(user_key, st.session_state, ttl=USER_KEYS_TTL)
                 
                 new_gemini = st.text_input("Gemini API Key", value=keys.get("gemini") or "", type="password")
                 new_iol_u = st.text_input("IOL Username", value=keys.get("iol_user") or "", type="password")
@@ -455,6 +728,8 @@ def main():
                 if st.button("Save Credentials"):
                     try:
                         auth_manager.update_user_keys(user_key, new_gemini, new_iol_u, new_iol_p)
+                        # New credentials: refetch the dashboard on the next run
+                        SessionStages(user_key).invalidate()
                         saved = auth_manager.get_user_keys(user_key)
                         if saved.get("iol_user") or saved.get("iol_pass") or saved.get("gemini"):
                             st.success("Saved!")
@@ -482,8 +757,16 @@ def main():
                             except Exception as e:
                                 st.error(f"Falló la verificación de IOL: {e}")
 
+            batch_opt_in = auth_manager.get_batch_opt_in(user_key)
+            new_batch_opt_in = st.toggle(
+                "🌙 Nightly Analysis", value=batch_opt_in,
+                help="Genera un análisis de tu último portafolio cada madrugada (Gemini batch, menor costo). Aparece en Previous Analyses."
+            )
+            if new_batch_opt_in != batch_opt_in:
+                auth_manager.set_batch_opt_in(user_key, new_batch_opt_in)
+
         # Get credentials for the session
-        keys = auth_manager.get_user_keys(user_key)
+        keys = auth_manager.get_user_keys_cached(user_key, st.session_state, ttl=USER_KEYS_TTL)
         gemini_key = keys.get("gemini") or settings.GEMINI_API_KEY
         iol_u = st.session_state.get("iol_user_input") or keys.get("iol_user")
         iol_p = st.session_state.get("iol_pass_input") or keys.get("iol_pass")
@@ -0,0 +1,48 @@
+import time
+
+import streamlit as st
+
+class SessionStages:
+    """
+    Per-user cache of the dashboard pipeline in st.session_state, so reruns
+    triggered elsewhere in the page reuse the results instead of redoing the
+    I/O. Stages run in ORDER; each is stored with the inputs it was computed
+    from, and recomputing or invalidating a stage drops every later one.
+    """
+
+    ORDER = ("fetch", "enrich", "charts")
+
+    def __init__(self, user_id, state=None):
+        state = st.session_state if state is None else state
+        key = f"dashboard_stages:{user_id}"
+        if key not in state:
+            state[key] = {}
+        self.entries = state[key]
+
+    def _drop_from(self, stage):
+        for name in self.ORDER[self.ORDER.index(stage):]:
+            self.entries.pop(name, None)
+
+    def get(self, stage, key, compute, ttl=None):
+        """Cached value of `stage` for `key`; computed (and stored) on a miss or after `ttl` seconds."""
+        entry = self.entries.get(stage)
+        if entry and entry["key"] == key and (ttl is None or time.time() - entry["at"] < ttl):
+            return entry["value"]
+        value = compute()
+        self._drop_from(stage)
+        self.entries[stage] = {"key": key, "value": value, "at": time.time()}
+        return value
+
+    def peek(self, stage):
+        """Last value of `stage` without computing it (None if missing)."""
+        entry = self.entries.get(stage)
+        return entry["value"] if entry else None
+
+    def version(self, stage):
+        """Identifies the current value of `stage`; use it in later stages' keys."""
+        entry = self.entries.get(stage)
+        return entry["at"] if entry else None
+
+    def invalidate(self, stage=None):
+        """Drops `stage` and everything after it (all stages if None)."""
+        self._drop_from(stage or self.ORDER[0])
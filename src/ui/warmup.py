@@ -0,0 +1,67 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+
+# Shared by every session of this server process
+WARMUP_WORKERS = 8
+_executor = ThreadPoolExecutor(max_workers=WARMUP_WORKERS, thread_name_prefix="warmup")
+
+class Warmup:
+    """
+    Post-login warm-up: independent data sources are fetched concurrently
+    on a shared thread pool, and each section takes its result when it
+    renders, so the first paint waits for the slowest source instead of the
+    sum of all of them. Tasks must not call Streamlit.
+    """
+
+    STATE_KEY = "warmup"
+
+    def __init__(self, state=None):
+        self.state = st.session_state if state is None else state
+
+    def start(self, key, tasks):
+        """
+        Submits `tasks` ({name: callable}) unless a warm-up for the same key
+        (e.g. user and credentials) was already started in this session.
+        Tasks marked with chained() receive the futures submitted before
+        them, to wait on another task's result.
+        """
+        current = self.state.get(self.STATE_KEY)
+        if current and current["key"] == key:
+            return False
+        futures = {}
+        for name, task in tasks.items():
+            if getattr(task, "needs_futures", False):
+                futures[name] = _executor.submit(task, dict(futures))
+            else:
+                futures[name] = _executor.submit(task)
+        self.state[self.STATE_KEY] = {"key": key, "futures": futures}
+        return True
+
+    def pending(self, name):
+        """True if `name` is still running."""
+        future = self._futures().get(name)
+        return future is not None and not future.done()
+
+    def take(self, name, timeout=None):
+        """
+        Waits for `name` and hands over its result once (None if it was not
+        started, already taken or failed); later calls fetch fresh data.
+        """
+        future = self._futures().pop(name, None)
+        if future is None:
+            return None
+        try:
+            return future.result(timeout=timeout)
+        except Exception as e:
+            print(f"Warm-up task {name} failed: {e}")
+            return None
+
+    def _futures(self):
+        current = self.state.get(self.STATE_KEY)
+        return current["futures"] if current else {}
+
+def chained(task):
+    """Marks a warm-up task that receives the futures dict (to wait on another task)."""
+    task.needs_futures = True
+    return task
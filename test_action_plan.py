@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""Parsing of structured (JSON) analysis answers."""
+from pathlib import Path
+import json
+import sys
+
+ROOT = Path(__file__).resolve().parent
+sys.path.insert(0, str(ROOT))
+
+from src.services.action_plan import parse_action_plan, render_action_plan
+
+def test_parses_and_normalizes_trades():
+    plan = parse_action_plan("```json\n" + json.dumps({
+        "market_summary": ["Merval sube"],
+        "diagnostics": {"strengths": ["Diversificado"], "risks": []},
+        "trades": [
+            {"ticker": "ggal", "side": "buy", "quantity": "10", "limit_price": 2000, "amount": 20000},
+            {"ticker": "", "side": "BUY"},
+            {"ticker": "YPFD", "side": "HOLD"},
+        ],
+        "outlook": "Estable",
+    }) + "\n```")
+    assert plan["trades"] == [{
+        "ticker": "GGAL", "side": "BUY", "quantity": 10.0, "limit_price": 2000.0,
+        "amount": 20000.0, "rationale": "",
+    }]
+    assert "| GGAL | Compra |" in render_action_plan(plan)
+
+def test_malformed_sections_are_ignored():
+    plan = parse_action_plan('{"trades": ["GGAL", null, 3]}')
+    assert plan["trades"] == []
+    plan = parse_action_plan('{"diagnostics": ["x"]}')
+    assert plan["diagnostics"] == {"strengths": [], "risks": []}
+    render_action_plan(plan)
+
+def test_non_object_answers():
+    assert parse_action_plan("not json") is None
+    assert parse_action_plan('["GGAL"]') is None
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Reconstruction of missing trading days (backfill)."""
+from pathlib import Path
+from datetime import date
+import sqlite3
+import sys
+
+import pandas as pd
+
+ROOT = Path(__file__).resolve().parent
+sys.path.insert(0, str(ROOT))
+
+from src.data.portfolio_manager import PortfolioManager
+from src.services.backfill import find_gaps, reconstruct_day
+from src.services.market_calendar import MarketCalendar
+
+CLOSES = pd.DataFrame(
+    {
+        "GGAL": [100.0, None, 110.0, 121.0],
+        "AL30": [50.0, 50.0, 45.0, None],
+    },
+    index=["2024-03-04", "2024-03-05", "2024-03-06", "2024-03-07"],
+)
+
+def test_reconstruct_day_scales_iol_price():
+    # IOL quotes AL30 per 100 nominal: only the Yahoo move is applied
+    base = [("GGAL", 10, 2000.0), ("AL30", 200, 6000.0)]
+    assets = {a["Symbol"]: a for a in reconstruct_day("2024-03-04", base, "2024-03-06", CLOSES)}
+    assert assets["GGAL"]["Last Price"] == 2200.0
+    assert assets["GGAL"]["Total Value"] == 22000.0
+    assert assets["AL30"]["Last Price"] == 5400.0
+
+def test_reconstruct_day_uses_last_close_and_carries_forward():
+    base = [("GGAL", 10, 2000.0), ("AL30", 200, 6000.0), ("XYZ", 5, 10.0)]
+    # AL30 has no close on 03-07: the 03-06 close still applies
+    assets = {a["Symbol"]: a for a in reconstruct_day("2024-03-04", base, "2024-03-07", CLOSES)}
+    assert assets["GGAL"]["Last Price"] == 2420.0
+    assert assets["AL30"]["Last Price"] == 5400.0
+    # No market data at all: carried forward
+    assert assets["XYZ"]["Last Price"] == 10.0
+    # GGAL has no close on 03-05: the 03-04 close is used, so the price is unchanged
+    assets = reconstruct_day("2024-03-04", base, "2024-03-05", CLOSES)
+    assert assets[0]["Last Price"] == 2000.0
+    assert reconstruct_day("2024-03-04", base, "2024-03-06", pd.DataFrame())[0]["Last Price"] == 2000.0
+
+def test_find_gaps_skips_holidays_and_recorded_days():
+    calendar = MarketCalendar()
+    history = {"2024-03-25": []}
+    gaps = find_gaps(calendar, history, {"2024-03-26"}, date(2024, 3, 20), date(2024, 4, 2))
+    # Holy Thursday, Good Friday, the weekend and Malvinas (2 Apr) are not gaps
+    assert gaps == ["2024-03-27", "2024-04-01"]
+
+def _flags(db_path, day):
+    conn = sqlite3.connect(db_path)
+    row = conn.execute(
+        "SELECT total_value, reconstructed FROM portfolio_snapshots WHERE user_id = 'ana' AND date = ?", (day,)
+    ).fetchone()
+    assets = conn.execute(
+        "SELECT reconstructed FROM asset_snapshots WHERE user_id = 'ana' AND date = ?", (day,)
+    ).fetchall()
+    conn.close()
+    return row, [flag for flag, in assets]
+
+def test_reconstructed_flag(tmp_path):
+    db_path = str(tmp_path / "inver.db")
+    pm = PortfolioManager(db_path=db_path)
+    today = date.today().isoformat()
+    assets = reconstruct_day("2024-03-04", [("GGAL", 10, 2000.0)], "2024-03-06", CLOSES)
+
+    assert pm.save_reconstructed_snapshots("ana", {"2024-03-06": assets, today: assets}) == 2
+    assert _flags(db_path, "2024-03-06") == ((22000.0, 1), [1])
+    # Reconstructed days are not used as a base for later reconstructions
+    assert pm.get_asset_history("ana", "2024-03-01") == {}
+
+    # A real snapshot replaces the reconstruction and clears the flag...
+    pm.save_daily_snapshot(25000.0, [{"Symbol": "GGAL", "Quantity": 10, "Last Price": 2500.0, "Total Value": 25000.0}], user_id="ana")
+    assert _flags(db_path, today) == ((25000.0, 0), [0])
+    # ...and is never overwritten by a later backfill
+    assert pm.save_reconstructed_snapshots("ana", {today: assets}) == 0
+    assert _flags(db_path, today) == ((25000.0, 0), [0])
+
+def test_find_gaps_stops_after_max_distance():
+    calendar = MarketCalendar()
+    # Refreshes stopped after 2024-05-02: only the next max_distance days are rebuilt
+    gaps = find_gaps(calendar, {"2024-05-02": []}, set(), date(2024, 5, 1), date(2024, 5, 31), max_distance=7)
+    assert gaps == ["2024-05-03", "2024-05-06", "2024-05-07", "2024-05-08", "2024-05-09"]
+
+def test_reconstructed_rows_do_not_keep_a_user_active(tmp_path):
+    pm = PortfolioManager(db_path=str(tmp_path / "inver.db"))
+    assets = reconstruct_day("2024-03-04", [("GGAL", 10, 2000.0)], "2024-03-06", CLOSES)
+    pm.save_reconstructed_snapshots("ana", {date.today().isoformat(): assets})
+    assert pm.get_active_users(days=7) == []
+    pm.save_daily_snapshot(100.0, [], user_id="beto")
+    assert pm.get_active_users(days=7) == ["beto"]
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""Key rotation: after rotating, the old key can be removed from ENCRYPTION_KEY."""
+from pathlib import Path
+import sys
+
+from cryptography.fernet import Fernet
+
+ROOT = Path(__file__).resolve().parent
+sys.path.insert(0, str(ROOT))
+
+from src.settings import get_settings
+from src.data.auth_manager import AuthManager
+from src.data.batch_store import BatchStore
+from src.services.key_rotation import rotate_keys
+
+def _auth(monkeypatch, db_path, keys):
+    monkeypatch.setenv("ENCRYPTION_KEY", ",".join(keys))
+    monkeypatch.setenv("COOKIE_KEY", "test")
+    monkeypatch.setenv("ADMIN_PASSWORD", "test")
+    get_settings.cache_clear()
+    return AuthManager(db_path=str(db_path))
+
+def test_rotate_then_remove_old_key(monkeypatch, tmp_path):
+    db_path = tmp_path / "inver.db"
+    old, new = Fernet.generate_key().decode(), Fernet.generate_key().decode()
+
+    auth = _auth(monkeypatch, db_path, [old])
+    for i in range(5):
+        auth.register_user(f"user{i}", f"User {i}", f"user{i}@example.com", "pw")
+        auth.update_user_keys(f"user{i}", gemini=f"gemini-{i}", iol_user=f"iol-{i}", iol_pass=f"pass-{i}")
+    store = BatchStore(db_path=str(db_path))
+    store.add("batches/pending", "hash", auth.encrypt("batch-key"), "gemini", {})
+
+    # New key first, old key still readable
+    auth = _auth(monkeypatch, db_path, [new, old])
+    progress = rotate_keys(batch_size=2, workers=2, auth=auth, store=store)
+    assert progress["finished_at"] and progress["failed"] == 0
+
+    # Old key retired
+    auth = _auth(monkeypatch, db_path, [new])
+    for i in range(5):
+        assert auth.get_user_keys(f"user{i}") == {"gemini": f"gemini-{i}", "iol_user": f"iol-{i}", "iol_pass": f"pass-{i}"}
+    assert auth.decrypt(store.get_pending()[0]["api_key_enc"]) == "batch-key"
+    get_settings.cache_clear()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""Leases and refresh claims shared by scheduler replicas."""
+from pathlib import Path
+import sys
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent
+sys.path.insert(0, str(ROOT))
+
+from src.data.lease_store import LeaseStore, LEADER_LEASE
+
+USERS = ["ana", "beto", "carla", "dani"]
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("src.data.lease_store.time.time", lambda: now[0])
+    return now
+
+@pytest.fixture
+def replicas(tmp_path):
+    # Two replicas on the same database
+    db_path = str(tmp_path / "inver.db")
+    return LeaseStore(db_path=db_path), LeaseStore(db_path=db_path)
+
+def test_leader_lease_is_exclusive_until_it_expires(clock, replicas):
+    a, b = replicas
+    assert a.try_acquire(LEADER_LEASE, "a", ttl=60)
+    assert not b.try_acquire(LEADER_LEASE, "b", ttl=60)
+    # Renewing extends the lease
+    clock[0] += 50
+    assert a.try_acquire(LEADER_LEASE, "a", ttl=60)
+    clock[0] += 50
+    assert not b.try_acquire(LEADER_LEASE, "b", ttl=60)
+    # Replica a dies: b takes over once the lease expired
+    clock[0] += 11
+    assert b.try_acquire(LEADER_LEASE, "b", ttl=60)
+    assert not a.try_acquire(LEADER_LEASE, "a", ttl=60)
+
+def test_release_hands_the_lease_over(clock, replicas):
+    a, b = replicas
+    assert a.try_acquire(LEADER_LEASE, "a", ttl=60)
+    b.release(LEADER_LEASE, "b")  # not the holder: no-op
+    assert not b.try_acquire(LEADER_LEASE, "b", ttl=60)
+    a.release(LEADER_LEASE, "a")
+    assert b.try_acquire(LEADER_LEASE, "b", ttl=60)
+
+def test_replicas_split_the_users(clock, replicas):
+    a, b = replicas
+    assert a.claim_users(USERS, "a", limit=2, ttl=60, fresh_for=300) == ["ana", "beto"]
+    assert b.claim_users(USERS, "b", limit=10, ttl=60, fresh_for=300) == ["carla", "dani"]
+    assert a.claim_users(USERS, "a", limit=10, ttl=60, fresh_for=300) == []
+    assert a.claimed_elsewhere(USERS, "a") == 2
+    assert b.claimed_elsewhere(["ana", "carla"], "b") == 1
+
+def test_expired_claims_are_taken_over(clock, replicas):
+    a, b = replicas
+    a.claim_users(USERS, "a", limit=2, ttl=60, fresh_for=300)
+    clock[0] += 61
+    # a died before completing: its users go to b
+    assert b.claim_users(USERS, "b", limit=10, ttl=60, fresh_for=300) == USERS
+    assert b.claimed_elsewhere(USERS, "b") == 0
+    # a stale holder can no longer complete users it lost
+    a.complete_users(["ana"], "a")
+    clock[0] += 61
+    assert a.claim_users(["ana"], "a", limit=10, ttl=60, fresh_for=300) == ["ana"]
+
+def test_completed_users_stay_fresh(clock, replicas):
+    a, b = replicas
+    a.claim_users(USERS, "a", limit=2, ttl=60, fresh_for=300)
+    a.complete_users(["ana", "beto"], "a")
+    assert a.claimed_elsewhere(USERS, "b") == 0
+    # Refreshed users are skipped for fresh_for seconds, even after the claim ended
+    assert b.claim_users(USERS, "b", limit=10, ttl=60, fresh_for=300) == ["carla", "dani"]
+    clock[0] += 301
+    b.complete_users(["carla", "dani"], "b")
+    assert a.claim_users(USERS, "a", limit=10, ttl=60, fresh_for=300) == ["ana", "beto"]
+
+def test_released_users_can_be_retried_right_away(clock, replicas):
+    a, b = replicas
+    a.claim_users(USERS, "a", limit=2, ttl=60, fresh_for=300)
+    # The fetch failed for beto: released without being marked refreshed
+    a.release_users(["beto"], "a")
+    a.complete_users(["ana"], "a")
+    assert b.claim_users(USERS, "b", limit=10, ttl=60, fresh_for=300) == ["beto", "carla", "dani"]
+    # Releasing someone else's claim does nothing
+    a.release_users(["carla"], "a")
+    assert a.claim_users(USERS, "a", limit=10, ttl=60, fresh_for=300) == []
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""Argentine holidays and BYMA trading days."""
+from pathlib import Path
+from datetime import date
+import sys
+
+ROOT = Path(__file__).resolve().parent
+sys.path.insert(0, str(ROOT))
+
+from src.services.market_calendar import MarketCalendar, easter_sunday, national_holidays
+
+def test_easter_sunday():
+    assert easter_sunday(2019) == date(2019, 4, 21)
+    assert easter_sunday(2024) == date(2024, 3, 31)
+    assert easter_sunday(2025) == date(2025, 4, 20)
+    assert easter_sunday(2026) == date(2026, 4, 5)
+
+def test_easter_based_holidays():
+    holidays = national_holidays(2024)
+    # Carnival Monday/Tuesday, Holy Thursday, Good Friday
+    for day in (date(2024, 2, 12), date(2024, 2, 13), date(2024, 3, 28), date(2024, 3, 29)):
+        assert day in holidays
+    holidays = national_holidays(2025)
+    for day in (date(2025, 3, 3), date(2025, 3, 4), date(2025, 4, 17), date(2025, 4, 18)):
+        assert day in holidays
+
+def test_moved_holidays():
+    # San Martín 2023 (Thursday) -> next Monday
+    assert date(2023, 8, 21) in national_holidays(2023)
+    assert date(2023, 8, 17) not in national_holidays(2023)
+    # Diversidad Cultural 2023 (Thursday) -> next Monday
+    assert date(2023, 10, 16) in national_holidays(2023)
+    # Soberanía Nacional 2024 (Wednesday) -> previous Monday
+    assert date(2024, 11, 18) in national_holidays(2024)
+    assert date(2024, 11, 20) not in national_holidays(2024)
+    # Saturday/Sunday/Monday stay
+    assert date(2024, 10, 12) in national_holidays(2024)
+
+def test_guemes():
+    assert date(2020, 6, 15) in national_holidays(2020)   # Wednesday -> previous Monday
+    assert date(2021, 6, 21) in national_holidays(2021)   # Thursday -> next Monday
+    assert date(2025, 6, 16) in national_holidays(2025)   # Tuesday -> previous Monday
+    assert date(2024, 6, 17) in national_holidays(2024)   # Monday stays
+    # Friday stays: the next Monday is Belgrano (20 June)
+    assert date(2022, 6, 17) in national_holidays(2022)
+    assert date(2022, 6, 20) in national_holidays(2022)
+
+def test_is_trading_day():
+    calendar = MarketCalendar(extra_holidays={date(2024, 3, 27)})
+    assert calendar.is_trading_day(date(2024, 3, 26))
+    assert not calendar.is_trading_day(date(2024, 3, 27))   # extra holiday
+    assert not calendar.is_trading_day(date(2024, 3, 29))   # Good Friday
+    assert not calendar.is_trading_day(date(2024, 3, 30))   # Saturday
+    assert calendar.next_trading_day(date(2024, 3, 26)) == date(2024, 4, 1)
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""Token bucket used for the per-user AI quota."""
+from pathlib import Path
+import sys
+import math
+
+ROOT = Path(__file__).resolve().parent
+sys.path.insert(0, str(ROOT))
+
+from src.data.usage_store import UsageStore
+
+def test_bucket_consumes_and_refills(monkeypatch, tmp_path):
+    store = UsageStore(db_path=str(tmp_path / "inver.db"))
+    clock = [1000.0]
+    monkeypatch.setattr("src.data.usage_store.time.time", lambda: clock[0])
+
+    assert store.try_consume("ana", 600, capacity=1000, refill_per_hour=3600) == (True, 400.0, 0)
+    allowed, tokens, retry_after = store.try_consume("ana", 600, capacity=1000, refill_per_hour=3600)
+    assert not allowed and tokens == 400.0
+    assert retry_after == 200.0  # 200 tokens at 1 token/s
+
+    clock[0] += 200
+    assert store.try_consume("ana", 600, capacity=1000, refill_per_hour=3600)[0]
+    # Refill is capped at the capacity
+    clock[0] += 10 * 3600
+    assert store.get_bucket("ana", capacity=1000, refill_per_hour=3600) == 1000.0
+
+def test_oversized_request_is_charged_the_capacity(tmp_path):
+    store = UsageStore(db_path=str(tmp_path / "inver.db"))
+    allowed, tokens, _ = store.try_consume("ana", 5000, capacity=1000, refill_per_hour=3600)
+    assert allowed and tokens == 0
+
+def test_settle_returns_unused_reservation(tmp_path):
+    store = UsageStore(db_path=str(tmp_path / "inver.db"))
+    store.try_consume("ana", 800, capacity=1000, refill_per_hour=0)
+    store.settle("ana", reserved=800, actual=300, capacity=1000, refill_per_hour=0)
+    assert store.get_bucket("ana", capacity=1000, refill_per_hour=0) == 700.0
+
+def test_no_refill_denies_without_error(tmp_path):
+    store = UsageStore(db_path=str(tmp_path / "inver.db"))
+    assert store.try_consume("ana", 1000, capacity=1000, refill_per_hour=0)[0]
+    allowed, tokens, retry_after = store.try_consume("ana", 1, capacity=1000, refill_per_hour=0)
+    assert not allowed and tokens == 0 and math.isinf(retry_after)